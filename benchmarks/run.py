@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+import benchmarks.synthetic as synthetic
+import utils.backtest as backtest
+from benchmarks.stand_in_server import StandInServer
+import utils.data_fetching as fetching
+import utils.http_client as http
+import utils.mapping_registry as registry
+import utils.odds_analytics as odds_analytics
+import utils.prediction as prediction
+import utils.processed_store as store
+import utils.ranking as ranking
+import utils.ranking_series as ranking_series
+import utils.team_index as team_index
+
+BASELINE_PATH = "benchmarks/baseline.json"
+FIRST_SEASON = 2005
+
+def build_workspace(workspace: str, leagues: int, seasons: int, teams: int, server_url: str) -> dict[str, bytes]:
+    # Mapping files expected by the pipelines, and the files the stand-in server has to serve
+    os.makedirs(os.path.join(workspace, "data_mapping"), exist_ok=True)
+    synthetic.header_dictionary().to_csv(os.path.join(workspace, registry.HEADER_DICTIONARY_PATH), index=False)
+    pd.DataFrame({"Elo team name": [], "Global team name": []}).to_csv(
+        os.path.join(workspace, "data_mapping/team_elo_matches_mapping.csv"), index=False
+    )
+
+    files = {}
+    last_season = synthetic.season_code(FIRST_SEASON + seasons - 1)
+    for league_idx in range(leagues):
+        for season_idx in range(seasons):
+            season_start = FIRST_SEASON + season_idx
+            df = synthetic.season_matches(league_idx, season_start, teams)
+            files[f"/mmz4281/{synthetic.season_code(season_start)}/D{league_idx:02d}.csv"] = df.to_csv(index=False).encode()
+        files[f"/fixtures/{league_idx:02d}.ics"] = synthetic.ical_feed(league_idx, teams).encode()
+    pd.DataFrame({
+        "League": [f"League {i:02d}" for i in range(leagues)],
+        "Country": [f"Country {i % 10}" for i in range(leagues)],
+        "Source": [f"{server_url}/mmz4281/{last_season}/D{i:02d}.csv" for i in range(leagues)],
+        "Fixtures Source": [f"{server_url}/fixtures/{i:02d}.ics" for i in range(leagues)],
+    }).to_csv(os.path.join(workspace, "data_mapping/leagues_sources.csv"), index=False)
+    pd.DataFrame({
+        "League": [f"League {i:02d}" for i in range(leagues)],
+        "Country": [f"Country {i % 10}" for i in range(leagues)],
+        "Flag Filename": [f"{i % 10:02d}.svg" for i in range(leagues)],
+        "Division Filename": [f"{i:02d}.svg" for i in range(leagues)],
+    }).to_csv(os.path.join(workspace, registry.LEAGUES_IMAGES_PATH), sep=";", index=False)
+    files[f"/{datetime.now().strftime('%Y-%m-%d')}"] = synthetic.elo_snapshot(leagues, teams).to_csv(index=False).encode()
+    return files
+
+def measure(func, setup, rows: int, repeat: int) -> dict:
+    # Best wall time over the repeats, then one traced run for the peak memory
+    best = None
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    args = setup()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "seconds": best,
+        "rows": rows,
+        "rows_per_second": rows / best if best else None,
+        "peak_memory_mb": peak / 1024 ** 2,
+    }
+
+def run_benchmarks(leagues: int, seasons: int, teams: int, repeat: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as workspace, StandInServer({}) as server:
+        server.files.update(build_workspace(workspace, leagues, seasons, teams, server.url))
+        # Restored afterwards : the benchmarks can run in a process which goes on using ClubElo
+        elo_api_url = fetching.ELO_API_URL
+        fetching.ELO_API_URL = server.url
+        cwd = os.getcwd()
+        os.chdir(workspace)
+        try:
+            seasons_codes = [synthetic.season_code(FIRST_SEASON + i) for i in range(seasons)]
+            sources = "data_mapping/leagues_sources.csv"
+
+            def fetch_seasons():
+                frames = [fetching.fetch_matches_data(sources, use_cache=False, season=code) for code in seasons_codes]
+                return pd.concat(frames, axis=0, ignore_index=True)
+            raw_matches = fetch_seasons()
+            matches = raw_matches.copy()
+            fetching.map_fullname_columns(matches)
+            team_matches = ranking.team_matches_table(matches)
+            overall = ranking.results_ranking(team_matches)
+            elo = fetching.fetch_elo_data(use_cache=False)
+            teams_names = sorted(set(matches["Home Team"]))
+            history = pd.concat([synthetic.elo_history(team, seasons) for team in teams_names], ignore_index=True)
+            history[["From", "To"]] = history[["From", "To"]].apply(pd.to_datetime)
+            tables = {
+                "Matches": matches, "Ranking": overall.reset_index(),
+                "Countries and leagues": matches[["Country", "League"]].drop_duplicates(),
+                "Ranking history": ranking_series.ranking_history(matches),
+                "Odds": odds_analytics.odds_table(matches),
+            }
+
+            def elo_enrichment(elo_frame, ranking_frame):
+                team_country_league = team_index.teams_table(matches)
+                fetching.pre_process_elo_data(elo_frame, team_country_league)
+                ranking.add_elo_column(ranking_frame, elo_frame)
+
+            # Imported here so that streamlit start-up is not part of the measure
+            from utils.preview_prep import build_preview_cube, map_divisions_leagues_images, split_processed_data_sheets
+            def preview_cube(key):
+                build_preview_cube(key, matches)
+
+            def upload(workbook, key):
+                # Data preview page of an uploaded workbook : its sheets, then the images of its leagues
+                split_processed_data_sheets(workbook, key)
+                map_divisions_leagues_images(workbook, key)
+            def upload_setup(key):
+                # The workbook of the core Excel export, as the uploaded file (getvalue())
+                with open("bench.xlsx", "rb") as f:
+                    return BytesIO(f.read()), key
+            def upload_rerun_setup():
+                workbook, key = upload_setup("bench-rerun")
+                upload(workbook, key)
+                return workbook, key
+
+            fixtures_urls = list(pd.read_csv(sources)["Fixtures Source"])
+            def fixtures():
+                for url in fixtures_urls:
+                    fetching.parse_league_fixtures(http.fetch_url(url, use_cache=False).content)
+            fixtures_tables = {
+                url: fetching.league_fixtures_table(url, http.fetch_url(url, use_cache=False).content) for url in fixtures_urls
+            }
+            timezones = ["UTC", "Europe/London", "Europe/Paris", "America/New_York", "Asia/Tokyo"]
+            def fixtures_weeks():
+                # Sheets of several weeks and timezones, from the tables parsed once
+                for weeks in range(-2, 3):
+                    for tz in timezones:
+                        start, end = fetching.week_bounds(tz, datetime.now() + pd.Timedelta(weeks=weeks))
+                        fetching.fixtures_window(fixtures_tables, start, end, tz)
+
+            week_fixtures = fetching.fixtures_window(fixtures_tables, *fetching.week_bounds("UTC"), "UTC")
+            models = prediction.fit_models(matches, path="bench_models.json")
+
+            features = backtest.match_features(matches)
+            # 20 x 10 x 10 = 2,000 combinations of thresholds
+            sweep = backtest.Strategy("Home win", [
+                backtest.parse_rule("Points per match difference >= -1:0.9:0.1"),
+                backtest.parse_rule("Home Team consistency >= 0:0.45:0.05"),
+                backtest.parse_rule("Odds >= 1.2:2.1:0.1"),
+            ])
+
+            n = len(matches)
+            no_setup = lambda: ()
+            # name -> (benchmarked function, untimed setup returning its arguments, rows processed)
+            benchmarks = {
+                "fetch_matches_data": (fetch_seasons, no_setup, n),
+                "map_fullname_columns": (fetching.map_fullname_columns, lambda: (raw_matches.copy(),), n),
+                "create_overall_ranking": (ranking.create_overall_ranking, lambda: (matches,), n),
+                "add_consistency_columns": (
+                    ranking.add_consistency_columns, lambda: (overall.copy(), team_matches, (5, 10)), len(team_matches)
+                ),
+                "add_side_stats_columns": (ranking.add_side_stats_columns, lambda: (overall.copy(), team_matches), len(team_matches)),
+                "elo_enrichment": (elo_enrichment, lambda: (elo.copy(), overall.copy()), len(elo)),
+                "kickoff_elo_asof": (fetching.add_match_elo_columns, lambda: (matches.copy(), history), n),
+                "ranking_history": (ranking_series.ranking_history, lambda: (matches,), n),
+                "odds_table": (odds_analytics.odds_table, lambda: (matches,), n),
+                "parquet_write": (store.save_store, lambda: (tables, "bench_store"), n),
+                "excel_write": (store.export_store_to_excel, lambda: ("bench.xlsx", "bench_store", None, True), n),
+                "excel_write_core": (store.export_store_to_excel, lambda: ("bench.xlsx", "bench_store"), n),
+                "preview_cube": (preview_cube, lambda: (f"bench-{time.perf_counter_ns()}",), n),
+                # A new file is parsed, a file already seen (every rerun of the page) only comes from the memory tier
+                "upload_parse": (upload, lambda: upload_setup(f"bench-{time.perf_counter_ns()}"), n),
+                "upload_rerun": (upload, upload_rerun_setup, n),
+                "fixtures_parse": (fixtures, no_setup, len(fixtures_urls)),
+                "fixtures_weeks": (fixtures_weeks, no_setup, 5 * len(timezones)),
+                "prediction_fit": (
+                    prediction.fit_models, lambda: (matches, None, f"bench_models_{time.perf_counter_ns()}.json"), n
+                ),
+                "backtest_features": (backtest.match_features, lambda: (matches,), n),
+                "backtest_sweep": (backtest.run_backtest, lambda: (features, sweep), n),
+                "prediction_scoring": (prediction.score_fixtures, lambda: (week_fixtures, models), len(week_fixtures)),
+            }
+            for name, (func, setup, rows) in benchmarks.items():
+                results[name] = measure(func, setup, rows, repeat)
+                print(f"{name:<24} {results[name]['seconds']:>8.3f}s {results[name]['rows_per_second'] or 0:>14,.0f} rows/s "
+                      f"{results[name]['peak_memory_mb']:>9.1f} MB")
+        finally:
+            os.chdir(cwd)
+            fetching.ELO_API_URL = elo_api_url
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        status = "REGRESSION" if ratio > tolerance else "ok"
+        print(f"{name:<24} {ratio:>6.2f}x baseline time  {status}")
+        if ratio > tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Soccer BI benchmarks on synthetic Football-Data.co.uk shaped data")
+    parser.add_argument("--leagues", type=int, default=5, choices=range(1, 51), metavar="[1-50]")
+    parser.add_argument("--seasons", type=int, default=3, choices=range(1, 21), metavar="[1-20]")
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    config = {"leagues": args.leagues, "seasons": args.seasons, "teams": args.teams}
+    results = run_benchmarks(args.leagues, args.seasons, args.teams, args.repeat)
+
+    # Baselines are stored per data size
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+    key = json.dumps(config, sort_keys=True)
+    if args.save_baseline:
+        baselines[key] = results
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Baseline saved in {args.baseline}")
+    elif key in baselines:
+        if compare(results, baselines[key], args.tolerance):
+            sys.exit(1)
+    else:
+        print("No baseline for this configuration, run with --save-baseline to store one")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandInServer:
+    # Local HTTP stand-in for Football-Data.co.uk, ClubElo and the fixtures feeds, serving in-memory files
+    def __init__(self, files: dict[str, bytes], host: str = "127.0.0.1", port: int = 0):
+        self.files = files
+        files_ref = files
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = files_ref.get(self.path)
+                if content is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
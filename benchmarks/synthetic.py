@@ -0,0 +1,151 @@
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import utils.mapping_registry as registry
+
+# Football-Data.co.uk fields generated besides the odds, named by the header dictionary of the repository
+MATCH_FIELDS = [
+    "Div", "Date", "Time", "HomeTeam", "AwayTeam", "FTHG", "FTAG", "FTR", "HTHG", "HTAG", "HTR",
+    "HS", "AS", "HST", "AST", "HF", "AF", "HC", "AC", "HY", "AY", "HR", "AR",
+]
+RESULT_BOOKMAKERS = ["B365", "BW", "IW", "PS", "WH", "VC", "Max", "Avg"]
+TOTAL_BOOKMAKERS = ["B365", "P", "Max", "Avg"]
+HANDICAP_BOOKMAKERS = ["B365", "P", "Max", "Avg"]
+
+def odds_fields() -> list[str]:
+    fields = [f"{bookmaker}{outcome}" for bookmaker in RESULT_BOOKMAKERS for outcome in "HDA"]
+    fields += [f"{bookmaker}{side}2.5" for bookmaker in TOTAL_BOOKMAKERS for side in "><"]
+    fields += ["AHh"] + [f"{bookmaker}AH{side}" for bookmaker in HANDICAP_BOOKMAKERS for side in "HA"]
+    return fields
+
+def header_dictionary(path: str = registry.HEADER_DICTIONARY_PATH) -> pd.DataFrame:
+    # Header dictionary of the repository, the generated fields it does not name keeping their code
+    header_dictionary = pd.read_csv(path)
+    missing = [field for field in MATCH_FIELDS + odds_fields() if field not in set(header_dictionary["Field"])]
+    return pd.concat([header_dictionary, pd.DataFrame({"Field": missing, "Fullname": missing})], ignore_index=True)
+
+def league_teams(league_idx: int, teams_per_league: int) -> list[str]:
+    return [f"Club {league_idx:02d}-{team_idx:02d}" for team_idx in range(teams_per_league)]
+
+def season_matches(
+        league_idx: int, season_start: int, teams_per_league: int = 20, seed: int = 0
+    ) -> pd.DataFrame:
+    # Double round robin of one league season, shaped like a Football-Data.co.uk CSV
+    rng = np.random.default_rng((seed, league_idx, season_start))
+    teams = np.array(league_teams(league_idx, teams_per_league))
+    home_idx, away_idx = np.nonzero(~np.eye(teams_per_league, dtype=bool))
+    n = len(home_idx)
+    order = rng.permutation(n)
+    home_idx, away_idx = home_idx[order], away_idx[order]
+
+    strength = rng.normal(0, 0.35, teams_per_league)
+    home_rate = np.exp(0.3 + strength[home_idx] - strength[away_idx])
+    away_rate = np.exp(0.05 + strength[away_idx] - strength[home_idx])
+    fthg, ftag = rng.poisson(home_rate), rng.poisson(away_rate)
+    hthg, htag = rng.binomial(fthg, 0.45), rng.binomial(ftag, 0.45)
+
+    # Matchdays spread from August to May
+    season_days = (datetime(season_start + 1, 5, 25) - datetime(season_start, 8, 10)).days
+    days = np.sort(rng.integers(0, season_days, n))
+    dates = [datetime(season_start, 8, 10) + timedelta(days=int(d)) for d in days]
+
+    df = pd.DataFrame({
+        "Div": f"D{league_idx:02d}",
+        "Date": [d.strftime("%d/%m/%Y") for d in dates],
+        "Time": rng.choice(["15:00", "17:30", "20:00", "21:00"], n),
+        "HomeTeam": teams[home_idx],
+        "AwayTeam": teams[away_idx],
+        "FTHG": fthg,
+        "FTAG": ftag,
+        "FTR": np.select([fthg > ftag, fthg < ftag], ["H", "A"], "D"),
+        "HTHG": hthg,
+        "HTAG": htag,
+        "HTR": np.select([hthg > htag, hthg < htag], ["H", "A"], "D"),
+        "HS": fthg + rng.poisson(10, n),
+        "AS": ftag + rng.poisson(8, n),
+    })
+    df["HST"] = np.minimum(df["HS"], fthg + rng.poisson(3, n))
+    df["AST"] = np.minimum(df["AS"], ftag + rng.poisson(2, n))
+    for field in ["HF", "AF"]:
+        df[field] = rng.poisson(11, n)
+    for field in ["HC", "AC"]:
+        df[field] = rng.poisson(5, n)
+    for field in ["HY", "AY"]:
+        df[field] = rng.poisson(2, n)
+    for field in ["HR", "AR"]:
+        df[field] = rng.binomial(1, 0.05, n)
+
+    # Odds derived from the scoring rates, with a bookmaker margin and some noise
+    p_home = 1 / (1 + np.exp(-(home_rate - away_rate)))
+    p_draw = np.full(n, 0.26)
+    p_home = p_home * (1 - p_draw)
+    p_away = 1 - p_draw - p_home
+    for bookmaker in RESULT_BOOKMAKERS:
+        margin = 1.05 + rng.uniform(0, 0.03)
+        for outcome, proba in zip("HDA", (p_home, p_draw, p_away)):
+            df[f"{bookmaker}{outcome}"] = np.round(1 / (proba * margin) * rng.uniform(0.97, 1.03, n), 2)
+    p_over = 1 - np.exp(-(home_rate + away_rate)) * (1 + (home_rate + away_rate) + (home_rate + away_rate) ** 2 / 2)
+    for bookmaker in TOTAL_BOOKMAKERS:
+        df[f"{bookmaker}>2.5"] = np.round(1 / (p_over * 1.05), 2)
+        df[f"{bookmaker}<2.5"] = np.round(1 / ((1 - p_over) * 1.05), 2)
+    df["AHh"] = np.round((away_rate - home_rate) * 2) / 2
+    for bookmaker in HANDICAP_BOOKMAKERS:
+        df[f"{bookmaker}AHH"] = np.round(rng.uniform(1.8, 2.1, n), 2)
+        df[f"{bookmaker}AHA"] = np.round(rng.uniform(1.8, 2.1, n), 2)
+    return df
+
+def season_code(season_start: int) -> str:
+    return f"{season_start % 100:02d}{(season_start + 1) % 100:02d}"
+
+def elo_snapshot(leagues: int, teams_per_league: int = 20, other_clubs: int = 600, seed: int = 0) -> pd.DataFrame:
+    # ClubElo-shaped snapshot : synthetic league clubs plus clubs that are not in the matches
+    rng = np.random.default_rng(seed)
+    clubs = [team for league_idx in range(leagues) for team in league_teams(league_idx, teams_per_league)]
+    clubs += [f"Other Club {i:04d}" for i in range(other_clubs)]
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return pd.DataFrame({
+        "Rank": np.arange(1, len(clubs) + 1),
+        "Club": clubs,
+        "Country": rng.choice(["ENG", "ESP", "GER", "ITA", "FRA"], len(clubs)),
+        "Level": rng.choice([1, 2], len(clubs)),
+        "Elo": np.round(rng.normal(1500, 150, len(clubs)), 2),
+        "From": (today - timedelta(days=7)).strftime("%Y-%m-%d"),
+        "To": (today + timedelta(days=7)).strftime("%Y-%m-%d"),
+    })
+
+def elo_history(club: str, seasons: int, seed: int = 0) -> pd.DataFrame:
+    # One rating per week over the seasons, as returned by the ClubElo club endpoint
+    rng = np.random.default_rng((seed, zlib.crc32(club.encode())))
+    starts = pd.date_range(datetime.now() - timedelta(days=365 * seasons), datetime.now(), freq="7D")
+    return pd.DataFrame({
+        "Rank": 1,
+        "Club": club,
+        "Country": "ENG",
+        "Level": 1,
+        "Elo": np.round(1500 + np.cumsum(rng.normal(0, 5, len(starts))), 2),
+        "From": starts.strftime("%Y-%m-%d"),
+        "To": (starts + timedelta(days=6)).strftime("%Y-%m-%d"),
+    })
+
+def ical_feed(league_idx: int, teams_per_league: int = 20, weeks: int = 38) -> str:
+    # Sky Sports-like calendar : one event per fixture, "Home v Away" summaries
+    teams = league_teams(league_idx, teams_per_league)
+    start = datetime.now().replace(hour=15, minute=0, second=0, microsecond=0) - timedelta(weeks=weeks // 2)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//soccer-bi//benchmarks//EN"]
+    for week in range(weeks):
+        shift = week % (teams_per_league - 1) + 1
+        for i in range(0, teams_per_league, 2):
+            home, away = teams[i], teams[(i + shift) % teams_per_league]
+            kickoff = start + timedelta(weeks=week, hours=i % 6)
+            lines += [
+                "BEGIN:VEVENT",
+                f"UID:{league_idx}-{week}-{i}@soccer-bi",
+                f"DTSTART:{kickoff.strftime('%Y%m%dT%H%M%SZ')}",
+                f"SUMMARY:{home} v {away}",
+                "END:VEVENT",
+            ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
@@ -0,0 +1,206 @@
+import argparse
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import utils.backtest as backtest
+import utils.data_fetching as fetching
+import utils.match_warehouse as warehouse
+import utils.prediction as prediction
+import utils.processed_store as store
+from utils.ranking_state import process_input_stream, refresh_ranking
+from utils.profiling import RunReport
+from utils.ranking import fetch_all_matches, process_input_data
+from utils.ranking_series import SERIES_COLUMNS, build_series
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    yield
+    print(f"[{stage}] {time.perf_counter() - start:.2f}s")
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d")
+
+def load_runs(args: argparse.Namespace) -> list[dict]:
+    # Several league/date configurations from a JSON file, or a single one from the arguments
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return [{
+        "leagues": args.leagues,
+        "from": args.from_date,
+        "to": args.to_date,
+        "output": args.output,
+        "excel": args.excel,
+        "seasons": args.seasons,
+    }]
+
+def run_process(args: argparse.Namespace):
+    if args.stream and args.historical_elo:
+        raise SystemExit("--historical-elo is not available with --stream")
+    runs = load_runs(args)
+    all_matches = None
+    if args.update_warehouse:
+        with timed("warehouse update"):
+            print(warehouse.update_warehouse(args.update_warehouse))
+    if not args.warehouse and not args.stream:
+        with timed("matches download"):
+            all_matches = fetch_all_matches()
+    with timed("elo download"):
+        elo = fetching.fetch_elo_data()
+
+    for run in runs:
+        from_date = parse_date(run["from"])
+        # The end date is inclusive, as in the data process page
+        to_date = datetime.combine(parse_date(run["to"]), datetime.max.time())
+        output = run.get("output") or store.STORE_DIR
+        report = RunReport(track_memory=args.track_memory, profile=args.profile)
+        with timed(f"process {', '.join(run['leagues'])} ({run['from']} - {run['to']})"):
+            if args.stream:
+                # Matches read chunk by chunk from the sources, over as many seasons as needed
+                process_input_stream(
+                    run["leagues"], from_date, to_date, tuple(args.consistency_windows), seasons=run.get("seasons"),
+                    store_dir=output, elo=elo, report=report
+                )
+            else:
+                process_input_data(
+                    run["leagues"], from_date, to_date, tuple(args.consistency_windows),
+                    store_dir=output, use_warehouse=args.warehouse, historical_elo=args.historical_elo,
+                    all_matches=all_matches, elo=elo, report=report, workers=args.workers
+                )
+        for record in report.stages:
+            print(f"    {record.name}: {record.seconds:.2f}s, rows {record.rows_in} -> {record.rows_out}")
+        print(f"    report: {report.save()}")
+        if run.get("excel"):
+            with timed(f"excel export {run['excel']}"):
+                export = store.export_store_to_excel(run["excel"], output, include_odds=args.odds)
+            for record in export.stages:
+                print(f"    {record.name}: {record.seconds:.2f}s, {record.rows_out} rows, {record.bytes_out / 1024 ** 2:.1f} MB")
+
+def run_refresh(args: argparse.Namespace):
+    report = RunReport(name="refresh", track_memory=args.track_memory)
+    with timed(f"refresh {', '.join(args.leagues)} (from {args.from_date})"):
+        refresh_ranking(
+            args.leagues, parse_date(args.from_date), tuple(args.consistency_windows), store_dir=args.output, report=report
+        )
+    for record in report.stages:
+        print(f"    {record.name}: {record.seconds:.3f}s, rows {record.rows_in} -> {record.rows_out}")
+
+def run_fixtures(args: argparse.Namespace):
+    with timed("fixtures download"):
+        fixtures = fetching.get_week_fixtures(args.timezone, parse_date(args.week) if args.week else None)
+    sheets = None
+    if args.predict:
+        with timed("fixtures scoring"):
+            probabilities = prediction.predict_fixtures(fixtures, args.store)
+            sheets = prediction.prediction_sheets(fixtures, probabilities)
+        unscored = prediction.unscored_fixtures(fixtures, probabilities)
+        if not unscored.empty:
+            print(f"{len(unscored)} of {len(fixtures)} fixtures not scored (unknown league or team names) :")
+            print(unscored.to_string(index=False))
+    with timed(f"prediction sheets {args.output}"):
+        fetching.save_fixtures_as_sheets(fixtures, args.output, sheets)
+
+def run_table(args: argparse.Namespace):
+    with timed("ranking series"):
+        series = build_series(store.load_table("Matches", args.output, SERIES_COLUMNS))
+    end = parse_date(args.as_of) if args.as_of else None
+    # Tables of the season of the last date, or of the whole period from the first date
+    table = series.between(parse_date(args.from_date), end) if args.from_date else series.as_of(end)
+    columns = ["Position", "Played", "Win", "Draw", "Loss", "Goals", "Conceded", "Goal difference", "Points"]
+    for league, league_table in table.groupby(level="League", sort=True):
+        if args.leagues and league not in args.leagues:
+            continue
+        print(league)
+        print(league_table.droplevel("League").sort_values("Position")[columns].to_string())
+
+def run_backtest(args: argparse.Namespace):
+    with timed("features"):
+        features = backtest.load_features(args.output, args.leagues, args.bookmaker, args.best_price, args.form_window)
+    strategy = backtest.Strategy(args.selection, [backtest.parse_rule(rule) for rule in args.rule])
+    with timed(f"backtest {len(features)} matches"):
+        results = backtest.run_backtest(features, strategy)
+    if args.csv:
+        results.to_csv(args.csv, index=False)
+    best = results[results["Bets"] >= args.min_bets].sort_values("ROI", ascending=False)
+    print(f"{len(results)} strategies, {len(best)} with at least {args.min_bets} bets")
+    print(best.head(args.top).to_string(index=False))
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Soccer BI pipelines, without the Streamlit app")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    process = subparsers.add_parser("process", help="Process matches into the ranking and processed data store")
+    process.add_argument("--leagues", nargs="+", default=["Premier League", "Bundesliga", "LaLiga", "Serie A", "Ligue 1"])
+    process.add_argument("--from", dest="from_date", default="2024-08-01", help="Start date (YYYY-MM-DD)")
+    process.add_argument("--to", dest="to_date", default=datetime.now().strftime("%Y-%m-%d"), help="End date (YYYY-MM-DD)")
+    process.add_argument("--output", default=store.STORE_DIR, help="Processed data store directory")
+    process.add_argument("--excel", help="Also export the processed data as an Excel workbook")
+    process.add_argument("--odds", action="store_true", help="Include the bookmakers odds in the Excel workbook")
+    process.add_argument("--config", help="JSON list of runs with leagues, from, to, output, excel and seasons keys")
+    process.add_argument("--warehouse", action="store_true", help="Read matches from the local warehouse")
+    process.add_argument("--stream", action="store_true", help="Stream matches from the sources with a bounded memory")
+    process.add_argument("--seasons", nargs="+", metavar="SEASON", help="Seasons streamed with --stream, oldest first, e.g. 2324 2425")
+    process.add_argument("--update-warehouse", nargs="+", metavar="SEASON", help="Seasons to ingest first, e.g. 2324 2425")
+    process.add_argument("--consistency-windows", nargs="+", type=int, default=[], metavar="N", help="Also rank the consistency over the last N matches (adds columns to the Ranking sheet)")
+    process.add_argument(
+        "--historical-elo", action="store_true",
+        help="Add the Elo of both teams at kickoff to the matches (one ClubElo request per team, not with --stream)"
+    )
+    process.add_argument("--workers", type=int, default=1, help="Worker processes ranking the leagues in parallel")
+    process.add_argument("--track-memory", action="store_true", help="Record the peak memory of every stage")
+    process.add_argument("--profile", action="store_true", help="Capture a cProfile of each run in its report")
+    process.set_defaults(func=run_process)
+
+    refresh = subparsers.add_parser("refresh", help="Add the matches played since the last run to the saved ranking state")
+    refresh.add_argument("--leagues", nargs="+", default=["Premier League", "Bundesliga", "LaLiga", "Serie A", "Ligue 1"])
+    refresh.add_argument("--from", dest="from_date", default="2024-08-01", help="Start date (YYYY-MM-DD) of the ranking")
+    refresh.add_argument("--output", default=store.STORE_DIR, help="Processed data store directory")
+    refresh.add_argument("--consistency-windows", nargs="+", type=int, default=[], metavar="N", help="Also rank the consistency over the last N matches (adds columns to the Ranking sheet)")
+    refresh.add_argument("--track-memory", action="store_true", help="Record the peak memory of every stage")
+    refresh.set_defaults(func=run_refresh)
+
+    table = subparsers.add_parser("table", help="League tables of the processed matches, as of any date")
+    table.add_argument("--as-of", dest="as_of", help="Last date (YYYY-MM-DD) of the tables, the last matchday by default")
+    table.add_argument("--from", dest="from_date", help="First date (YYYY-MM-DD) of the tables, the start of the season by default")
+    table.add_argument("--leagues", nargs="+", help="Leagues to print, all of them by default")
+    table.add_argument("--output", default=store.STORE_DIR, help="Processed data store directory")
+    table.set_defaults(func=run_table)
+
+    fixtures = subparsers.add_parser("fixtures", help="Generate the current week prediction sheets")
+    fixtures.add_argument("--timezone", default="UTC")
+    fixtures.add_argument("--week", help="Any day (YYYY-MM-DD) of the week to generate, the current one by default")
+    fixtures.add_argument("--output", default="tmp/prediction_sheet.xlsx")
+    fixtures.add_argument("--predict", action="store_true", help="Pre-fill the sheets with the probabilities of the prediction models")
+    fixtures.add_argument("--store", default=store.STORE_DIR, help="Processed data store the models are fitted on")
+    fixtures.set_defaults(func=run_fixtures)
+
+    backtest_parser = subparsers.add_parser("backtest", help="Evaluate betting strategies on the processed matches")
+    backtest_parser.add_argument("--selection", default="Home win", choices=list(backtest.OUTCOMES))
+    backtest_parser.add_argument(
+        "--rule", action="append", default=[],
+        help="Condition on a feature, with one or several thresholds, e.g. 'Home Team consistency > 0.5' or 'Odds >= 1.5:3:0.1' ('Elo difference >= 0:200:25' needs matches processed with --historical-elo)"
+    )
+    backtest_parser.add_argument("--bookmaker", help="Bookmaker code of the odds bets are settled at (e.g. B365), the market average by default")
+    backtest_parser.add_argument(
+        "--best-price", action="store_true",
+        help="Settle bets at the best price of the bookmakers (known after the fact : overstates the ROI)"
+    )
+    backtest_parser.add_argument(
+        "--form-window", type=int, default=backtest.FORM_WINDOW,
+        help="Previous home (or away) matches the teams consistency is computed over"
+    )
+    backtest_parser.add_argument("--leagues", nargs="+", help="Leagues to bet on, all of them by default")
+    backtest_parser.add_argument("--min-bets", type=int, default=30, help="Strategies with fewer bets are not printed")
+    backtest_parser.add_argument("--top", type=int, default=20, help="Number of strategies printed, by ROI")
+    backtest_parser.add_argument("--csv", help="Save the results of every strategy")
+    backtest_parser.add_argument("--output", default=store.STORE_DIR, help="Processed data store directory")
+    backtest_parser.set_defaults(func=run_backtest)
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    with timed("total"):
+        args.func(args)
@@ -0,0 +1,356 @@
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+import benchmarks.run as benchmarks
+import benchmarks.synthetic as synthetic
+from benchmarks.stand_in_server import StandInServer
+import utils.backtest as backtest
+import utils.data_fetching as fetching
+import utils.jobs as jobs
+import utils.match_schema as schema
+import utils.match_warehouse as warehouse
+import utils.odds_analytics as odds_analytics
+import utils.processed_store as store
+import utils.ranking as ranking
+import utils.ranking_series as ranking_series
+import utils.ranking_state as ranking_state
+import utils.team_index as team_index
+import utils.xlsx_writer as xlsx
+
+def synthetic_matches(leagues: int = 2, seasons: int = 2, teams: int = 8, first_season: int = 2022) -> pd.DataFrame:
+    # Football-Data.co.uk shaped seasons, read and renamed as the pipelines do
+    frames = []
+    for league_idx in range(leagues):
+        for season_start in range(first_season, first_season + seasons):
+            content = synthetic.season_matches(league_idx, season_start, teams).to_csv(index=False).encode()
+            frames.append(schema.read_matches_csv(content).assign(Country=f"Country {league_idx}", League=f"League {league_idx:02d}"))
+    matches = pd.concat(frames, axis="index", ignore_index=True).rename(columns=fetching.header_mapping())
+    return matches.sort_values("Match Date", kind="stable", ignore_index=True)
+
+def ical_calendar(*events: str) -> bytes:
+    body = "".join(f"BEGIN:VEVENT\r\nUID:{i}@tests\r\n{event}\r\nEND:VEVENT\r\n" for i, event in enumerate(events))
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n{body}END:VCALENDAR\r\n".encode()
+
+def test_fixtures_kickoffs_in_utc():
+    fixtures = fetching.parse_league_fixtures(ical_calendar(
+        "DTSTART:20240817T140000Z\r\nSUMMARY:Arsenal v Wolves",
+        'DTSTART;TZID="Europe/London":20240817T150000\r\nSUMMARY:Everton v Brighton',
+        "DTSTART;TZID=GMT Standard Time:20240817T150000\r\nSUMMARY:Newcastle v Southampton",
+        "DTSTART;VALUE=DATE:20240818\r\nSUMMARY:Chelsea v Manchester City",
+    ))
+    assert list(fixtures["Match Date"]) == [
+        pd.Timestamp("2024-08-17 14:00", tz="UTC"),
+        pd.Timestamp("2024-08-17 14:00", tz="UTC"),
+        pd.Timestamp("2024-08-17 14:00", tz="UTC"),
+        pd.Timestamp("2024-08-18 00:00", tz="UTC"),
+    ]
+    assert list(fixtures["Home Team"]) == ["Arsenal", "Everton", "Newcastle", "Chelsea"]
+
+def test_fixtures_unknown_zone_and_escapes():
+    fixtures = fetching.parse_league_fixtures(ical_calendar(
+        "DTSTART;TZID=Nowhere/Zone:20240817T150000\r\nSUMMARY:Brighton \\, Hove v Fulham",
+    ))
+    assert fixtures["Match Date"].tolist() == [pd.Timestamp("2024-08-17 15:00", tz="UTC")]
+    assert fixtures["Home Team"].tolist() == ["Brighton , Hove"]
+
+def test_fixtures_dst_fall_back_hour_kept():
+    # 01:30 happens twice in London on 2024-10-27 : the fixture is kept, at its first occurrence
+    fixtures = fetching.parse_league_fixtures(ical_calendar(
+        "DTSTART;TZID=Europe/London:20241027T013000\r\nSUMMARY:Leeds v Hull",
+    ))
+    assert fixtures["Match Date"].tolist() == [pd.Timestamp("2024-10-27 00:30", tz="UTC")]
+
+def test_fixtures_without_match_left_out():
+    fixtures = fetching.parse_league_fixtures(ical_calendar(
+        "SUMMARY:Leeds v Hull",
+        "DTSTART:20240817T140000Z\r\nSUMMARY:International break",
+    ))
+    assert fixtures.empty
+    assert list(fixtures.columns) == ["Match Date", "Home Team", "Away Team"]
+
+def empty_team_index(tmp_path) -> team_index.TeamIndex:
+    mapping_path = tmp_path / "team_elo_matches_mapping.csv"
+    pd.DataFrame({"Global team name": [], "Elo team name": []}).to_csv(mapping_path, index=False)
+    index = team_index.TeamIndex(str(tmp_path / "team_index.json"), str(mapping_path))
+    index.add_teams(pd.DataFrame({
+        "Team": ["Sp Lisbon", "Sporting Lisbon", "Benfica", "Arsenal"],
+        "Country": ["Portugal", "Portugal", "Portugal", "UK"],
+        "League": ["Liga", "Liga", "Liga", "Premier League"],
+    }))
+    return index
+
+def test_team_suggestions_contested_left_for_review(tmp_path):
+    index = empty_team_index(tmp_path)
+    names = pd.Series(["Sporting Lisboa", "Sporting Lisbon B", "Benfica"])
+    resolved = index.resolve(names, "elo", countries=pd.Series(["Portugal"] * 3))
+    # Sporting Lisbon is the closest team of both names : neither is applied
+    assert resolved.tolist() == ["Sporting Lisboa", "Sporting Lisbon B", "Benfica"]
+    assert index.suggestions["elo"]["Sporting Lisboa"][0] == "Sporting Lisbon"
+    assert not index.suggestions["elo"]["Sporting Lisboa"][4]
+
+def test_team_suggestions_within_country(tmp_path):
+    index = empty_team_index(tmp_path)
+    names = pd.Series(["Arsenal.", "Arsenal.", "Benfica."])
+    resolved = index.resolve(names, "elo", countries=pd.Series(["Portugal", "Portugal", "Portugal"]))
+    assert resolved.tolist() == ["Arsenal.", "Arsenal.", "Benfica"]
+    resolved = index.resolve(pd.Series(["Arsenal."]), "elo", countries=pd.Series(["UK"]))
+    assert resolved.tolist() == ["Arsenal"]
+    assert index.source_names(["Arsenal", "Benfica", "Sp Lisbon"], "elo") == ["Arsenal.", "Benfica.", "Sp Lisbon"]
+
+def test_team_names_without_country_not_searched(tmp_path):
+    index = empty_team_index(tmp_path)
+    resolved = index.resolve(pd.Series(["Arsenal.", "Benfica."]), "elo", countries=pd.Series([None, "Portugal"]))
+    assert resolved.tolist() == ["Arsenal.", "Benfica"]
+    assert "Arsenal." not in index.suggestions["elo"]
+
+def test_xlsx_round_trip():
+    df = pd.DataFrame({
+        "Team": pd.Categorical(["Brighton & Hove", "<Wolves>", None]),
+        "Goals": [1, 2, 3],
+        "Rate": [0.5, np.nan, np.inf],
+        "Match Date": pd.to_datetime(["2024-08-17 15:00", "2024-08-18 16:30", None]),
+        "Won": [True, False, True],
+        "Level": ["1", 2, None],
+    })
+    output = BytesIO()
+    # Shared frame rendered once, chunks streamed, empty frame keeping its header
+    xlsx.write_workbook(output, {
+        "Ranking": df, "Copy": df, "Chunks": xlsx.chunked(df, chunk_rows=2), "Empty": df.iloc[:0],
+    })
+    workbook = openpyxl.load_workbook(output)
+    assert workbook.sheetnames == ["Ranking", "Copy", "Chunks", "Empty"]
+    expected = [
+        list(df.columns),
+        ["Brighton & Hove", 1, 0.5, datetime(2024, 8, 17, 15), True, "1"],
+        ["<Wolves>", 2, None, datetime(2024, 8, 18, 16, 30), False, 2],
+        [None, 3, None, None, True, None],
+    ]
+    for name in ("Ranking", "Copy", "Chunks"):
+        assert [list(row) for row in workbook[name].iter_rows(values_only=True)] == expected
+    assert [list(row) for row in workbook["Empty"].iter_rows(values_only=True)] == [list(df.columns)]
+    output.seek(0)
+    sheets = pd.read_excel(output, sheet_name=None)
+    assert sheets["Ranking"]["Goals"].tolist() == [1, 2, 3]
+    assert sheets["Ranking"]["Match Date"].tolist()[:2] == list(df["Match Date"][:2])
+
+def test_xlsx_invalid_characters_and_sheet_names():
+    output = BytesIO()
+    xlsx.write_workbook(output, {"Teams": pd.DataFrame({"Team": ["Bad\x0bName\ufffe", "Tab\tKept"]})})
+    assert [row[0].value for row in openpyxl.load_workbook(output)["Teams"].iter_rows(min_row=2)] == ["BadName", "Tab\tKept"]
+    df = pd.DataFrame({"Team": ["Arsenal"]})
+    for sheets in ({"Ranking history and odds 2024/25": df}, {"Odds [B365]": df}, {"Odds": df, "ODDS": df}, {"": df}):
+        with pytest.raises(ValueError):
+            xlsx.write_workbook(BytesIO(), sheets)
+
+def relegated_matches() -> pd.DataFrame:
+    # Club 00-00 is relegated after the first season, Club 00-99 promoted in its place
+    matches = synthetic_matches(leagues=1)
+    second_season = matches["Match Date"] >= pd.Timestamp("2023-07-01")
+    for col in ("Home Team", "Away Team"):
+        matches.loc[second_season, col] = matches.loc[second_season, col].replace("Club 00-00", "Club 00-99")
+    return matches
+
+def test_series_periods_match_overall_ranking():
+    matches = synthetic_matches()
+    series = ranking_series.build_series(matches)
+    rng = np.random.default_rng(0)
+    dates = np.sort(matches["Match Date"].unique())
+    for _ in range(10):
+        start, end = np.sort(rng.choice(dates, 2, replace=False))
+        period = matches[matches["Match Date"].between(start, end)]
+        team_matches = ranking.team_matches_table(period)
+        expected = ranking.results_ranking(team_matches).join(ranking.side_stats_ranking(team_matches))
+        table = series.between(start, end).droplevel("League")
+        pd.testing.assert_series_equal(table["Points"], expected["Points"].reindex(table.index), check_names=False, check_dtype=False)
+        pd.testing.assert_series_equal(table["Win"], expected["Win"].reindex(table.index), check_names=False, check_dtype=False)
+        pd.testing.assert_series_equal(table["Goals"], expected["Goals - All"].reindex(table.index), check_names=False, check_dtype=False)
+        pd.testing.assert_series_equal(
+            table["Shots on target"], expected["Shots on target - All"].reindex(table.index), check_names=False, check_dtype=False
+        )
+        assert sorted(table.index) == sorted(expected.index)
+
+def test_series_seasons_start_again():
+    matches = relegated_matches()
+    series = ranking_series.build_series(matches)
+    table = series.as_of("2024-01-01").droplevel("League")
+    assert "Club 00-00" not in table.index and "Club 00-99" in table.index
+    second_season = matches[matches["Match Date"].between("2023-07-01", "2024-01-01")]
+    expected = ranking.create_overall_ranking(second_season)
+    assert table["Points"].sort_index().tolist() == expected["Points"].sort_index().tolist()
+
+    history = ranking_series.ranking_history(matches)
+    assert set(history["Season"]) == {"2223", "2324"}
+    last_day = history[history["Season"] == "2223"]["Match Date"].max()
+    last_table = history[history["Match Date"] == last_day].set_index("Team")
+    expected = series.as_of(last_day).droplevel("League")
+    assert last_table["Points"].sort_index().tolist() == expected["Points"].sort_index().tolist()
+    assert "Club 00-00" not in set(history[history["Season"] == "2324"]["Team"])
+    # Every table of the second season only counts its matches
+    first_day = history[history["Season"] == "2324"]["Match Date"].min()
+    assert history[history["Match Date"] == first_day]["Played"].max() == 1
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    # Pipelines run against the stand-in server of the benchmarks, from a workspace of their own
+    with StandInServer({}) as server:
+        server.files.update(benchmarks.build_workspace(str(tmp_path), 3, 1, 10, server.url))
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(fetching, "ELO_API_URL", server.url)
+        yield server
+
+def sorted_table(df: pd.DataFrame, keys: list[str]) -> pd.DataFrame:
+    df = df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+    return df.sort_values(keys, kind="stable", ignore_index=True)
+
+def test_stream_and_refreshes_match_batch(workspace):
+    matches = fetching.fetch_matches_data(use_cache=False)
+    fetching.map_fullname_columns(matches)
+    elo = fetching.fetch_elo_data(use_cache=False)
+    leagues, start = ["League 00", "League 02"], datetime(2005, 9, 15)
+    ranking.process_input_data(leagues, start, datetime(2006, 12, 1), all_matches=matches, elo=elo, store_dir="batch")
+
+    # Streamed up to a matchday of several matches, absorbed over two refreshes
+    league_matches = matches[matches["League"].isin(leagues)]
+    matchdays = league_matches.groupby("Match Date").size()
+    split_day = matchdays[(matchdays.index > datetime(2006, 1, 15)) & (matchdays >= 3)].index[0]
+    ranking_state.process_input_stream(
+        leagues, start, split_day - pd.Timedelta(days=1), seasons=["0506"], elo=elo, store_dir="stream", state_dir="state"
+    )
+    partial = pd.concat([matches[matches["Match Date"] < split_day], league_matches[league_matches["Match Date"] == split_day].iloc[::2]])
+    for refresh_matches in (partial, matches, matches):
+        ranking_state.refresh_ranking(leagues, start, matches=refresh_matches, elo=elo, store_dir="stream", state_dir="state")
+
+    batch, stream = store.load_store("batch"), store.load_store("stream")
+    keys = {
+        "Ranking": ["Teams"],
+        "Matches": ["League", "Match Date", "Home Team"],
+        "Ranking history": ["League", "Match Date", "Position"],
+        "Odds": ["League", "Match Date", "Home Team"],
+    }
+    for table, table_keys in keys.items():
+        expected = sorted_table(batch[table], table_keys)
+        pd.testing.assert_frame_equal(expected, sorted_table(stream[table], table_keys)[expected.columns], check_dtype=False)
+
+# Field code of the odds of a bookmaker for a selection, per market
+ODDS_FIELDS = {"Full time result": "{}{}", "Over/Under 2.5": "{}{}2.5", "Asian handicap": "{}AH{}"}
+
+def test_odds_markets_on_synthetic_matches():
+    matches = synthetic_matches(leagues=1, seasons=1)
+    header_mapping = fetching.header_mapping()
+    column = lambda field: header_mapping.get(field, field)
+    # Missing odds and odds of 1 are not prices
+    matches.loc[0, column("B365H")] = np.nan
+    matches.loc[1, column("B365H")] = 1.0
+    markets = odds_analytics.odds_markets(matches)
+    assert sorted(markets["Full time result"].bookmakers) == sorted(synthetic.RESULT_BOOKMAKERS)
+    assert sorted(markets["Over/Under 2.5"].bookmakers) == sorted(synthetic.TOTAL_BOOKMAKERS)
+    assert sorted(markets["Asian handicap"].bookmakers) == sorted(synthetic.HANDICAP_BOOKMAKERS)
+    for market_name, market in markets.items():
+        _, selections = odds_analytics.MARKET_CODES[market_name]
+        for b, bookmaker in enumerate(market.bookmakers):
+            for code, j in selections.items():
+                expected = matches[column(ODDS_FIELDS[market_name].format(bookmaker, code))].to_numpy(dtype=np.float32)
+                expected[~(expected > 1)] = np.nan
+                np.testing.assert_array_equal(market.odds[:, b, j], expected)
+    assert np.isnan(markets["Full time result"].odds[:2, markets["Full time result"].bookmakers.index("B365"), 0]).all()
+
+    result = markets["Full time result"]
+    prices, bookmakers = odds_analytics.best_prices(result)
+    market_prices = odds_analytics.MAXIMUM_BOOKMAKERS + odds_analytics.AVERAGE_BOOKMAKERS
+    offered = [b for b, name in enumerate(result.bookmakers) if name not in market_prices]
+    np.testing.assert_array_equal(prices, np.nanmax(result.odds[:, offered, :], axis=1))
+    np.testing.assert_array_equal(np.take_along_axis(result.odds, bookmakers[:, None, :], axis=1)[:, 0, :], prices)
+    np.testing.assert_array_equal(odds_analytics.average_prices(result), result.odds[:, result.bookmakers.index("Avg"), :])
+    np.testing.assert_allclose(odds_analytics.consensus_probabilities(result).sum(axis=1), 1, rtol=1e-6)
+
+def test_best_price_offered_by_a_bookmaker():
+    matches = synthetic_matches(leagues=1, seasons=1)
+    header_mapping = fetching.header_mapping()
+    # The market maximum is the highest price of the first match, yet no bookmaker offers it
+    matches.loc[0, header_mapping.get("MaxH", "MaxH")] = 100.0
+    matches.loc[0, header_mapping.get("PSH", "PSH")] = 50.0
+    result = odds_analytics.odds_markets(matches)["Full time result"]
+    prices, bookmakers = odds_analytics.best_prices(result)
+    assert prices[0, 0] == 50.0
+    assert result.bookmakers[bookmakers[0, 0]] == "PS"
+
+def test_backtest_sweep_matches_naive_loop():
+    features = backtest.match_features(synthetic_matches())
+    strategy = backtest.Strategy("Home win", [
+        backtest.parse_rule("Odds >= 1.5:3:0.5"), backtest.parse_rule("Home Team consistency > 0.2,0.5"),
+    ])
+    results = backtest.run_backtest(features, strategy)
+    assert len(results) == 8
+    odds = features["Home win odds"].to_numpy(dtype=np.float32)
+    consistency = features["Home Team consistency"].to_numpy(dtype=np.float32)
+    won = features["Home win won"].to_numpy()
+    for row in results.itertuples(index=False):
+        min_odds, min_consistency = np.float32(row[0]), np.float32(row[1])
+        bets, wins, equity, peak, drawdown = 0, 0, 0.0, 0.0, 0.0
+        for i in range(len(features)):
+            if not (odds[i] >= min_odds and consistency[i] > min_consistency):
+                continue
+            bets += 1
+            wins += bool(won[i])
+            equity += float(np.float32(odds[i] - 1)) if won[i] else -1.0
+            peak = max(peak, equity)
+            drawdown = max(drawdown, peak - equity)
+        assert (row.Bets, row.Wins) == (bets, wins)
+        assert row.Profit == pytest.approx(equity)
+        assert row._5 == pytest.approx(drawdown)
+
+def test_elo_history_without_clubs(workspace):
+    # ClubElo answers an empty file for an unknown club
+    workspace.files["/UnknownClub"] = b""
+    history = fetching.fetch_elo_history(["Unknown Club"], use_cache=False)
+    assert history.empty
+    assert {"Club", "Elo", "From", "To"} <= set(history.columns)
+    assert pd.api.types.is_datetime64_any_dtype(history["From"])
+
+def test_match_elo_is_the_rating_in_force_at_kickoff():
+    history = pd.DataFrame({
+        "Club": ["Arsenal", "Arsenal", "Arsenal", "Wolves"],
+        "From": pd.to_datetime(["2024-08-01", "2024-08-18", "2024-08-25", "2024-08-01"]),
+        "To": pd.to_datetime(["2024-08-17", "2024-08-24", "2024-09-30", "2024-08-10"]),
+        "Elo": [1900.0, 1910.0, 1920.0, 1700.0],
+    })
+    matches = pd.DataFrame({
+        "Match Date": pd.to_datetime(["2024-08-24", "2024-08-17", "2024-08-31"]),
+        "Home Team": pd.Categorical(["Arsenal", "Arsenal", "Wolves"]),
+        "Away Team": pd.Categorical(["Wolves", "Wolves", "Arsenal"]),
+    })
+    fetching.add_match_elo_columns(matches, history)
+    # Later ratings (2024-08-25) are never used for an earlier match
+    assert matches["Home Team Elo"].iloc[:2].tolist() == [1910.0, 1900.0]
+    assert np.isnan(matches["Home Team Elo"].iloc[2])
+    # Wolves rating expired on 2024-08-10 : no Elo rather than an outdated one
+    assert matches["Away Team Elo"].isna().iloc[:2].all()
+    assert matches["Away Team Elo"].iloc[2] == 1920.0
+
+def test_finished_job_published_as_default_store(workspace):
+    job = jobs.submit(["League 00"], datetime(2005, 8, 1), datetime(2006, 6, 1))
+    job.future.result()
+    assert job.status == jobs.DONE, job.error
+    # The default store is a copy of the job outputs, read by the command line and the other pages
+    assert store.store_exists()
+    pd.testing.assert_frame_equal(store.load_table("Matches"), store.load_table("Matches", job.store_dir))
+    assert not pd.read_csv("tmp/team_country_league.csv").empty
+
+def test_warehouse_skips_missing_sources_and_compacts_seasons(workspace):
+    league_01 = workspace.files.pop("/mmz4281/0506/D01.csv")
+    update = warehouse.update_warehouse(["0506", "0607"], warehouse_dir="warehouse")
+    assert update["missing"] == {"0506": ["League 01"], "0607": ["League 00", "League 01", "League 02"]}
+    assert update["ingested"]["0506"] > 0
+    # Matches added to a season are written again with it, as a single part
+    matches = schema.read_matches_csv(league_01).assign(Country="Country 1", League="League 01")
+    fetching.map_fullname_columns(matches)
+    assert warehouse.ingest_matches(matches, "0506", "warehouse") == len(matches)
+    assert len(warehouse.part_files("warehouse")) == 1
+    stored = warehouse.load_matches(warehouse_dir="warehouse")
+    assert len(stored) == update["ingested"]["0506"] + len(matches)
+    assert sorted(stored["League"].unique()) == ["League 00", "League 01", "League 02"]
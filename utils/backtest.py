@@ -0,0 +1,201 @@
+import itertools
+import re
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+import utils.odds_analytics as odds_analytics
+import utils.processed_store as store
+import utils.ranking as ranking
+import utils.ranking_series as ranking_series
+
+# Selection -> matches won by backing it
+OUTCOMES = {
+    "Home win": lambda matches: matches["Full time result"] == "H",
+    "Draw": lambda matches: matches["Full time result"] == "D",
+    "Away win": lambda matches: matches["Full time result"] == "A",
+    "Over 2.5": lambda matches: matches["Full time home team goals"] + matches["Full time away team goals"] > 2.5,
+    "Under 2.5": lambda matches: matches["Full time home team goals"] + matches["Full time away team goals"] < 2.5,
+}
+OPERATORS = {">=": np.greater_equal, "<=": np.less_equal, ">": np.greater, "<": np.less}
+# Features of the backed selection, whatever the selection : "Odds" >= 1.8
+SELECTION_FEATURES = {"Odds": "{selection} odds", "Market probability": "{selection} market probability"}
+ELO_COLUMNS = ["Home Team Elo", "Away Team Elo"]
+# Cells (threshold combinations x matches) evaluated at once : memory does not depend on the size of a sweep
+CHUNK_CELLS = 1_000_000
+# "Odds >= 1.5:3:0.1" (start:stop:step, stop included), "Odds >= 1.5,1.8,2" or "Home Team consistency > 0.5"
+RULE_PATTERN = re.compile(r"^\s*(?P<feature>.+?)\s*(?P<operator>>=|<=|>|<)\s*(?P<values>[-0-9.,:]+)\s*$")
+# Previous matches of a side the pre-match consistency is computed over
+FORM_WINDOW = 6
+
+@dataclass
+class Rule:
+    feature: str
+    operator: str
+    # A single threshold, or several for a parameter sweep
+    thresholds: list[float]
+
+@dataclass
+class Strategy:
+    # Flat stake of 1 on the selection for every match meeting all the rules, at the odds of the features.
+    # Every combination of the rules thresholds is a strategy of the sweep.
+    selection: str
+    rules: list[Rule] = field(default_factory=list)
+
+def parse_rule(rule: str) -> Rule:
+    match = RULE_PATTERN.match(rule)
+    if match is None:
+        raise ValueError(f"Invalid rule {rule!r}, expected e.g. 'Odds >= 1.5:3:0.1' or 'Home Team consistency > 0.5'")
+    values = match["values"]
+    if ":" in values:
+        start, stop, step = (float(value) for value in values.split(":"))
+        thresholds = list(np.round(np.arange(start, stop + step / 2, step), 10))
+    else:
+        thresholds = [float(value) for value in values.split(",")]
+    return Rule(match["feature"], match["operator"], thresholds)
+
+def pre_match_form(matches: pd.DataFrame, form_window: int = FORM_WINDOW) -> pd.DataFrame:
+    # Form of both teams before every match, from their previous matches only : number of matches and points
+    # per match, and consistency over the last form_window matches of the side the team plays on (the rolling
+    # "Consistency (last N) - Home" of the ranking for the home team, "- Away" for the away team)
+    team_matches = ranking.team_matches_table(matches)
+    team_matches["Row"] = np.tile(np.arange(len(matches)), 2)
+    ordered = ranking.sort_team_matches(team_matches)
+    by_team = ordered.groupby("Team", sort=False, observed=True)
+    points = ordered["Result"].map({"Win": 3, "Draw": 1, "Loss": 0}).astype(float)
+    played = by_team.cumcount()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        form = pd.DataFrame({
+            "Row": ordered["Row"],
+            "Side": ordered["Side"],
+            "matches played": played,
+            "points per match": ((points.groupby(ordered["Team"], sort=False, observed=True).cumsum() - points) / played).where(played > 0),
+            "consistency": ranking.previous_consistency(ordered, ["Team", "Side"], form_window),
+        })
+    res = pd.DataFrame(index=np.arange(len(matches)))
+    for side in ("Home", "Away"):
+        side_form = form[form["Side"] == side].set_index("Row").reindex(res.index)
+        for stat in ("matches played", "points per match", "consistency"):
+            res[f"{side} Team {stat}"] = side_form[stat].to_numpy(dtype=np.float32)
+    return res
+
+def match_features(
+        matches: pd.DataFrame, header_mapping: dict[str, str] = None,
+        bookmaker: str = None, best_price: bool = False, form_window: int = FORM_WINDOW
+    ) -> pd.DataFrame:
+    # Everything a rule can use, known before kickoff, one row per match in chronological order.
+    # Bets are settled at the market average odds (Avg), or at the odds of a bookmaker (e.g. B365), or at the best
+    # price of the bookmakers on request : the best price of every match is only known afterwards, and overstates the ROI.
+    matches = matches.sort_values("Match Date", kind="stable", ignore_index=True)
+    features = matches[["Match Date", "League", "Home Team", "Away Team"]].copy()
+    form = pre_match_form(matches, form_window)
+    features = pd.concat([features, form], axis="columns")
+    features["Points per match difference"] = form["Home Team points per match"] - form["Away Team points per match"]
+    features["Previous matches"] = np.minimum(form["Home Team matches played"], form["Away Team matches played"])
+    if set(ELO_COLUMNS) <= set(matches.columns):
+        # Elo at kickoff, processed with the historical Elo option
+        for col in ELO_COLUMNS:
+            features[col] = matches[col].to_numpy(dtype=np.float32)
+        features["Elo difference"] = features["Home Team Elo"] - features["Away Team Elo"]
+    for market in odds_analytics.odds_markets(matches, header_mapping).values():
+        if bookmaker is not None:
+            prices = market.odds[:, market.bookmakers.index(bookmaker), :] if bookmaker in market.bookmakers \
+                else np.full((len(matches), len(market.selections)), np.nan, dtype=np.float32)
+        elif best_price:
+            prices = odds_analytics.best_prices(market)[0]
+        else:
+            prices = odds_analytics.average_prices(market)
+        probabilities = odds_analytics.consensus_probabilities(market)
+        for j, selection in enumerate(market.selections):
+            if selection in OUTCOMES:
+                features[f"{selection} odds"] = prices[:, j]
+                features[f"{selection} market probability"] = probabilities[:, j]
+    for selection, outcome in OUTCOMES.items():
+        features[f"{selection} won"] = outcome(matches).to_numpy()
+    return features
+
+def load_features(
+        store_dir: str = store.STORE_DIR, leagues: list[str] = None,
+        bookmaker: str = None, best_price: bool = False, form_window: int = FORM_WINDOW
+    ) -> pd.DataFrame:
+    # Features of the processed matches of the store, only the columns they need being read
+    available = store.table_columns("Matches", store_dir)
+    columns = list(dict.fromkeys(
+        ranking_series.SERIES_COLUMNS + [col for col in ELO_COLUMNS if col in available]
+        + odds_analytics.source_columns(available)
+    ))
+    matches = store.load_table("Matches", store_dir, columns)
+    if leagues is not None:
+        matches = matches[matches["League"].isin(leagues)]
+    return match_features(matches, bookmaker=bookmaker, best_price=best_price, form_window=form_window)
+
+def feature_values(features: pd.DataFrame, feature: str, selection: str) -> np.ndarray:
+    column = SELECTION_FEATURES.get(feature, feature).format(selection=selection)
+    if column not in features.columns:
+        if "Elo" in column:
+            raise ValueError(f"Unknown feature {feature!r} : the matches have no Elo, process them with the historical Elo option")
+        raise ValueError(f"Unknown feature {feature!r}")
+    return features[column].to_numpy(dtype=np.float32)
+
+def chunk_results(bets: np.ndarray, profit: np.ndarray, won: np.ndarray, offset: float) -> pd.DataFrame:
+    # Results of a chunk of combinations (rows of bets) computed on the bets placed only : every bet of the chunk
+    # in one flat array, each combination shifted by offset so that the running peak restarts with it
+    combinations = len(bets)
+    rows, cols = np.nonzero(bets)
+    counts = np.bincount(rows, minlength=combinations)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    bet_profit = profit[cols].astype(np.float64)
+    cumulative = np.concatenate([[0.0], np.cumsum(bet_profit)])
+    equity = cumulative[1:] - np.repeat(cumulative[starts], counts)
+    shift = np.repeat(np.arange(combinations) * offset, counts)
+    peaks = np.maximum(np.maximum.accumulate(equity + shift) - shift, 0)
+    drawdown = np.zeros(combinations)
+    placed = counts > 0
+    if placed.any():
+        drawdown[placed] = np.maximum.reduceat(peaks - equity, starts[placed])
+    return pd.DataFrame({
+        "Bets": counts,
+        "Wins": np.bincount(rows, weights=won[cols], minlength=combinations).astype(int),
+        "Profit": np.bincount(rows, weights=bet_profit, minlength=combinations),
+        "Max drawdown": drawdown,
+    })
+
+def run_backtest(features: pd.DataFrame, strategy: Strategy) -> pd.DataFrame:
+    # One row per combination of the rules thresholds : bets, hit rate, profit, ROI and maximum drawdown
+    # (in stakes). Rules are evaluated as boolean matrices, a chunk of combinations at a time.
+    if strategy.selection not in OUTCOMES:
+        raise ValueError(f"Unknown selection {strategy.selection!r}, expected one of {list(OUTCOMES)}")
+    odds = feature_values(features, "Odds", strategy.selection)
+    won = features[f"{strategy.selection} won"].to_numpy(dtype=bool)
+    # Matches that cannot be bet (no odds) are left out once, before any combination
+    priced = np.flatnonzero(~np.isnan(odds))
+    odds, won = odds[priced], won[priced]
+    profit = np.where(won, odds - 1, -1).astype(np.float32)
+    # Larger than any equity swing : shifted combinations never share a running peak
+    offset = 2 * float(np.abs(profit).sum()) + 1
+
+    # Per rule : (thresholds, matches) mask, NaN features meeting no rule
+    conditions = [
+        OPERATORS[rule.operator](feature_values(features, rule.feature, strategy.selection)[priced][None, :],
+                                 np.asarray(rule.thresholds, dtype=np.float32)[:, None])
+        for rule in strategy.rules
+    ]
+    combinations = np.array(
+        list(itertools.product(*(range(len(rule.thresholds)) for rule in strategy.rules))), dtype=np.intp
+    ).reshape(-1, len(strategy.rules)) if strategy.rules else np.zeros((1, 0), dtype=np.intp)
+    chunk = max(1, CHUNK_CELLS // max(len(priced), 1))
+    results = []
+    for start in range(0, len(combinations), chunk):
+        indexes = combinations[start:start + chunk]
+        bets = np.ones((len(indexes), len(priced)), dtype=bool)
+        for r, condition in enumerate(conditions):
+            bets &= condition[indexes[:, r]]
+        results.append(chunk_results(bets, profit, won, offset))
+    res = pd.concat(results, ignore_index=True)
+    for r, rule in enumerate(strategy.rules):
+        res.insert(r, f"{rule.feature} {rule.operator}", np.asarray(rule.thresholds)[combinations[:, r]])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        res["Hit rate"] = res["Wins"] / res["Bets"]
+        res["ROI"] = res["Profit"] / res["Bets"]
+    return res
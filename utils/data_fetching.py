@@ -1,136 +1,286 @@
-from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
+import hashlib
+import re
+import threading
+from datetime import datetime, timezone
+from io import BytesIO
 
 import icalendar as ical
-import requests as req
-
 import pandas as pd
 import numpy as np
 
-def fetch_matches_data(league_sources_path: str = "data_mapping/leagues_sources.csv"):
-    leagues_sources = pd.read_csv(league_sources_path)
-    leagues_headers = dict(zip(leagues_sources["League"], leagues_sources["Source"]))
-    leagues_headers = {league_name: pd.read_csv(leagues_headers[league_name], nrows=1) for league_name in leagues_headers}
-    # Get columns of each league
-    leagues_columns = {league_name: list(leagues_headers[league_name].columns) for league_name in leagues_headers}
-    # Convert result as list of sets
-    leagues_columns_list = [set(leagues_columns[league_name]) for league_name in leagues_columns]
-    # Leagues
-    common_columns = list(set.intersection(*leagues_columns_list))
+import utils.http_client as http
+import utils.mapping_registry as registry
+import utils.match_schema as schema
+import utils.team_index as team_index
+import utils.xlsx_writer as xlsx
+
+ELO_API_URL = "http://api.clubelo.com"
+PREDICTION_SHEETS = ["Full time result", "Win or draw", "Over X goals"]
+
+def season_source(source_url: str, season: str) -> str:
+    # Football-Data URLs embed the season code, e.g. ".../mmz4281/2425/E0.csv" for 2024-2025
+    return re.sub(r"/mmz4281/\d{4}/", f"/mmz4281/{season}/", source_url)
+
+def season_code(start_year: int) -> str:
+    return f"{start_year % 100:02d}{(start_year + 1) % 100:02d}"
+
+def season_start_year(season: str, today: datetime = None) -> int:
+    # Inverse of season_code : the latest start year not after the next season ("9900" -> 1999, "0001" -> 2000)
+    current_year = (today or datetime.now()).year
+    start_year = current_year - current_year % 100 + int(season[:2])
+    return start_year - 100 if start_year > current_year + 1 else start_year
+
+def fetch_matches_data(
+        league_sources_path: str = registry.LEAGUES_SOURCES_PATH,
+        max_workers: int = http.DEFAULT_MAX_WORKERS,
+        use_cache: bool = True,
+        season: str = None,
+        columns: list[str] = None,
+        skip_missing: bool = False
+    ):
+    # columns : Football-Data fields to keep (e.g. schema.CORE_FIELDS to leave the odds out), all of them by default.
+    # skip_missing : the leagues without a file (e.g. not covered that season) are left out, instead of an error
+    leagues_sources = registry.leagues_sources(league_sources_path)
+    sources = {
+        league_name: source if season is None else season_source(source, season)
+        for league_name, source in leagues_sources.matches_sources.items()
+    }
+    # Downloading every league file once, concurrently
+    downloads = http.fetch_all(sources, max_workers, source_type="matches", use_cache=use_cache, skip_missing=skip_missing)
+    sources = {league_name: source for league_name, source in sources.items() if downloads[league_name] is not None}
+    if not sources:
+        raise FileNotFoundError(f"No matches file found{'' if season is None else f' for the season {season}'}")
+    leagues_datasets = [
+        schema.read_matches_csv(downloads[league_name].content, columns)
+        for league_name in sources
+    ]
+    # Columns common to every league, computed from the downloaded data
+    leagues_columns_list = [set(df_league.columns) for df_league in leagues_datasets]
+    common_columns_set = set.intersection(*leagues_columns_list)
+    common_columns = [col for col in leagues_datasets[0].columns if col in common_columns_set]
 
     selected_columns = common_columns + ["Country", "League"]
-    global_dataset = pd.DataFrame()
-    for i in range(len(leagues_sources)):
-        df_current_league = pd.read_csv(leagues_sources["Source"].loc[i], parse_dates=["Date"], dayfirst=True)
-        df_current_league["Country"] = leagues_sources["Country"].loc[i]
-        df_current_league["League"] = leagues_sources["League"].loc[i]
-        global_dataset = pd.concat([global_dataset, df_current_league[selected_columns]], axis=0)
-    return global_dataset
-
-def fetch_elo_data():
-    now = datetime.now().strftime("%Y-%m-%d")
-    return pd.read_csv(f"http://api.clubelo.com/{now}", parse_dates=["From", "To"])
-
-
-def add_country_column(elo: pd.DataFrame, matches: pd.DataFrame):
-    home_team_countries = matches[["Home Team", "Country"]]
-    away_team_countries = matches[["Away Team", "Country"]]
-    home_team_countries = home_team_countries.rename({"Home Team": "Team"}, axis=1)
-    away_team_countries = away_team_countries.rename({"Away Team": "Team"}, axis=1)
-    all_teams_countries = pd.concat([home_team_countries, away_team_countries], axis=0, ignore_index=True)
-    all_teams_countries.drop_duplicates(inplace=True)
-    teams_countries_mapping = dict(zip(all_teams_countries["Team"], all_teams_countries["Country"]))
-    def map_country_to_team(row):
-        if row["Club"] in teams_countries_mapping:
-            return teams_countries_mapping[row["Club"]]
-        return row["Country Alias"]
+    for i, league_name in enumerate(sources):
+        leagues_datasets[i]["Country"] = leagues_sources.countries[league_name]
+        leagues_datasets[i]["League"] = league_name
+        leagues_datasets[i] = leagues_datasets[i][selected_columns]
+    return schema.categorize_names(pd.concat(leagues_datasets, axis=0))
+
+def stream_matches_data(
+        leagues: list[str] = None,
+        from_date: datetime = None, to_date: datetime = None,
+        seasons: list[str] = None,
+        league_sources_path: str = registry.LEAGUES_SOURCES_PATH,
+        chunksize: int = 10_000,
+        use_cache: bool = True,
+        columns: list[str] = None
+    ):
+    # Matches with fullname columns, yielded one chunk at a time : only one league file is held in memory.
+    # Leagues are filtered before any download, dates while reading.
+    # seasons : season codes, oldest first (e.g. ["2223", "2324"]), the sources season by default
+    leagues_sources = registry.leagues_sources(league_sources_path).table
+    if leagues is not None:
+        leagues_sources = leagues_sources[leagues_sources["League"].isin(leagues)]
+    mapping = header_mapping()
+    for season in seasons or [None]:
+        for league, country, source in zip(leagues_sources["League"], leagues_sources["Country"], leagues_sources["Source"]):
+            url = source if season is None else season_source(source, season)
+            content = http.fetch_url(url, source_type="matches", use_cache=use_cache).content
+            for chunk in schema.read_matches_chunks(content, columns, chunksize):
+                if from_date is not None:
+                    chunk = chunk[chunk["Date"] >= from_date]
+                if to_date is not None:
+                    chunk = chunk[chunk["Date"] <= to_date]
+                if chunk.empty:
+                    continue
+                chunk = chunk.assign(Country=country, League=league)
+                yield chunk.rename(columns=mapping)
+
+def header_mapping(header_dictionary_path: str = registry.HEADER_DICTIONARY_PATH) -> dict[str, str]:
+    return registry.header_mapping(header_dictionary_path)
+
+def map_fullname_columns(matches_dataset: pd.DataFrame):
+    matches_dataset.rename(columns=header_mapping(), inplace=True)
+
+def empty_elo() -> pd.DataFrame:
+    # Ratings table without rows, with the columns of the ClubElo files
+    return pd.DataFrame({
+        "Rank": pd.Series(dtype=float), "Club": pd.Series(dtype=object), "Country": pd.Series(dtype=object),
+        "Level": pd.Series(dtype=float), "Elo": pd.Series(dtype=float),
+        "From": pd.Series(dtype="datetime64[ns]"), "To": pd.Series(dtype="datetime64[ns]"),
+    })
+
+def fetch_elo_data(use_cache: bool = True, date: datetime = None):
+    day = (date or datetime.now()).strftime("%Y-%m-%d")
+    elo_content = http.fetch_url(f"{ELO_API_URL}/{day}", source_type="elo", use_cache=use_cache).content
+    return pd.read_csv(BytesIO(elo_content), parse_dates=["From", "To"])
+
+def fetch_elo_history(clubs: list[str], max_workers: int = http.DEFAULT_MAX_WORKERS, use_cache: bool = True):
+    # Whole rating history of each club, one ClubElo request per club (ClubElo names, without spaces)
+    urls = {club: f"{ELO_API_URL}/{club.replace(' ', '')}" for club in clubs}
+    downloads = http.fetch_all(urls, max_workers, source_type="elo", use_cache=use_cache)
+    histories = [
+        pd.read_csv(BytesIO(downloads[club].content), parse_dates=["From", "To"])
+        for club in clubs if downloads[club].content.strip()
+    ]
+    if not histories:
+        # No club found by ClubElo : no ratings, with the columns of a history
+        return empty_elo()
+    return pd.concat(histories, axis=0, ignore_index=True)
+
+def add_country_column(elo: pd.DataFrame, teams_attributes: pd.DataFrame):
     elo.rename({"Country": "Country Alias"}, axis=1, inplace=True)
-    elo["Country"] = elo.apply(map_country_to_team, axis=1)
-
-def add_league_column(elo: pd.DataFrame, matches: pd.DataFrame):
-    home_team_leagues = matches[["Home Team", "League"]]
-    away_team_leagues = matches[["Away Team", "League"]]
-    home_team_leagues = home_team_leagues.rename({"Home Team": "Team"}, axis=1)
-    away_team_leagues = away_team_leagues.rename({"Away Team": "Team"}, axis=1)
-    all_teams_leagues = pd.concat([home_team_leagues, away_team_leagues], axis=0, ignore_index=True)
-    all_teams_leagues.drop_duplicates(inplace=True)
-    teams_leagues_mapping = dict(zip(all_teams_leagues["Team"], all_teams_leagues["League"]))
-    def map_league_to_team(row):
-        if row["Club"] in teams_leagues_mapping:
-            return teams_leagues_mapping[row["Club"]]
-        return row["Level"]
-    elo["League"] = elo.apply(map_league_to_team, axis=1)
-
-def pre_process_elo_data(elo: pd.DataFrame, matches: pd.DataFrame,
-        team_elo_matches_mapping_path: str = "data_mapping/team_elo_matches_mapping.csv"):
-    datasets_mapping = pd.read_csv(team_elo_matches_mapping_path)
-    datasets_mapping.replace({np.nan: None}, inplace=True)
-    
-    # Update elo team names that are different, looking at the matches dataset
-    elo_global_teams_mapping = dict(zip(
-        datasets_mapping["Elo team name"],
-        datasets_mapping["Global team name"])
-    )
-    elo.replace(elo_global_teams_mapping, inplace=True)
-
-    # Adding country column to elo dataset
-    add_country_column(elo, matches)
-    add_league_column(elo, matches)
+    # Clubs that are not in the matches dataset keep the ClubElo country code
+    elo["Country"] = elo["Club"].map(teams_attributes["Country"]).astype(object).fillna(elo["Country Alias"])
+
+def add_league_column(elo: pd.DataFrame, teams_attributes: pd.DataFrame):
+    # Clubs that are not in the matches dataset keep the ClubElo level
+    elo["League"] = elo["Club"].map(teams_attributes["League"]).astype(object).fillna(elo["Level"])
+
+def latest_elo_index(elo: pd.DataFrame) -> pd.Series:
+    # Club -> most recent Elo rating, built once for every lookup
+    latest = elo.sort_values("From", kind="stable").drop_duplicates("Club", keep="last")
+    return pd.Series(latest["Elo"].to_numpy(), index=latest["Club"].astype(object).to_numpy())
+
+def elo_club_names(teams: list[str], team_elo_matches_mapping_path: str = team_index.MAPPING_PATH) -> list[str]:
+    # ClubElo names of teams named as in the matches dataset
+    return team_index.load_index(mapping_path=team_elo_matches_mapping_path).source_names(teams, "elo")
+
+def add_match_elo_columns(matches: pd.DataFrame, elo_history: pd.DataFrame):
+    # Elo of both teams at kickoff, with an as-of join on the rating validity period
+    history = elo_history[["Club", "From", "To", "Elo"]].dropna(subset=["From"])
+    history = history.astype({"Club": str}).sort_values("From", kind="stable")
+    for side in ("Home", "Away"):
+        kickoffs = pd.DataFrame({
+            "Row": np.arange(len(matches)),
+            "Club": matches[f"{side} Team"].astype(str).to_numpy(),
+            "Match Date": matches["Match Date"].to_numpy(),
+        }).sort_values("Match Date", kind="stable")
+        ratings = pd.merge_asof(kickoffs, history, left_on="Match Date", right_on="From", by="Club", direction="backward")
+        ratings = ratings[ratings["Match Date"] <= ratings["To"]]
+        elo_values = np.full(len(matches), np.nan)
+        elo_values[ratings["Row"].to_numpy()] = ratings["Elo"].to_numpy()
+        matches[f"{side} Team Elo"] = elo_values
+
+def pre_process_elo_data(elo: pd.DataFrame, team_country_league: pd.DataFrame,
+        team_elo_matches_mapping_path: str = team_index.MAPPING_PATH):
+    # team_country_league : teams of the matches with their country and league (team_index.teams_table)
+    index = team_index.load_index(mapping_path=team_elo_matches_mapping_path)
+    index.add_teams(team_country_league)
+    # Update elo team names that are different from the matches dataset ones, in the club column only,
+    # unknown names being searched among the teams of their country. Only the clubs of the countries of the
+    # leagues are looked up : the others can be no team of the matches.
+    elo_countries = registry.leagues_sources().elo_countries
+    countries = elo["Country"].astype(object).map(elo_countries)
+    in_leagues = countries.isin(team_country_league["Country"].astype(object).unique()).to_numpy()
+    elo["Club"] = elo["Club"].astype(object)
+    elo.loc[in_leagues, "Club"] = index.resolve(elo.loc[in_leagues, "Club"], "elo", countries=countries[in_leagues])
+    index.save()
+
+    # Adding country and league columns to elo dataset
+    attributes = team_index.teams_attributes(team_country_league)
+    add_country_column(elo, attributes)
+    add_league_column(elo, attributes)
+
+# League -> (hash of the feed the table was parsed from, fixtures sorted by kickoff)
+_fixtures_tables: dict[str, tuple[str, pd.DataFrame]] = {}
+_fixtures_lock = threading.Lock()
+
+def event_kickoff(event: ical.Event) -> datetime | None:
+    # Kickoff of an event in UTC : icalendar resolves the TZID (quoted, Windows names, VTIMEZONE),
+    # floating times and unknown zones are read as UTC, whole days start at midnight
+    try:
+        start = event.decoded("DTSTART")
+    except (KeyError, ValueError):
+        return None
+    if not isinstance(start, datetime):
+        start = datetime.combine(start, datetime.min.time())
+    return start.replace(tzinfo=timezone.utc) if start.tzinfo is None else start.astimezone(timezone.utc)
+
+def parse_league_fixtures(calendar_content: bytes | str) -> pd.DataFrame:
+    calendar = ical.Calendar.from_ical(calendar_content)
+    fixtures = {"Match Date": [], "Home Team": [], "Away Team": []}
+    for event in calendar.walk("VEVENT"):
+        kickoff = event_kickoff(event)
+        home_team, separator, away_team = str(event.get("SUMMARY", "")).partition(" v ")
+        # Events that are not a match (no kickoff, no " v " between the teams) are left out
+        if kickoff is not None and separator:
+            fixtures["Match Date"].append(kickoff)
+            fixtures["Home Team"].append(home_team.strip())
+            fixtures["Away Team"].append(away_team.strip())
+    fixtures["Match Date"] = pd.to_datetime(pd.Series(fixtures["Match Date"], dtype=object), utc=True)
+    return pd.DataFrame(fixtures).astype({"Home Team": object, "Away Team": object})
 
 def get_league_fixtures(league_calendar_url: str):
-    calendar_str = req.get(league_calendar_url).text
-    calendar_obj = ical.Calendar.from_ical(calendar_str)
-    fixtures_dict = {
-        "Match Date": [],
-        "Home Team": [],
-        "Away Team": []
-    }
-    for event in calendar_obj.events:
-        fixtures_dict["Match Date"].append(event.decoded("DTSTART"))
-        home_team, away_team = event["SUMMARY"].split(" v ")
-        fixtures_dict["Home Team"].append(home_team)
-        fixtures_dict["Away Team"].append(away_team)
-    return pd.DataFrame(fixtures_dict)
-
-def process_fixtures_data(league_name: str, fixtures_df: pd.DataFrame, assigned_timezone: str):
-    today_dt = datetime.today().replace(tzinfo=timezone.utc)
-    # Picking monday of the current week
-    current_monday = today_dt - timedelta(days=today_dt.weekday())
-    # Picking sunday of the current week
-    current_sunday = current_monday + timedelta(days=7)
-    # Applying dates filters
-    current_week_fixtures = fixtures_df[fixtures_df["Match Date"].between(current_monday, current_sunday)].copy()
-    # Getting match date time according to locale timezone
-    current_week_fixtures["Match Date (locale)"] = current_week_fixtures["Match Date"].map(lambda x: x.astimezone(ZoneInfo(assigned_timezone)).replace(tzinfo=None))
-    # Adding blank columns to be filled by the user
+    return parse_league_fixtures(http.fetch_url(league_calendar_url, source_type="fixtures").content)
+
+def league_fixtures_table(league_name: str, calendar_content: bytes) -> pd.DataFrame:
+    # Each feed is parsed once : the sorted table is reused until the feed content changes
+    key = hashlib.sha256(calendar_content).hexdigest()
+    with _fixtures_lock:
+        cached = _fixtures_tables.get(league_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    table = parse_league_fixtures(calendar_content).sort_values("Match Date", kind="stable", ignore_index=True)
+    table["League"] = league_name
+    # Feed team names resolved to the matches dataset ones, among the teams of the league
+    index = team_index.load_index()
+    for col in ("Home Team", "Away Team"):
+        table[col] = index.resolve(table[col], "fixtures", [league_name])
+    index.save()
+    with _fixtures_lock:
+        _fixtures_tables[league_name] = (key, table)
+    return table
+
+def fixtures_sources(league_sources_path: str = registry.LEAGUES_SOURCES_PATH) -> dict[str, str]:
+    return dict(registry.leagues_sources(league_sources_path).fixtures_sources)
+
+def get_fixtures_tables(sources: dict[str, str] = None) -> dict[str, pd.DataFrame]:
+    # Fixtures of the season of every league, the feeds being downloaded concurrently
+    sources = sources or fixtures_sources()
+    calendars = http.fetch_all(sources, source_type="fixtures")
+    return {league: league_fixtures_table(league, calendars[league].content) for league in sources}
+
+def week_bounds(assigned_timezone: str, day: datetime = None) -> tuple[pd.Timestamp, pd.Timestamp]:
+    # Monday 00:00 to the next Monday 00:00, in the chosen timezone
+    day = pd.Timestamp(day or datetime.now(timezone.utc))
+    day = day.tz_localize(assigned_timezone) if day.tzinfo is None else day.tz_convert(assigned_timezone)
+    monday = day.normalize() - pd.Timedelta(days=day.weekday())
+    return monday, monday + pd.Timedelta(days=7)
+
+def fixtures_window(
+        fixtures_tables: dict[str, pd.DataFrame], start: datetime, end: datetime, assigned_timezone: str
+    ) -> pd.DataFrame:
+    # Fixtures kicking off in [start, end), sliced by binary search in every sorted league table
+    windows = []
+    for table in fixtures_tables.values():
+        lower, upper = table["Match Date"].searchsorted([pd.Timestamp(start), pd.Timestamp(end)])
+        windows.append(table.iloc[lower:upper])
     blank_columns = ["Bet prediction", "Bet odd", "Confidence", "Result"]
-    for col in blank_columns:   
-        current_week_fixtures[col] = pd.Series()
-    # Adding a "league" column
-    current_week_fixtures["League"] = league_name
-    # Reordering columns
     order = ["Match Date (locale)", "League", "Home Team", "Away Team"] + blank_columns
-    current_week_fixtures_reord = current_week_fixtures[order]
-    current_week_fixtures_reord
-    return current_week_fixtures_reord
+    if not windows:
+        return pd.DataFrame(columns=order)
+    fixtures = pd.concat(windows, axis=0, ignore_index=True)
+    # Kickoff in the chosen timezone, converted for the whole column at once
+    fixtures["Match Date (locale)"] = fixtures["Match Date"].dt.tz_convert(assigned_timezone).dt.tz_localize(None)
+    # Adding blank columns to be filled by the user
+    for col in blank_columns:
+        fixtures[col] = None
+    return fixtures[order].sort_values(["League", "Match Date (locale)"], kind="stable")
+
+def get_week_fixtures(assigned_timezone: str, day: datetime = None, sources: dict[str, str] = None) -> pd.DataFrame:
+    start, end = week_bounds(assigned_timezone, day)
+    return fixtures_window(get_fixtures_tables(sources), start, end, assigned_timezone)
 
 def get_current_week_fixtures(assigned_timezone: str):
-    # Getting all sources
-    fixtures_sources_df = pd.read_csv("data_mapping/leagues_sources.csv")
-    # Filtering available sources
-    fixtures_sources_df = fixtures_sources_df[fixtures_sources_df["Fixtures Source"].notna()]
-    # Dictionary from league and sources
-    fixtures_sources_dict = dict(zip(fixtures_sources_df["League"], fixtures_sources_df["Fixtures Source"]))
-    # Generating a whole dataframe for all fixtures
-    all_fixtures_df = pd.DataFrame()
-    for league in fixtures_sources_dict:
-        league_fixtures = get_league_fixtures(fixtures_sources_dict[league])
-        processed_fixtures = process_fixtures_data(league, league_fixtures, assigned_timezone)
-        all_fixtures_df = pd.concat([all_fixtures_df, processed_fixtures], axis=0)
-    return all_fixtures_df.sort_values(["League", "Match Date (locale)"])
-
-def save_fixtures_as_sheets(current_week_all_fixtures: pd.DataFrame, prediction_sheets_path: str):
-    with pd.ExcelWriter(prediction_sheets_path, mode='w') as pred_writer:
-        current_week_all_fixtures.to_excel(pred_writer, sheet_name="Full time result", index=False)
-        current_week_all_fixtures.to_excel(pred_writer, sheet_name="Win or draw", index=False)
-        current_week_all_fixtures.to_excel(pred_writer, sheet_name="Over X goals", index=False)
\ No newline at end of file
+    return get_week_fixtures(assigned_timezone)
+
+def save_fixtures_as_sheets(
+        current_week_all_fixtures: pd.DataFrame, prediction_sheets_path: str | BytesIO,
+        sheets: dict[str, pd.DataFrame] = None
+    ):
+    # Sheets pre-filled by the prediction models if given, otherwise the three sheets share
+    # the same blank fixtures : they are rendered once
+    xlsx.write_workbook(prediction_sheets_path, sheets or {
+        sheet_name: current_week_all_fixtures for sheet_name in PREDICTION_SHEETS
+    })
\ No newline at end of file
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_DIR = "tmp/http_cache"
+# Seconds during which a cached response is served without contacting the source
+CACHE_TTL = {
+    "matches": 6 * 3600,
+    "elo": 24 * 3600,
+    "fixtures": 6 * 3600,
+    "default": 3600,
+}
+CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+_lock = threading.Lock()
+
+def cache_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+def cache_paths(url: str, cache_dir: str = None) -> tuple[str, str]:
+    cache_dir = cache_dir or CACHE_DIR
+    key = cache_key(url)
+    return os.path.join(cache_dir, f"{key}.body"), os.path.join(cache_dir, f"{key}.json")
+
+def ttl_for(source_type: str) -> float:
+    return CACHE_TTL.get(source_type, CACHE_TTL["default"])
+
+def load_entry(url: str, cache_dir: str = None) -> tuple[dict, bytes] | None:
+    body_path, meta_path = cache_paths(url, cache_dir)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            content = f.read()
+        # Access time drives the least-recently-used eviction
+        os.utime(body_path)
+    except (OSError, ValueError):
+        return None
+    return meta, content
+
+def is_fresh(meta: dict, source_type: str) -> bool:
+    return time.time() - meta["fetched_at"] < ttl_for(source_type)
+
+def validation_headers(meta: dict) -> dict[str, str]:
+    # Headers turning the next request into a conditional GET
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def store_entry(
+        url: str, content: bytes, etag: str = None, last_modified: str = None,
+        cache_dir: str = None, max_bytes: int = None
+    ):
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    body_path, meta_path = cache_paths(url, cache_dir)
+    meta = {"url": url, "etag": etag, "last_modified": last_modified, "fetched_at": time.time()}
+    with _lock:
+        _write_atomic(body_path, content)
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        evict(cache_dir, max_bytes)
+
+def touch_entry(url: str, cache_dir: str = None):
+    # Source confirmed that nothing changed : restarting the TTL of the cached response
+    loaded = load_entry(url, cache_dir)
+    if loaded is None:
+        return
+    meta, _ = loaded
+    meta["fetched_at"] = time.time()
+    _, meta_path = cache_paths(url, cache_dir)
+    with _lock:
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+def evict(cache_dir: str = None, max_bytes: int = None):
+    # Removing least recently used responses until the cache fits in max_bytes
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if not os.path.isdir(cache_dir):
+        return
+    bodies = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".body"):
+            stat = entry.stat()
+            bodies.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in bodies)
+    for _, size, body_path in sorted(bodies):
+        if total <= max_bytes:
+            break
+        for path in (body_path, body_path[:-len(".body")] + ".json"):
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+
+def clear(cache_dir: str = None):
+    evict(cache_dir, 0)
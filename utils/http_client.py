@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import utils.http_cache as cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+
+@dataclass
+class FetchResult:
+    url: str
+    content: bytes
+    elapsed: float
+    from_cache: bool = False
+
+def create_session(pool_size: int = DEFAULT_MAX_WORKERS, retries: int = DEFAULT_RETRIES) -> req.Session:
+    # Retrying on connection errors and transient server errors, with an exponential backoff
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = req.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+_shared_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> req.Session:
+    # One pooled session shared by every fetch of the process, created once even when the first fetches are concurrent
+    global _shared_session
+    with _session_lock:
+        if _shared_session is None:
+            _shared_session = create_session()
+        return _shared_session
+
+def fetch_url(
+        url: str, session: req.Session = None, timeout: float = DEFAULT_TIMEOUT,
+        source_type: str = "default", use_cache: bool = True
+    ) -> FetchResult:
+    session = session or get_session()
+    start = time.perf_counter()
+    cached = cache.load_entry(url) if use_cache else None
+    if cached is not None and cache.is_fresh(cached[0], source_type):
+        logger.info("Served %s from cache", url)
+        return FetchResult(url, cached[1], time.perf_counter() - start, from_cache=True)
+
+    headers = cache.validation_headers(cached[0]) if cached is not None else {}
+    response = session.get(url, timeout=timeout, headers=headers)
+    if cached is not None and response.status_code == 304:
+        # Nothing changed upstream : reusing the cached bytes
+        cache.touch_entry(url)
+        elapsed = time.perf_counter() - start
+        logger.info("Revalidated %s in %.2fs", url, elapsed)
+        return FetchResult(url, cached[1], elapsed, from_cache=True)
+    response.raise_for_status()
+    if use_cache:
+        cache.store_entry(url, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    elapsed = time.perf_counter() - start
+    logger.info("Fetched %s (%d bytes) in %.2fs", url, len(response.content), elapsed)
+    return FetchResult(url, response.content, elapsed)
+
+def fetch_or_none(
+        url: str, session: req.Session = None, timeout: float = DEFAULT_TIMEOUT,
+        source_type: str = "default", use_cache: bool = True
+    ) -> FetchResult | None:
+    # None for a source that does not exist (404), instead of an error
+    try:
+        return fetch_url(url, session, timeout, source_type, use_cache)
+    except req.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        logger.warning("Missing source %s", url)
+        return None
+
+def fetch_all(
+        urls: dict[str, str], max_workers: int = DEFAULT_MAX_WORKERS,
+        session: req.Session = None, timeout: float = DEFAULT_TIMEOUT,
+        source_type: str = "default", use_cache: bool = True, skip_missing: bool = False
+    ) -> dict[str, FetchResult | None]:
+    # Downloading every source once, concurrently, with a bounded number of workers.
+    # skip_missing : the sources that do not exist are None, instead of failing the whole download
+    session = session or get_session()
+    fetch = fetch_or_none if skip_missing else fetch_url
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as executor:
+        futures = {
+            key: executor.submit(fetch, url, session, timeout, source_type, use_cache)
+            for key, url in urls.items()
+        }
+        return {key: futures[key].result() for key in futures}
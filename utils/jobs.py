@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import utils.http_cache as http_cache
+import utils.processed_store as store
+import utils.profiling as profiling
+import utils.ranking as ranking
+
+JOBS_DIR = "tmp/jobs"
+MAX_RUNNING_JOBS = 2
+# A finished job is shared while its matches could only come from the same cached downloads
+RESULT_TTL = http_cache.CACHE_TTL["matches"]
+MAX_KEPT_JOBS = 20
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+class JobCancelled(Exception):
+    pass
+
+@dataclass
+class Job:
+    id: str
+    leagues: list[str]
+    from_date: datetime
+    to_date: datetime
+    # Elo of both teams at kickoff added to the matches
+    historical_elo: bool = False
+    # Run options that do not change the outputs, and thus are not part of the job id
+    workers: int = 1
+    track_memory: bool = False
+    profile: bool = False
+    status: str = QUEUED
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: float = None
+    error: str = None
+    report: profiling.RunReport = None
+    # JSON run report saved in the output directory
+    report_path: str = None
+    cancel_requested: threading.Event = field(default_factory=threading.Event, repr=False)
+    future: Future = field(default=None, repr=False)
+
+    @property
+    def output_dir(self) -> str:
+        return os.path.join(JOBS_DIR, self.id)
+
+    @property
+    def store_dir(self) -> str:
+        return os.path.join(self.output_dir, "process_result")
+
+    def excel_path(self, include_odds: bool = False) -> str:
+        return os.path.join(self.output_dir, "process_result_odds.xlsx" if include_odds else "process_result.xlsx")
+
+    def is_active(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    def is_reusable(self) -> bool:
+        if self.is_active():
+            return True
+        return self.status == DONE and time.time() - self.finished_at < RESULT_TTL
+
+# Job id -> job, in submission order
+_jobs: dict[str, Job] = {}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS, thread_name_prefix="process-job")
+# Publications of finished jobs outputs as the default store, one at a time
+_publish_lock = threading.Lock()
+
+def job_id(leagues: list[str], from_date: datetime, to_date: datetime, historical_elo: bool = False) -> str:
+    # Identical requests (same leagues, whatever their order, same dates and options) share the same id
+    request = {"leagues": sorted(leagues), "from": from_date.isoformat(), "to": to_date.isoformat()}
+    if historical_elo:
+        request["historical_elo"] = True
+    return hashlib.sha256(json.dumps(request).encode("utf-8")).hexdigest()[:16]
+
+def run_job(job: Job):
+    if job.cancel_requested.is_set():
+        job.status = CANCELLED
+        job.finished_at = time.time()
+        return
+
+    def check_cancel(_):
+        # Cancellation takes effect between two stages of the process
+        if job.cancel_requested.is_set():
+            raise JobCancelled()
+
+    job.status = RUNNING
+    job.report = profiling.RunReport(
+        name=f"job_{job.id}", track_memory=job.track_memory, profile=job.profile, on_stage_end=check_cancel
+    )
+    try:
+        # Outputs of a previous run of the same request are replaced
+        shutil.rmtree(job.output_dir, ignore_errors=True)
+        ranking.process_input_data(
+            job.leagues, job.from_date, job.to_date,
+            store_dir=job.store_dir, historical_elo=job.historical_elo, report=job.report, workers=job.workers
+        )
+        job.report_path = job.report.save(job.output_dir)
+        # The outputs of the latest finished job are the default store of the other pages and of the command line
+        with _publish_lock:
+            store.publish_store(job.store_dir)
+        job.status = DONE
+    except JobCancelled:
+        job.status = CANCELLED
+    except Exception as e:
+        job.error = f"{type(e).__name__}: {e}"
+        job.status = FAILED
+    finally:
+        job.finished_at = time.time()
+
+def submit(
+        leagues: list[str], from_date: datetime, to_date: datetime,
+        historical_elo: bool = False, workers: int = 1, track_memory: bool = False, profile: bool = False
+    ) -> Job:
+    # Queued, running or recently finished identical requests are returned instead of starting a new one
+    key = job_id(leagues, from_date, to_date, historical_elo)
+    with _lock:
+        job = _jobs.get(key)
+        if job is not None and job.is_reusable():
+            return job
+        job = Job(key, list(leagues), from_date, to_date, historical_elo, workers, track_memory, profile)
+        _jobs.pop(key, None)
+        _jobs[key] = job
+        job.future = _executor.submit(run_job, job)
+        forget_old_jobs()
+        return job
+
+def get(key: str) -> Job | None:
+    with _lock:
+        return _jobs.get(key)
+
+def list_jobs() -> list[Job]:
+    with _lock:
+        return list(_jobs.values())
+
+def cancel(key: str) -> bool:
+    with _lock:
+        job = _jobs.get(key)
+        if job is None or not job.is_active():
+            return False
+        job.cancel_requested.set()
+        # A queued job never starts, a running one stops at the end of its current stage
+        if job.future.cancel():
+            job.status = CANCELLED
+            job.finished_at = time.time()
+        return True
+
+def forget_old_jobs():
+    # Oldest finished jobs and their outputs are removed beyond MAX_KEPT_JOBS
+    finished = [job for job in _jobs.values() if not job.is_active()]
+    for job in finished[:max(0, len(_jobs) - MAX_KEPT_JOBS)]:
+        del _jobs[job.id]
+        shutil.rmtree(job.output_dir, ignore_errors=True)
+
+def export_excel(job: Job, include_odds: bool = False) -> str:
+    # Workbook of the job outputs, built once (with and without the odds)
+    path = job.excel_path(include_odds)
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp.xlsx"
+        store.export_store_to_excel(tmp_path, job.store_dir, include_odds=include_odds)
+        os.replace(tmp_path, path)
+    return path
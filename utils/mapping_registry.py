@@ -0,0 +1,113 @@
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+import pandas as pd
+
+HEADER_DICTIONARY_PATH = "data_mapping/header_dictionary.csv"
+LEAGUES_SOURCES_PATH = "data_mapping/leagues_sources.csv"
+TEAM_MAPPING_PATH = "data_mapping/team_elo_matches_mapping.csv"
+LEAGUES_IMAGES_PATH = "data_mapping/leagues_countries_images.csv"
+PBI_TEMPLATE_PATH = "dataviz/pbi_template.pbit"
+# Source -> column of the team mapping file with the names used by that source
+TEAM_SOURCE_COLUMNS = {"elo": "Elo team name", "fixtures": "Fixtures team name"}
+
+@dataclass(frozen=True)
+class LeaguesSources:
+    # leagues_sources.csv, with the lookups the pipelines need.
+    # Shared by every caller : not to be modified.
+    table: pd.DataFrame
+    leagues: list[str]
+    # League -> country, matches CSV of the current season, fixtures calendar (leagues having one)
+    countries: dict[str, str]
+    matches_sources: dict[str, str]
+    fixtures_sources: dict[str, str]
+    # ClubElo country code -> country of the leagues
+    elo_countries: dict[str, str]
+
+@dataclass
+class LoadedFile:
+    # Parsed content of a file, and the (modification time, size) it has been parsed at
+    signature: tuple[int, int] | None
+    value: object
+
+# (absolute path, parser) -> parsed file, shared by every session and pipeline of the process
+_files: dict[tuple[str, Callable], LoadedFile] = {}
+_lock = threading.Lock()
+
+def file_signature(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def load(path: str, parser: Callable[[str], object]):
+    # A file is parsed again only when it has been edited since its last parse (one stat call otherwise)
+    key = (os.path.abspath(path), parser)
+    signature = file_signature(key[0])
+    with _lock:
+        loaded = _files.get(key)
+        if loaded is not None and loaded.signature == signature:
+            return loaded.value
+    if signature is None:
+        raise FileNotFoundError(path)
+    value = parser(key[0])
+    with _lock:
+        _files[key] = LoadedFile(signature, value)
+    return value
+
+def parse_header_dictionary(path: str) -> dict[str, str]:
+    header_dictionary = pd.read_csv(path)
+    return dict(zip(header_dictionary["Field"], header_dictionary["Fullname"]))
+
+def parse_leagues_sources(path: str) -> LeaguesSources:
+    table = pd.read_csv(path)
+    fixtures = table.reindex(columns=["League", "Fixtures Source"]).dropna()
+    elo_countries = table.reindex(columns=["Elo Country", "Country"]).dropna()
+    return LeaguesSources(
+        table=table,
+        leagues=list(table["League"]),
+        countries=dict(zip(table["League"], table["Country"])),
+        matches_sources=dict(zip(table["League"], table["Source"])),
+        fixtures_sources=dict(zip(fixtures["League"], fixtures["Fixtures Source"])),
+        elo_countries=dict(zip(elo_countries["Elo Country"], elo_countries["Country"])),
+    )
+
+def parse_team_aliases(path: str) -> dict[str, dict[str, str]]:
+    mapping = pd.read_csv(path)
+    return {
+        source: dict(mapping[[column, "Global team name"]].dropna().itertuples(index=False))
+        for source, column in TEAM_SOURCE_COLUMNS.items() if column in mapping.columns
+    }
+
+def parse_leagues_images(path: str) -> pd.DataFrame:
+    images = pd.read_csv(path, sep=";")
+    images["Flag Filepaths"] = images["Flag Filename"].map(lambda filename: f"img\\countries\\{filename}")
+    images["Division Filepaths"] = images["Division Filename"].map(lambda filename: f"img\\divisions\\{filename}")
+    return images
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def header_mapping(path: str = HEADER_DICTIONARY_PATH) -> dict[str, str]:
+    # Football-Data.co.uk field -> full column name
+    return load(path, parse_header_dictionary)
+
+def leagues_sources(path: str = LEAGUES_SOURCES_PATH) -> LeaguesSources:
+    return load(path, parse_leagues_sources)
+
+def team_aliases(path: str = TEAM_MAPPING_PATH) -> dict[str, dict[str, str]]:
+    # Source -> source team name -> team name of the matches dataset, no aliases without a mapping file
+    if file_signature(path) is None:
+        return {}
+    return load(path, parse_team_aliases)
+
+def leagues_images(path: str = LEAGUES_IMAGES_PATH) -> pd.DataFrame:
+    # League, country, and the paths of their images
+    return load(path, parse_leagues_images)
+
+def file_bytes(path: str) -> bytes:
+    return load(path, read_bytes)
@@ -0,0 +1,73 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+# Football-Data.co.uk fields, see data_mapping/header_dictionary.csv
+CATEGORY_FIELDS = ["Div", "HomeTeam", "AwayTeam", "FTR", "HTR", "Referee", "Time", "Country", "League"]
+INTEGER_FIELDS = [
+    "FTHG", "FTAG", "HTHG", "HTAG",
+    "HS", "AS", "HST", "AST", "HHW", "AHW", "HC", "AC", "HF", "AF", "HFKC", "AFKC", "HO", "AO",
+    "HY", "AY", "HR", "AR", "HBP", "ABP", "Attendance",
+]
+# Fields read whatever the column projection, the pipelines cannot work without them
+REQUIRED_FIELDS = ["Div", "Date", "HomeTeam", "AwayTeam", "FTHG", "FTAG", "FTR"]
+# Every field except the bookmakers odds
+CORE_FIELDS = REQUIRED_FIELDS + ["HTHG", "HTAG", "HTR", "Referee", "Time"] + INTEGER_FIELDS
+# Columns added to the matches by the pipelines
+ADDED_COLUMNS = ["Country", "League", "Season"]
+
+def odds_columns(columns: list[str], header_mapping: dict[str, str]) -> list[str]:
+    # Betting columns : Football-Data fields outside the core ones, renamed with their fullname or not.
+    # Codes missing from the header dictionary (new bookmakers, closing odds,...) are odds as well.
+    core = set(CORE_FIELDS) | {header_mapping.get(field, field) for field in CORE_FIELDS} | set(ADDED_COLUMNS)
+    fullnames = set(header_mapping.values())
+    return [col for col in columns if col not in core and (col in fullnames or " " not in col)]
+
+def projection(columns: list[str] = None):
+    # Projected columns are skipped by the parser : unused odds are never materialised
+    if columns is None:
+        return None
+    kept = set(columns) | set(REQUIRED_FIELDS)
+    return lambda col: col in kept
+
+def read_matches_csv(content: bytes, columns: list[str] = None) -> pd.DataFrame:
+    df = pd.read_csv(BytesIO(content), usecols=projection(columns), parse_dates=["Date"], dayfirst=True)
+    return compact_numbers(df)
+
+def read_matches_chunks(content: bytes, columns: list[str] = None, chunksize: int = 10_000):
+    # Same parsing, a bounded number of rows at a time
+    with pd.read_csv(
+        BytesIO(content), usecols=projection(columns), parse_dates=["Date"], dayfirst=True, chunksize=chunksize
+    ) as reader:
+        for chunk in reader:
+            yield compact_numbers(chunk)
+
+def smallest_integer_type(low: int, high: int) -> type:
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def compact_numbers(df: pd.DataFrame) -> pd.DataFrame:
+    # Counts (goals, shots, cards,...) as the smallest integer type, everything else numeric (odds) as float32.
+    # Integer fields with missing values are read as floats, float32 holds them exactly.
+    # Columns are cast by groups of the same type : one block operation each instead of one per column.
+    counts = [col for col, dtype in df.dtypes.items() if col in INTEGER_FIELDS and pd.api.types.is_integer_dtype(dtype)]
+    floats = [col for col, dtype in df.dtypes.items() if col not in counts and pd.api.types.is_float_dtype(dtype)]
+    if not counts and not floats:
+        return df
+    groups = {np.float32: floats}
+    lows, highs = df[counts].min(), df[counts].max()
+    for col in counts:
+        groups.setdefault(smallest_integer_type(lows[col], highs[col]), []).append(col)
+    others = [col for col in df.columns if col not in counts and col not in floats]
+    parts = [df[others]] + [df[cols].astype(dtype) for dtype, cols in groups.items() if cols]
+    return pd.concat(parts, axis=1)[df.columns]
+
+def categorize_names(df: pd.DataFrame) -> pd.DataFrame:
+    # Done once on the concatenated frame, so every league shares the same categories
+    for col in CATEGORY_FIELDS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    return df
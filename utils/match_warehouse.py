@@ -0,0 +1,165 @@
+import glob
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import utils.data_fetching as fetching
+import utils.mapping_registry as registry
+import utils.match_schema as schema
+import utils.processed_store as store
+
+WAREHOUSE_DIR = "tmp/warehouse"
+# Elo ratings of the last update, for the rankings built from the warehouse without network access
+ELO_FILE = "elo.parquet"
+# A match is identified by its division, its date and both teams
+KEY_COLUMNS = ["Division", "Match Date", "Home Team", "Away Team"]
+
+def manifest_path(warehouse_dir: str = WAREHOUSE_DIR) -> str:
+    return os.path.join(warehouse_dir, "manifest.json")
+
+def load_manifest(warehouse_dir: str = WAREHOUSE_DIR) -> dict:
+    try:
+        with open(manifest_path(warehouse_dir), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"complete_seasons": [], "parts": 0}
+
+def save_manifest(manifest: dict, warehouse_dir: str = WAREHOUSE_DIR):
+    with open(manifest_path(warehouse_dir), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+def part_files(warehouse_dir: str = WAREHOUSE_DIR) -> list[str]:
+    return sorted(glob.glob(os.path.join(warehouse_dir, "matches-*.parquet")))
+
+def stored_keys(warehouse_dir: str = WAREHOUSE_DIR) -> pd.MultiIndex:
+    # Only the key columns are read from the columnar parts
+    keys = [pd.read_parquet(path, columns=KEY_COLUMNS) for path in part_files(warehouse_dir)]
+    if not keys:
+        return pd.MultiIndex.from_arrays([[] for _ in KEY_COLUMNS], names=KEY_COLUMNS)
+    keys = pd.concat(keys, axis="index", ignore_index=True).astype({"Division": str, "Home Team": str, "Away Team": str})
+    return pd.MultiIndex.from_frame(keys)
+
+def season_parts(season: str, warehouse_dir: str = WAREHOUSE_DIR) -> list[str]:
+    # Parts holding matches of a season (a single one once the season has been ingested again)
+    return [
+        path for path in part_files(warehouse_dir)
+        if (pd.read_parquet(path, columns=["Season"])["Season"].astype(str) == season).any()
+    ]
+
+def unified_categories(matches: pd.DataFrame) -> pd.DataFrame:
+    # Parts may hold different categories : names are unified before being encoded again
+    return store.with_categories(matches.astype({col: object for col in store.CATEGORICAL_COLUMNS if col in matches.columns}))
+
+def ingest_matches(matches: pd.DataFrame, season: str, warehouse_dir: str = WAREHOUSE_DIR) -> int:
+    # Adding the matches that have never been seen : the season is written again as a single part with them,
+    # so that a season fetched on every refresh does not add up parts
+    os.makedirs(warehouse_dir, exist_ok=True)
+    matches = matches.dropna(subset=KEY_COLUMNS).drop_duplicates(subset=KEY_COLUMNS)
+    matches_keys = pd.MultiIndex.from_frame(matches[KEY_COLUMNS].astype({"Division": str, "Home Team": str, "Away Team": str}))
+    new_matches = matches[~matches_keys.isin(stored_keys(warehouse_dir))].copy()
+    if new_matches.empty:
+        return 0
+    new_matches["Season"] = season
+    parts = season_parts(season, warehouse_dir)
+    season_matches = unified_categories(pd.concat(
+        [pd.read_parquet(path) for path in parts] + [new_matches], axis="index", ignore_index=True
+    ))
+    if parts:
+        part_path = parts[0]
+    else:
+        manifest = load_manifest(warehouse_dir)
+        part_path = os.path.join(warehouse_dir, f"matches-{manifest['parts']:05d}.parquet")
+        manifest["parts"] += 1
+        save_manifest(manifest, warehouse_dir)
+    # Replaced in one step : readers see the season before or after the new matches, never both
+    season_matches.to_parquet(f"{part_path}.tmp", index=False)
+    os.replace(f"{part_path}.tmp", part_path)
+    for path in parts[1:]:
+        os.remove(path)
+    return len(new_matches)
+
+def is_season_complete(season: str, today: datetime = None) -> bool:
+    # Seasons end before July : a past season will not receive new matches
+    today = today or datetime.now()
+    end_year = fetching.season_start_year(season, today) + 1
+    return today >= datetime(end_year, 7, 1)
+
+def update_warehouse(
+        seasons: list[str], league_sources_path: str = registry.LEAGUES_SOURCES_PATH,
+        warehouse_dir: str = WAREHOUSE_DIR
+    ) -> dict[str, dict]:
+    # Complete seasons are downloaded once, only the ongoing one is fetched again on each refresh.
+    # Leagues without a file for a season (e.g. not covered yet) are skipped : matches ingested and leagues missing
+    # of every season are returned.
+    manifest = load_manifest(warehouse_dir)
+    leagues = list(registry.leagues_sources(league_sources_path).matches_sources)
+    ingested = {}
+    missing = {}
+    for season in seasons:
+        if season in manifest["complete_seasons"]:
+            continue
+        try:
+            df_matches = fetching.fetch_matches_data(league_sources_path, season=season, skip_missing=True)
+        except FileNotFoundError:
+            missing[season] = leagues
+            continue
+        fetched = set(df_matches["League"].astype(object))
+        missing_leagues = [league for league in leagues if league not in fetched]
+        if missing_leagues:
+            missing[season] = missing_leagues
+        fetching.map_fullname_columns(df_matches)
+        ingested[season] = ingest_matches(df_matches, season, warehouse_dir)
+        if is_season_complete(season):
+            manifest = load_manifest(warehouse_dir)
+            manifest["complete_seasons"].append(season)
+            save_manifest(manifest, warehouse_dir)
+    save_elo(fetching.fetch_elo_data(), warehouse_dir)
+    return {"ingested": ingested, "missing": missing}
+
+def save_elo(elo: pd.DataFrame, warehouse_dir: str = WAREHOUSE_DIR):
+    os.makedirs(warehouse_dir, exist_ok=True)
+    path = os.path.join(warehouse_dir, ELO_FILE)
+    elo.to_parquet(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+
+def load_elo(warehouse_dir: str = WAREHOUSE_DIR) -> pd.DataFrame:
+    # Ratings saved by the last update, none before the first one
+    path = os.path.join(warehouse_dir, ELO_FILE)
+    if not os.path.exists(path):
+        return fetching.empty_elo()
+    return pd.read_parquet(path)
+
+def empty_matches(warehouse_dir: str = WAREHOUSE_DIR) -> pd.DataFrame:
+    # Matches without rows, with the columns of the warehouse parts (the core ones before any ingestion)
+    parts = part_files(warehouse_dir)
+    if parts:
+        parts_schema = pa.unify_schemas([store.value_types(pq.read_schema(path)) for path in parts], promote_options="permissive")
+    else:
+        header_mapping = fetching.header_mapping()
+        types = store.matches_field_types()
+        columns = dict.fromkeys(header_mapping.get(field, field) for field in schema.CORE_FIELDS + schema.ADDED_COLUMNS)
+        parts_schema = pa.schema([pa.field(col, types[col]) for col in columns])
+    return store.with_categories(parts_schema.empty_table().to_pandas())
+
+def load_matches(
+        leagues: list[str] = None, from_date: datetime = None, to_date: datetime = None,
+        warehouse_dir: str = WAREHOUSE_DIR
+    ) -> pd.DataFrame:
+    # Filters are pushed down to the Parquet reader, no network access is needed
+    filters = []
+    if leagues is not None:
+        filters.append(("League", "in", list(leagues)))
+    if from_date is not None:
+        filters.append(("Match Date", ">=", pd.Timestamp(from_date)))
+    if to_date is not None:
+        filters.append(("Match Date", "<=", pd.Timestamp(to_date)))
+    parts = [pd.read_parquet(path, filters=filters or None) for path in part_files(warehouse_dir)]
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        return empty_matches(warehouse_dir)
+    matches = unified_categories(pd.concat(parts, axis="index", ignore_index=True))
+    return matches.sort_values("Match Date", kind="stable", ignore_index=True)
@@ -0,0 +1,153 @@
+import re
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import utils.mapping_registry as registry
+import utils.match_schema as schema
+
+# Market -> selections, in the order of the last axis of its odds matrix
+MARKET_SELECTIONS = {
+    "Full time result": ["Home win", "Draw", "Away win"],
+    "Over/Under 2.5": ["Over 2.5", "Under 2.5"],
+    "Asian handicap": ["Home handicap", "Away handicap"],
+}
+# Football-Data.co.uk codes of every market : bookmaker code, then selection code (closing odds add a "C"
+# to the bookmaker code, e.g. B365CH). Handicap sizes and numbers of bookmakers (AHh, B365AH, BbAH,...) are not odds.
+MARKET_CODES = {
+    "Asian handicap": (re.compile(r"^(?P<bookmaker>\w*?)AH(?P<selection>[HA])$"), {"H": 0, "A": 1}),
+    "Over/Under 2.5": (re.compile(r"^(?P<bookmaker>\w+?)(?P<selection>[><])2\.5$"), {">": 0, "<": 1}),
+    "Full time result": (re.compile(r"^(?P<bookmaker>\w+?)(?P<selection>[HDA])$"), {"H": 0, "D": 1, "A": 2}),
+}
+NOT_ODDS_CODES = re.compile(r"AHC?h?$|^Bb(1X2|OU|AH)$")
+# Prices computed over the market (maximum or average of the bookmakers), not offered by one bookmaker
+MAXIMUM_BOOKMAKERS = ["Max", "BbMx"]
+AVERAGE_BOOKMAKERS = ["Avg", "BbAv"]
+# Columns of the matches kept in the odds table
+KEY_COLUMNS = ["Match Date", "League", "Home Team", "Away Team", "Full time result"]
+
+@dataclass
+class OddsMarket:
+    selections: list[str]
+    bookmakers: list[str]
+    # (matches, bookmakers, selections) decimal odds, NaN where a bookmaker has not priced the match
+    odds: np.ndarray
+    closing: np.ndarray
+
+    def columns(self, bookmakers: list[str] = None, excluded: list[str] = ()) -> np.ndarray:
+        # Mask of the opening odds of the bookmakers (all of them by default), except the excluded ones
+        keep = ~self.closing & ~np.isin(self.bookmakers, list(excluded))
+        if bookmakers is not None:
+            keep &= np.isin(self.bookmakers, bookmakers)
+        return keep
+
+def field_codes(columns: list[str], header_mapping: dict[str, str]) -> dict[str, str]:
+    # Odds column -> Football-Data code, the columns being renamed with their fullname or not
+    codes = {}
+    for field, fullname in header_mapping.items():
+        codes.setdefault(fullname, field)
+    return {col: codes.get(col, col) for col in schema.odds_columns(columns, header_mapping)}
+
+def source_columns(columns: list[str], header_mapping: dict[str, str] = None) -> list[str]:
+    # Matches columns the odds table is computed from
+    header_mapping = header_mapping if header_mapping is not None else registry.header_mapping()
+    return [col for col in KEY_COLUMNS if col in columns] + schema.odds_columns(columns, header_mapping)
+
+def odds_matrix(matches: pd.DataFrame, header_mapping: dict[str, str] = None) -> tuple[np.ndarray, list[str]]:
+    # Every odds column as a single float32 matrix (one copy at most, the odds being read as float32),
+    # with the code of each column. Odds of 1 or less are not prices : missing.
+    header_mapping = header_mapping if header_mapping is not None else registry.header_mapping()
+    codes = field_codes(list(matches.columns), header_mapping)
+    positions = [i for i, col in enumerate(matches.columns) if col in codes]
+    matrix = matches.iloc[:, positions].to_numpy(dtype=np.float32, na_value=np.nan)
+    matrix[~(matrix > 1)] = np.nan
+    return matrix, [codes[matches.columns[i]] for i in positions]
+
+def odds_markets(matches: pd.DataFrame, header_mapping: dict[str, str] = None) -> dict[str, OddsMarket]:
+    # Market -> odds of its bookmakers, gathered from the odds matrix with one fancy indexing per market
+    matrix, codes = odds_matrix(matches, header_mapping)
+    # Missing (bookmaker, selection) pairs point to a column of NaN
+    matrix = np.hstack([matrix, np.full((len(matrix), 1), np.nan, dtype=np.float32)])
+    missing = matrix.shape[1] - 1
+    positions = {market: {} for market in MARKET_CODES}
+    for i, code in enumerate(codes):
+        if NOT_ODDS_CODES.search(code):
+            continue
+        for market, (pattern, selections) in MARKET_CODES.items():
+            match = pattern.match(code)
+            if match:
+                positions[market].setdefault(match["bookmaker"], {})[selections[match["selection"]]] = i
+                break
+    markets = {}
+    for market, bookmakers in positions.items():
+        if not bookmakers:
+            continue
+        names = list(bookmakers)
+        n_selections = len(MARKET_SELECTIONS[market])
+        index = np.array([[bookmakers[name].get(j, missing) for j in range(n_selections)] for name in names])
+        # Closing odds : a "C" after the code of a bookmaker whose opening odds are there as well
+        closing = np.array([name.endswith("C") and name[:-1] in bookmakers for name in names])
+        markets[market] = OddsMarket(MARKET_SELECTIONS[market], names, matrix[:, index], closing)
+    return markets
+
+def implied_probabilities(odds: np.ndarray) -> np.ndarray:
+    return 1 / odds
+
+def overround(odds: np.ndarray) -> np.ndarray:
+    # Sum of the implied probabilities of a market minus 1 (bookmaker margin), NaN if a selection is not priced
+    return implied_probabilities(odds).sum(axis=-1) - 1
+
+def fair_probabilities(odds: np.ndarray) -> np.ndarray:
+    # Implied probabilities with the margin removed proportionally
+    implied = implied_probabilities(odds)
+    return implied / implied.sum(axis=-1, keepdims=True)
+
+def nan_mean(values: np.ndarray, axis: int) -> np.ndarray:
+    # Mean of the priced values, NaN (without warnings) when none is
+    priced = ~np.isnan(values)
+    count = priced.sum(axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, np.where(priced, values, 0).sum(axis=axis) / count, np.nan).astype(np.float32)
+
+def best_prices(market: OddsMarket) -> tuple[np.ndarray, np.ndarray]:
+    # Highest opening odds offered for every selection (market maximums and averages are not offered by a bookmaker),
+    # and the index of the bookmaker offering it (-1 if none)
+    columns = market.columns(excluded=MAXIMUM_BOOKMAKERS + AVERAGE_BOOKMAKERS)
+    odds = market.odds[:, columns]
+    best = np.where(np.isnan(odds), -np.inf, odds).argmax(axis=1)
+    prices = np.take_along_axis(odds, best[:, None, :], axis=1)[:, 0, :]
+    return prices, np.where(np.isnan(prices), -1, np.flatnonzero(columns)[best])
+
+def average_prices(market: OddsMarket) -> np.ndarray:
+    # Market average opening odds of every selection (Avg, or BbAv for the older seasons), NaN if none
+    prices = np.full((len(market.odds), len(market.selections)), np.nan, dtype=np.float32)
+    for name in AVERAGE_BOOKMAKERS:
+        if name in market.bookmakers:
+            prices = np.where(np.isnan(prices), market.odds[:, market.bookmakers.index(name), :], prices)
+    return prices
+
+def consensus_probabilities(market: OddsMarket) -> np.ndarray:
+    # Average of the margin-free probabilities of the bookmakers pricing the whole market,
+    # the market average odds being used for the matches no bookmaker has fully priced
+    bookmakers = market.odds[:, market.columns(excluded=MAXIMUM_BOOKMAKERS + AVERAGE_BOOKMAKERS)]
+    consensus = nan_mean(fair_probabilities(bookmakers), axis=1)
+    average = nan_mean(fair_probabilities(market.odds[:, market.columns(AVERAGE_BOOKMAKERS)]), axis=1)
+    consensus = np.where(np.isnan(consensus).any(axis=1, keepdims=True), average, consensus)
+    return consensus / consensus.sum(axis=1, keepdims=True)
+
+def odds_table(matches: pd.DataFrame, header_mapping: dict[str, str] = None) -> pd.DataFrame:
+    # One row per match : best price (and its bookmaker), market consensus probability of every selection,
+    # average bookmaker margin and margin of the best prices of every market (negative : sure bet)
+    table = matches[[col for col in KEY_COLUMNS if col in matches.columns]].reset_index(drop=True)
+    for market_name, market in odds_markets(matches, header_mapping).items():
+        prices, bookmakers = best_prices(market)
+        consensus = consensus_probabilities(market)
+        for j, selection in enumerate(market.selections):
+            table[f"{selection} best odds"] = prices[:, j]
+            table[f"{selection} best bookmaker"] = pd.Categorical.from_codes(bookmakers[:, j], categories=market.bookmakers)
+            table[f"{selection} market probability"] = consensus[:, j]
+        bookmakers_odds = market.odds[:, market.columns(excluded=MAXIMUM_BOOKMAKERS + AVERAGE_BOOKMAKERS)]
+        table[f"{market_name} margin"] = nan_mean(overround(bookmakers_odds), axis=1)
+        table[f"{market_name} best prices margin"] = overround(prices)
+    return table
@@ -0,0 +1,249 @@
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from math import lgamma
+
+import numpy as np
+import pandas as pd
+
+import utils.data_fetching as fetching
+import utils.processed_store as store
+
+MODEL_PATH = "tmp/prediction_model.json"
+# Matches columns the models are fitted on
+MODEL_COLUMNS = [
+    "Match Date", "League", "Home Team", "Away Team", "Full time home team goals", "Full time away team goals",
+]
+# Weight of a match halved every year : recent form matters more than older seasons
+DECAY_PER_DAY = np.log(2) / 365
+# Weighted matches at the league average added to every team, so that few matches cannot give extreme strengths
+PRIOR_MATCHES = 2.0
+MAX_ITERATIONS = 200
+TOLERANCE = 1e-8
+# Dixon-Coles dependence of the low scores, searched on this grid
+RHO_GRID = np.linspace(-0.2, 0.2, 81)
+# Scores up to MAX_GOALS goals per team are enumerated
+MAX_GOALS = 10
+OVER_LINES = [0.5, 1.5, 2.5, 3.5, 4.5]
+
+@dataclass
+class LeagueModel:
+    # Poisson scoring rates : home goals ~ home * attack[home team] * defence[away team],
+    # away goals ~ attack[away team] * defence[home team], with a Dixon-Coles correction of the low scores
+    teams: list[str]
+    attack: list[float]
+    defence: list[float]
+    home: float
+    rho: float
+    # Data the model has been fitted on, to refit only when new matches come in
+    fitted_until: str
+    matches: int
+
+def fit_strengths(
+        home_idx: np.ndarray, away_idx: np.ndarray, home_goals: np.ndarray, away_goals: np.ndarray,
+        weights: np.ndarray, n_teams: int, start: tuple[np.ndarray, np.ndarray, float] = None
+    ) -> tuple[np.ndarray, np.ndarray, float]:
+    # Maximum likelihood of the multiplicative Poisson model, by alternating closed-form updates (Maher).
+    # A warm start from the previous fit converges in a few iterations.
+    goals_for = np.bincount(home_idx, weights * home_goals, n_teams) + np.bincount(away_idx, weights * away_goals, n_teams)
+    goals_against = np.bincount(home_idx, weights * away_goals, n_teams) + np.bincount(away_idx, weights * home_goals, n_teams)
+    total_home_goals = np.sum(weights * home_goals)
+    average = (goals_for.sum() / (2 * weights.sum())) if weights.sum() else 1.0
+    prior_goals = PRIOR_MATCHES * average
+    attack, defence, home = start if start is not None else (np.ones(n_teams), np.ones(n_teams), 1.0)
+    for _ in range(MAX_ITERATIONS):
+        exposure = np.bincount(home_idx, weights * home * defence[away_idx], n_teams) + np.bincount(away_idx, weights * defence[home_idx], n_teams)
+        new_attack = (goals_for + prior_goals) / (exposure + PRIOR_MATCHES)
+        exposure = np.bincount(home_idx, weights * new_attack[away_idx], n_teams) + np.bincount(away_idx, weights * home * new_attack[home_idx], n_teams)
+        new_defence = (goals_against + prior_goals) / (exposure + PRIOR_MATCHES * average)
+        # Attack strengths average to the league goals per team and match, defences to 1
+        scale = new_defence.mean()
+        new_attack, new_defence = new_attack * scale, new_defence / scale
+        expected_home = np.sum(weights * new_attack[home_idx] * new_defence[away_idx])
+        new_home = total_home_goals / expected_home if expected_home else 1.0
+        change = max(np.abs(new_attack - attack).max(), np.abs(new_defence - defence).max(), abs(new_home - home))
+        attack, defence, home = new_attack, new_defence, new_home
+        if change < TOLERANCE:
+            break
+    return attack, defence, home
+
+def low_score_correction(home_rates: np.ndarray, away_rates: np.ndarray, rho: np.ndarray) -> np.ndarray:
+    # Dixon-Coles factors of the 0-0, 0-1, 1-0 and 1-1 scores (last axis), broadcast over the arguments
+    return np.stack(np.broadcast_arrays(
+        1 - home_rates * away_rates * rho, 1 + home_rates * rho, 1 + away_rates * rho, 1 - rho
+    ), axis=-1)
+
+def fit_rho(home_rates: np.ndarray, away_rates: np.ndarray, home_goals: np.ndarray, away_goals: np.ndarray, weights: np.ndarray) -> float:
+    # Weighted likelihood of the low scores over the whole grid at once, the other scores do not depend on rho
+    score_idx = np.select(
+        [(home_goals == 0) & (away_goals == 0), (home_goals == 0) & (away_goals == 1),
+         (home_goals == 1) & (away_goals == 0), (home_goals == 1) & (away_goals == 1)],
+        [0, 1, 2, 3], -1
+    )
+    low = score_idx >= 0
+    if not low.any():
+        return 0.0
+    factors = low_score_correction(home_rates[low][:, None], away_rates[low][:, None], RHO_GRID)
+    factors = np.take_along_axis(factors, score_idx[low][:, None, None], axis=-1)[..., 0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        likelihood = np.where(factors > 0, np.log(np.maximum(factors, 1e-300)), -np.inf)
+    return float(RHO_GRID[np.argmax(weights[low] @ likelihood)])
+
+def fit_league(matches: pd.DataFrame, previous: LeagueModel = None) -> LeagueModel:
+    # matches : fullname columns matches of a single league
+    matches = matches.dropna(subset=["Full time home team goals", "Full time away team goals"])
+    teams = pd.Index(sorted(set(matches["Home Team"].astype(object)) | set(matches["Away Team"].astype(object))))
+    home_idx = teams.get_indexer(matches["Home Team"].astype(object))
+    away_idx = teams.get_indexer(matches["Away Team"].astype(object))
+    home_goals = matches["Full time home team goals"].to_numpy(dtype=float)
+    away_goals = matches["Full time away team goals"].to_numpy(dtype=float)
+    last_date = matches["Match Date"].max()
+    weights = np.exp(-DECAY_PER_DAY * (last_date - matches["Match Date"]).dt.days.to_numpy())
+
+    start = None
+    if previous is not None:
+        # Refit from the previous strengths, the teams new to the league starting from average ones
+        attack = pd.Series(previous.attack, index=previous.teams).reindex(teams)
+        defence = pd.Series(previous.defence, index=previous.teams).reindex(teams)
+        start = (attack.fillna(attack.mean()).to_numpy(), defence.fillna(1.0).to_numpy(), previous.home)
+    attack, defence, home = fit_strengths(home_idx, away_idx, home_goals, away_goals, weights, len(teams), start)
+    rho = fit_rho(home * attack[home_idx] * defence[away_idx], attack[away_idx] * defence[home_idx], home_goals, away_goals, weights)
+    return LeagueModel(
+        teams=list(teams), attack=attack.tolist(), defence=defence.tolist(), home=float(home), rho=rho,
+        fitted_until=last_date.isoformat(), matches=len(matches),
+    )
+
+# Model path -> league -> fitted model, shared by every session of the process
+_models: dict[str, dict[str, LeagueModel]] = {}
+_lock = threading.Lock()
+
+def load_models(path: str = MODEL_PATH) -> dict[str, LeagueModel]:
+    key = os.path.abspath(path)
+    if key not in _models:
+        models = {}
+        if os.path.exists(key):
+            with open(key, "r", encoding="utf-8") as f:
+                models = {league: LeagueModel(**model) for league, model in json.load(f).items()}
+        _models[key] = models
+    return _models[key]
+
+def save_models(models: dict[str, LeagueModel], path: str = MODEL_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({league: asdict(model) for league, model in models.items()}, f)
+    os.replace(tmp_path, path)
+
+def fit_models(matches: pd.DataFrame, leagues: list[str] = None, path: str = MODEL_PATH) -> dict[str, LeagueModel]:
+    # Leagues whose matches have not changed since their last fit are not fitted again
+    with _lock:
+        models = load_models(path)
+        changed = False
+        for league, league_matches in matches.groupby(matches["League"].astype(object), sort=False):
+            if leagues is not None and league not in leagues:
+                continue
+            previous = models.get(league)
+            fitted_until = league_matches["Match Date"].max().isoformat()
+            if previous is not None and previous.fitted_until == fitted_until and previous.matches == len(league_matches):
+                continue
+            models[league] = fit_league(league_matches, previous)
+            changed = True
+        if changed:
+            save_models(models, path)
+        return dict(models)
+
+def team_rates(fixtures: pd.DataFrame, models: dict[str, LeagueModel]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Expected home and away goals and rho of every fixture, NaN when a team or the league has no model
+    strengths = pd.concat([
+        pd.DataFrame({"League": league, "Team": model.teams, "Attack": model.attack, "Defence": model.defence,
+                      "Home": model.home, "Rho": model.rho})
+        for league, model in models.items()
+    ], ignore_index=True).set_index(["League", "Team"]) if models else pd.DataFrame(
+        columns=["Attack", "Defence", "Home", "Rho"], index=pd.MultiIndex.from_arrays([[], []], names=["League", "Team"])
+    )
+    leagues = fixtures["League"].astype(object).to_numpy()
+    home = strengths.reindex(pd.MultiIndex.from_arrays([leagues, fixtures["Home Team"].astype(object).to_numpy()]))
+    away = strengths.reindex(pd.MultiIndex.from_arrays([leagues, fixtures["Away Team"].astype(object).to_numpy()]))
+    home_rates = (home["Home"] * home["Attack"] * away["Defence"].to_numpy()).to_numpy(dtype=float)
+    away_rates = (away["Attack"] * home["Defence"].to_numpy()).to_numpy(dtype=float)
+    return home_rates, away_rates, home["Rho"].to_numpy(dtype=float)
+
+def score_probabilities(home_rates: np.ndarray, away_rates: np.ndarray, rho: np.ndarray) -> np.ndarray:
+    # Score matrix of every fixture in one pass : (fixtures, home goals, away goals)
+    goals = np.arange(MAX_GOALS + 1)
+    log_factorials = np.array([lgamma(k + 1) for k in goals])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        home_pmf = np.exp(goals * np.log(home_rates[:, None]) - home_rates[:, None] - log_factorials)
+        away_pmf = np.exp(goals * np.log(away_rates[:, None]) - away_rates[:, None] - log_factorials)
+    scores = home_pmf[:, :, None] * away_pmf[:, None, :]
+    factors = low_score_correction(home_rates, away_rates, np.nan_to_num(rho))
+    scores[:, 0, 0] *= factors[:, 0]
+    scores[:, 0, 1] *= factors[:, 1]
+    scores[:, 1, 0] *= factors[:, 2]
+    scores[:, 1, 1] *= factors[:, 3]
+    # Scores beyond MAX_GOALS are left out : the enumerated ones are normalised
+    with np.errstate(invalid="ignore"):
+        return scores / scores.sum(axis=(1, 2), keepdims=True)
+
+def score_fixtures(fixtures: pd.DataFrame, models: dict[str, LeagueModel]) -> pd.DataFrame:
+    # Full time result, win or draw and over X goals probabilities of every fixture, aligned on the fixtures rows
+    home_rates, away_rates, rho = team_rates(fixtures, models)
+    scores = score_probabilities(home_rates, away_rates, rho)
+    home_goals, away_goals = np.indices(scores.shape[1:])
+    probabilities = pd.DataFrame({
+        "Expected home goals": home_rates,
+        "Expected away goals": away_rates,
+        "Home win": scores[:, home_goals > away_goals].sum(axis=1),
+        "Draw": scores[:, home_goals == away_goals].sum(axis=1),
+        "Away win": scores[:, home_goals < away_goals].sum(axis=1),
+    }, index=fixtures.index)
+    probabilities["Home win or draw"] = probabilities["Home win"] + probabilities["Draw"]
+    probabilities["Away win or draw"] = probabilities["Away win"] + probabilities["Draw"]
+    # Distribution of the total goals, then the probability of every line
+    totals = np.stack([scores[:, home_goals + away_goals == total].sum(axis=1) for total in range(2 * MAX_GOALS + 1)], axis=1)
+    for line in OVER_LINES:
+        probabilities[f"Over {line}"] = totals[:, int(line) + 1:].sum(axis=1)
+    # Fixtures without a model keep blank probabilities
+    probabilities.loc[~(np.isfinite(home_rates) & np.isfinite(away_rates))] = np.nan
+    return probabilities
+
+def predict_fixtures(fixtures: pd.DataFrame, store_dir: str = store.STORE_DIR, path: str = MODEL_PATH) -> pd.DataFrame:
+    # Models fitted on the processed matches of the store (refitted for the leagues with new matches)
+    matches = store.load_table("Matches", store_dir, MODEL_COLUMNS)
+    leagues = list(pd.unique(fixtures["League"].astype(object)))
+    return score_fixtures(fixtures, fit_models(matches, leagues, path))
+
+def unscored_fixtures(fixtures: pd.DataFrame, probabilities: pd.DataFrame) -> pd.DataFrame:
+    # Fixtures left blank : league without a model, or a feed team name the models do not know
+    # (to be added to the "Fixtures team name" column of the team mapping file)
+    return fixtures.loc[probabilities["Home win"].isna(), ["League", "Home Team", "Away Team"]]
+
+def pick(probabilities: pd.DataFrame, labels: dict[str, str]) -> tuple[pd.Series, pd.Series]:
+    # Most likely outcome among the columns, with its probability as confidence
+    columns = probabilities[list(labels)]
+    known = columns.notna().all(axis="columns")
+    prediction = columns.fillna(-1).idxmax(axis="columns").map(labels).where(known)
+    return prediction, columns.max(axis="columns").where(known)
+
+def prediction_sheets(fixtures: pd.DataFrame, probabilities: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # Sheet name -> fixtures with the probabilities of that bet, prediction and confidence pre-filled,
+    # the bet odd and result being left to the user
+    key = ["Match Date (locale)", "League", "Home Team", "Away Team"]
+    expected = ["Expected home goals", "Expected away goals"]
+    over = probabilities.assign(**{"Under 2.5": 1 - probabilities["Over 2.5"]})
+    bets = {
+        "Full time result": (probabilities, ["Home win", "Draw", "Away win"], {"Home win": "H", "Draw": "D", "Away win": "A"}),
+        "Win or draw": (probabilities, ["Home win or draw", "Away win or draw"], {"Home win or draw": "1X", "Away win or draw": "X2"}),
+        "Over X goals": (over, [f"Over {line}" for line in OVER_LINES], {"Over 2.5": "Over 2.5", "Under 2.5": "Under 2.5"}),
+    }
+    sheets = {}
+    for sheet_name in fetching.PREDICTION_SHEETS:
+        bet_probabilities, columns, labels = bets[sheet_name]
+        sheet = fixtures[key].copy()
+        for col in expected + columns:
+            sheet[col] = bet_probabilities[col]
+        sheet["Bet prediction"], sheet["Confidence"] = pick(bet_probabilities, labels)
+        sheet["Bet odd"] = sheet["Result"] = None
+        sheets[sheet_name] = sheet[key + expected + columns + ["Bet prediction", "Bet odd", "Confidence", "Result"]]
+    return sheets
@@ -2,21 +2,31 @@ import pandas as pd
 from streamlit import cache_data
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
-@cache_data(persist="disk")
-def split_processed_data_sheets(file: UploadedFile):
-    matches = pd.read_excel(file, sheet_name="Matches", parse_dates=["Match Date"])
-    ranking = pd.read_excel(file, sheet_name="Ranking")
+import utils.mapping_registry as registry
+import utils.odds_analytics as odds_analytics
+import utils.processed_loader as loader
+import utils.processed_store as store
+
+def split_processed_data_sheets(file: UploadedFile, data_key: str = None):
+    tables = loader.load_processed_workbook(file.getvalue(), data_key, ["Matches", "Ranking"])
+    return tables["Matches"], tables["Ranking"]
+
+@cache_data
+def load_processed_store(store_dir: str, store_version: float):
+    # store_version (last modification time) is only part of the cache key
+    matches = store.load_table("Matches", store_dir)
+    ranking = store.load_table("Ranking", store_dir)
     return matches, ranking
 
-@cache_data(persist="disk")
-def map_divisions_leagues_images(processed_data: UploadedFile):
-    matches = pd.read_excel(processed_data, sheet_name="Matches")
-    res = pd.read_csv("data_mapping/leagues_countries_images.csv", sep=";")
-    leagues = list(matches["League"].unique())
-    res = res[res["League"].isin(leagues)]
-    res["Flag Filepaths"] = res["Flag Filename"].map(lambda filename: f"img\\countries\\{filename}")
-    res["Division Filepaths"] = res["Division Filename"].map(lambda filename: f"img\\divisions\\{filename}")
-    return res
+def map_divisions_leagues_images(processed_data: UploadedFile, data_key: str = None):
+    # Only read : the cached frame itself, not a copy
+    matches = loader.load_processed_workbook(processed_data.getvalue(), data_key, ["Matches"], copy=False)["Matches"]
+    return leagues_images_mapping(matches)
+
+def leagues_images_mapping(matches: pd.DataFrame):
+    # Images paths are computed once per mapping file
+    images = registry.leagues_images()
+    return images[images["League"].isin(matches["League"].unique())]
 
 def countries_flags(leagues_mapping: pd.DataFrame):
     countries_flags_map = zip(leagues_mapping["Country"], leagues_mapping["Flag Filepaths"])
@@ -26,16 +36,111 @@ def divisions_logos(leagues_mapping: pd.DataFrame):
     divisions_flags_map = zip(leagues_mapping["League"], leagues_mapping["Division Filepaths"])
     return list(divisions_flags_map)
 
-def group_goals_per_month(matches: pd.DataFrame, at_home: bool):
-    res = matches.groupby('Match Date', as_index=False)['Full time home team goals' if at_home else 'Full time away team goals'].sum()
-    res = res.groupby(pd.Grouper(key='Match Date', freq='YE')).sum()
-    return res.reset_index()
+def uploaded_file_key(file: UploadedFile) -> str:
+    return loader.content_key(file.getvalue())
+
+ALL = "All"
+KPI_AGGREGATIONS = {
+    "Oldest match": ("Match Date", "min"),
+    "Latest match": ("Match Date", "max"),
+    "Match days": ("Match Date", "nunique"),
+    "Matches": ("Match Date", "size"),
+    "Leagues": ("Division", "nunique"),
+    "Teams": ("Home Team", "nunique"),
+}
+SIDE_COLUMNS = {
+    "Home": ("Home Team", "Full time home team goals", "H"),
+    "Away": ("Away Team", "Full time away team goals", "A"),
+}
+
+@cache_data(max_entries=16)
+def build_preview_cube(data_key: str, _matches: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # Aggregates built once per processed file : data_key identifies its content, the frame itself is not hashed
+    kpis = _matches.groupby(_matches["Country"].astype(object)).agg(**KPI_AGGREGATIONS)
+    kpis.loc[ALL] = pd.Series({name: _matches[col].agg(func) for name, (col, func) in KPI_AGGREGATIONS.items()})
+
+    # Country x league x team x side x year cells, summed goals and wins
+    year_end = _matches["Match Date"].dt.to_period("Y").dt.to_timestamp(how="end").dt.normalize()
+    sides = []
+    for side, (team_col, goals_col, win_indicator) in SIDE_COLUMNS.items():
+        sides.append(pd.DataFrame({
+            "Country": _matches["Country"].to_numpy(dtype=object),
+            "League": _matches["League"].to_numpy(dtype=object),
+            "Team": _matches[team_col].to_numpy(dtype=object),
+            "Side": side,
+            "Year": year_end.to_numpy(),
+            "Goals": _matches[goals_col].to_numpy(),
+            "Wins": (_matches["Full time result"] == win_indicator).to_numpy(dtype=int),
+        }))
+    cells = pd.concat(sides, axis=0, ignore_index=True)
+    cells = cells.groupby(["Country", "League", "Team", "Side", "Year"], as_index=False, sort=False)[["Goals", "Wins"]].sum()
+    return {"kpis": kpis, "cells": cells}
+
+# Width of the market probability buckets of the calibration chart
+CALIBRATION_STEP = 0.05
+RESULT_SELECTIONS = {"Home win": "H", "Draw": "D", "Away win": "A"}
+
+@cache_data(max_entries=16)
+def build_odds_summary(data_key: str, _matches: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # Odds analytics computed once per processed file, aggregated for the charts :
+    # average bookmaker margin per league, and observed frequency of the results per market probability
+    odds = odds_analytics.odds_table(_matches)
+    margins = [f"{market} margin" for market in odds_analytics.MARKET_SELECTIONS if f"{market} margin" in odds.columns]
+    summary = {"margins": odds.groupby(odds["League"].astype(object))[margins].mean().mul(100).rename_axis("League")}
+    if "Home win market probability" not in odds.columns:
+        summary["calibration"] = pd.DataFrame()
+        return summary
+    buckets = []
+    for selection, result in RESULT_SELECTIONS.items():
+        probability = odds[f"{selection} market probability"]
+        buckets.append(pd.DataFrame({
+            "Selection": selection,
+            "Market probability": (probability // CALIBRATION_STEP) * CALIBRATION_STEP + CALIBRATION_STEP / 2,
+            "Observed frequency": (odds["Full time result"] == result).astype(float),
+        })[probability.notna().to_numpy()])
+    calibration = pd.concat(buckets, ignore_index=True)
+    summary["calibration"] = calibration.pivot_table(
+        index="Market probability", columns="Selection", values="Observed frequency", aggfunc="mean"
+    )[list(RESULT_SELECTIONS)]
+    return summary
+
+def cube_kpis(cube: dict[str, pd.DataFrame], country: str = ALL) -> pd.Series:
+    return cube["kpis"].loc[country]
+
+def cube_slice(cube: dict[str, pd.DataFrame], country: str = ALL, league: str = ALL, side: str = None) -> pd.DataFrame:
+    cells = cube["cells"]
+    mask = pd.Series(True, index=cells.index)
+    if country != ALL:
+        mask &= cells["Country"] == country
+    if league != ALL:
+        mask &= cells["League"] == league
+    if side is not None:
+        mask &= cells["Side"] == side
+    return cells[mask]
+
+def cube_leagues(cube: dict[str, pd.DataFrame], country: str = ALL) -> list[str]:
+    return list(cube_slice(cube, country)["League"].unique())
+
+def group_goals_per_team(cube: dict[str, pd.DataFrame], country: str, league: str, at_home: bool):
+    side = "Home" if at_home else "Away"
+    team_col, goals_col, _ = SIDE_COLUMNS[side]
+    res = cube_slice(cube, country, league, side).groupby("Team", as_index=False)["Goals"].sum()
+    return res.rename(columns={"Team": team_col, "Goals": goals_col})
+
+def group_goals_per_month(cube: dict[str, pd.DataFrame], country: str, league: str, at_home: bool):
+    side = "Home" if at_home else "Away"
+    _, goals_col, _ = SIDE_COLUMNS[side]
+    res = cube_slice(cube, country, league, side).groupby("Year")["Goals"].sum()
+    # Keeping empty years between the oldest and the latest match
+    res = res.resample("YE").sum()
+    return res.rename_axis("Match Date").reset_index().rename(columns={"Goals": goals_col})
 
-def group_wins_per_team(matches: pd.DataFrame, at_home: bool):
-    win_indicator = "H" if at_home else "A"
-    res = matches[matches["Full time result"] == win_indicator]
-    res = res.groupby("Home Team", as_index=False)["Full time result"].count()
-    return res
+def group_wins_per_team(cube: dict[str, pd.DataFrame], country: str, league: str, at_home: bool):
+    side = "Home" if at_home else "Away"
+    team_col, _, _ = SIDE_COLUMNS[side]
+    res = cube_slice(cube, country, league, side)
+    res = res[res["Wins"] > 0].groupby("Team", as_index=False)["Wins"].sum()
+    return res.rename(columns={"Team": team_col, "Wins": "Full time result"})
 
 def most_consistent_team(ranking: pd.DataFrame):
     most_consistent_idx = ranking["Consistency - All"].idxmax()
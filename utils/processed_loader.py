@@ -0,0 +1,114 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
+
+import pandas as pd
+
+import utils.processed_store as store
+
+CACHE_DIR = "tmp/processed_cache"
+MEMORY_MAX_ENTRIES = 4
+DISK_MAX_ENTRIES = 16
+
+# Content hash -> typed frames of a processed workbook, least recently used first.
+# Only handed out to read-only callers : the others get copies, which they are free to modify.
+_memory: OrderedDict[str, dict[str, pd.DataFrame]] = OrderedDict()
+# Content hash -> frames being loaded : sessions uploading the same file wait for a single parse
+_loading: dict[str, Future] = {}
+# Held for the lookups and insertions only, never while a workbook is parsed
+_lock = threading.Lock()
+_disk_lock = threading.Lock()
+
+def content_key(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def entry_dir(key: str) -> str:
+    return os.path.join(CACHE_DIR, key)
+
+def parse_workbook(content: bytes) -> dict[str, pd.DataFrame]:
+    # Every sheet parsed in a single pass over the workbook
+    sheets = pd.read_excel(BytesIO(content), sheet_name=None)
+    tables = {sheet_name: sheets[sheet_name] for sheet_name in store.STORE_TABLES if sheet_name in sheets}
+    tables["Matches"]["Match Date"] = pd.to_datetime(tables["Matches"]["Match Date"])
+    return {sheet_name: store.with_categories(df) for sheet_name, df in tables.items()}
+
+def load_from_disk(key: str) -> dict[str, pd.DataFrame] | None:
+    directory = entry_dir(key)
+    if not os.path.exists(os.path.join(directory, store.STORE_TABLES["Matches"])):
+        return None
+    # Access time drives the least-recently-used eviction of the disk tier
+    os.utime(directory)
+    return {
+        sheet_name: store.load_table(sheet_name, directory)
+        for sheet_name, filename in store.STORE_TABLES.items()
+        if os.path.exists(os.path.join(directory, filename))
+    }
+
+def save_to_disk(key: str, tables: dict[str, pd.DataFrame]):
+    store.save_store(tables, entry_dir(key))
+    with _disk_lock:
+        entries = sorted(
+            (entry for entry in os.scandir(CACHE_DIR) if entry.is_dir()),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries[:max(0, len(entries) - DISK_MAX_ENTRIES)]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def load_tables(key: str, content: bytes) -> dict[str, pd.DataFrame]:
+    tables = load_from_disk(key)
+    if tables is None:
+        tables = parse_workbook(content)
+        save_to_disk(key, tables)
+    return tables
+
+def load_processed_workbook(
+        content: bytes, key: str = None, sheets: list[str] = None, copy: bool = True
+    ) -> dict[str, pd.DataFrame]:
+    # Parsing happens once per distinct file : memory first, then the Parquet disk tier.
+    # The frames of the requested sheets (all of them by default) are returned as copies, or as the cached frames
+    # themselves for read-only callers (copy=False).
+    key = key or content_key(content)
+    with _lock:
+        tables = _memory.get(key)
+        if tables is not None:
+            _memory.move_to_end(key)
+        else:
+            loading = _loading.get(key)
+            owner = loading is None
+            if owner:
+                loading = _loading[key] = Future()
+    if tables is None and not owner:
+        # Parsed by another session : waiting for its result
+        tables = loading.result()
+    elif tables is None:
+        try:
+            tables = load_tables(key, content)
+        except BaseException as e:
+            with _lock:
+                del _loading[key]
+            loading.set_exception(e)
+            raise
+        with _lock:
+            del _loading[key]
+            _memory[key] = tables
+            while len(_memory) > MEMORY_MAX_ENTRIES:
+                _memory.popitem(last=False)
+        loading.set_result(tables)
+    return {
+        sheet_name: df.copy() if copy else df for sheet_name, df in tables.items()
+        if sheets is None or sheet_name in sheets
+    }
+
+def evict(key: str = None):
+    # Removing one processed file (or all of them) from both tiers
+    with _lock:
+        if key is None:
+            _memory.clear()
+            shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        else:
+            _memory.pop(key, None)
+            shutil.rmtree(entry_dir(key), ignore_errors=True)
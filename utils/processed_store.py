@@ -0,0 +1,262 @@
+import os
+import shutil
+from contextlib import contextmanager
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import utils.data_fetching as fetching
+import utils.match_schema as schema
+import utils.profiling as profiling
+import utils.xlsx_writer as xlsx
+
+STORE_DIR = "tmp/process_result"
+# Sheet name in the Excel export -> Parquet file in the store
+STORE_TABLES = {
+    "Matches": "matches.parquet",
+    "Ranking": "ranking.parquet",
+    "Countries and leagues": "countries_leagues.parquet",
+    "Ranking history": "ranking_history.parquet",
+    "Odds": "odds.parquet",
+}
+CATEGORICAL_COLUMNS = [
+    "Division", "Country", "League", "Team", "Teams", "Home Team", "Away Team",
+    "Full time result", "Half time result", "Season",
+]
+# Sheet name -> columns identifying a row : a new row replaces the stored one with the same keys
+TABLE_KEYS = {"Ranking history": ["Match Date", "League", "Team"]}
+# Part files of a table beyond which an append merges them into one
+MAX_TABLE_PARTS = 64
+
+def with_categories(df: pd.DataFrame) -> pd.DataFrame:
+    # Repeated names (teams, leagues,...) are stored once per table as dictionary-encoded columns
+    categorical = {col: "category" for col in CATEGORICAL_COLUMNS if col in df.columns and pd.api.types.is_string_dtype(df[col])}
+    return df.astype(categorical)
+
+def table_path(sheet_name: str, store_dir: str = STORE_DIR) -> str:
+    return os.path.join(store_dir, STORE_TABLES[sheet_name])
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def save_store(tables: dict[str, pd.DataFrame], store_dir: str = STORE_DIR):
+    os.makedirs(store_dir, exist_ok=True)
+    for sheet_name, df in tables.items():
+        path = table_path(sheet_name, store_dir)
+        with_categories(df).to_parquet(f"{path}.tmp", index=False)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(f"{path}.tmp", path)
+
+def arrow_schema(df: pd.DataFrame) -> pa.Schema:
+    # Types wide enough for every later chunk : counts may be missing (floats) or larger in other files
+    fields = []
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            fields.append(pa.field(col, pa.int32()))
+        elif pd.api.types.is_float_dtype(dtype):
+            fields.append(pa.field(col, pa.from_numpy_dtype(dtype)))
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            fields.append(pa.field(col, pa.timestamp("ns")))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+def matches_field_types() -> dict[str, pa.DataType]:
+    # Column (field or fullname) -> type, as read by schema.read_matches_csv : names as strings,
+    # counts as integers (nullable in Parquet), every other field (odds) as float32
+    header_mapping = fetching.header_mapping()
+    field_types = {field: pa.float32() for field in header_mapping}
+    field_types.update({field: pa.string() for field in schema.CATEGORY_FIELDS + schema.ADDED_COLUMNS})
+    field_types.update({field: pa.int32() for field in schema.INTEGER_FIELDS})
+    field_types["Date"] = pa.timestamp("ns")
+    types = dict(field_types)
+    # Fields sharing a fullname (e.g. FTAG and AG) : the type of a core field wins
+    for field, fullname in header_mapping.items():
+        if fullname not in types or field in schema.CORE_FIELDS:
+            types[fullname] = field_types[field]
+    return types
+
+def matches_arrow_schema(df: pd.DataFrame) -> pa.Schema:
+    # Types of the columns from their field rather than from the values of a chunk (all missing, counts
+    # read as floats because of a missing value,...) : the same in every part of the matches table.
+    # Columns of no field (new bookmakers, Elo,...) are typed from their values.
+    types = matches_field_types()
+    fallback = arrow_schema(df)
+    return pa.schema([pa.field(col, types.get(col, fallback.field(col).type)) for col in df.columns])
+
+def part_path(directory: str, number: int) -> str:
+    return os.path.join(directory, f"part-{number:05d}.parquet")
+
+@contextmanager
+def matches_writer(store_dir: str = STORE_DIR):
+    # Matches table written chunk by chunk, when the matches are streamed rather than held in memory.
+    # The table is a directory of part files : a chunk with other columns than the previous one (another league
+    # or season) starts a new part, and the parts are read back with the union of their columns.
+    os.makedirs(store_dir, exist_ok=True)
+    path = table_path("Matches", store_dir)
+    tmp_path = f"{path}.tmp"
+    remove_path(tmp_path)
+    os.makedirs(tmp_path)
+    writer = None
+    parts = 0
+
+    def append(chunk: pd.DataFrame):
+        nonlocal writer, parts
+        chunk = chunk.astype({col: object for col in chunk.columns if isinstance(chunk[col].dtype, pd.CategoricalDtype)})
+        chunk_schema = matches_arrow_schema(chunk)
+        if writer is None or not writer.schema.equals(chunk_schema):
+            if writer is not None:
+                writer.close()
+            writer = pq.ParquetWriter(part_path(tmp_path, parts), chunk_schema)
+            parts += 1
+        writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
+
+    try:
+        yield append
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pd.DataFrame().to_parquet(part_path(tmp_path, 0), index=False)
+    remove_path(path)
+    os.replace(tmp_path, path)
+
+def table_directory(path: str):
+    # A single file table turned into the first part of a directory, for parts to be added next to it
+    if os.path.isdir(path):
+        return
+    remove_path(f"{path}.tmp")
+    os.makedirs(f"{path}.tmp")
+    os.replace(path, part_path(f"{path}.tmp", 0))
+    os.replace(f"{path}.tmp", path)
+
+def write_part(df: pd.DataFrame, path: str, matches: bool = False):
+    if matches:
+        df = df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+        pq.write_table(pa.Table.from_pandas(df, schema=matches_arrow_schema(df), preserve_index=False), f"{path}.tmp")
+    else:
+        with_categories(df).to_parquet(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+
+def replace_rows(parts: list[str], df: pd.DataFrame, keys: list[str]):
+    # Stored rows with the keys of new rows removed, only the parts holding some of them being rewritten
+    new_keys = pd.MultiIndex.from_frame(df[keys].astype(object))
+    candidates = ds.field(keys[0]).isin(pa.array(df[keys[0]].drop_duplicates()))
+    for part in parts:
+        if not set(keys) <= set(pq.read_schema(part).names):
+            continue
+        stored_keys = ds.dataset(part, format="parquet").to_table(columns=keys, filter=candidates).to_pandas()
+        if not pd.MultiIndex.from_frame(stored_keys.astype(object)).isin(new_keys).any():
+            continue
+        stored = pd.read_parquet(part)
+        replaced = pd.MultiIndex.from_frame(stored[keys].astype(object)).isin(new_keys)
+        write_part(stored[~replaced], part)
+
+def append_table(sheet_name: str, df: pd.DataFrame, store_dir: str = STORE_DIR):
+    # New rows written as a new part file of a table : the rows already stored are not read again
+    # (except the keys of the parts that may hold rows they replace)
+    path = table_path(sheet_name, store_dir)
+    if not os.path.exists(path):
+        save_store({sheet_name: df}, store_dir)
+        return
+    table_directory(path)
+    parts = table_parts(path)
+    if sheet_name in TABLE_KEYS:
+        replace_rows(parts, df, TABLE_KEYS[sheet_name])
+    number = int(os.path.basename(parts[-1])[len("part-"):-len(".parquet")]) + 1 if parts else 0
+    write_part(df, part_path(path, number), matches=sheet_name == "Matches")
+    if len(parts) + 1 > MAX_TABLE_PARTS:
+        # Merged once in a while : reading a table does not open a file per refresh
+        merged = with_categories(table_dataset(sheet_name, store_dir).to_table().to_pandas())
+        write_part(merged, f"{path}.merged")
+        remove_path(path)
+        os.replace(f"{path}.merged", path)
+
+def store_exists(store_dir: str = STORE_DIR) -> bool:
+    return all(os.path.exists(os.path.join(store_dir, filename)) for filename in STORE_TABLES.values())
+
+def publish_store(source_dir: str, store_dir: str = STORE_DIR):
+    # Store of another run made the default one : copied next to it, then swapped in, so that readers
+    # never see a partly copied store. Fresh modification times : what was loaded from the replaced store is reloaded.
+    copy_dir = f"{store_dir}.{os.getpid()}.tmp"
+    old_dir = f"{store_dir}.{os.getpid()}.old"
+    remove_path(copy_dir)
+    shutil.copytree(source_dir, copy_dir, copy_function=shutil.copyfile)
+    if os.path.exists(store_dir):
+        os.replace(store_dir, old_dir)
+    os.replace(copy_dir, store_dir)
+    remove_path(old_dir)
+    # Teams file written next to the store
+    teams_path = os.path.join(os.path.dirname(source_dir), "team_country_league.csv")
+    if os.path.exists(teams_path):
+        published_path = os.path.join(os.path.dirname(store_dir), "team_country_league.csv")
+        shutil.copyfile(teams_path, f"{published_path}.tmp")
+        os.replace(f"{published_path}.tmp", published_path)
+
+def store_version(store_dir: str = STORE_DIR) -> float:
+    # Last modification of the store, used to invalidate what has been loaded from it
+    return max(os.path.getmtime(os.path.join(store_dir, filename)) for filename in STORE_TABLES.values())
+
+def table_parts(path: str) -> list[str]:
+    # A table is a single Parquet file, or a directory of part files
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".parquet"))
+
+def value_types(table_schema: pa.Schema) -> pa.Schema:
+    # Dictionary-encoded columns as their values, for parts encoding a column differently to be read together
+    return pa.schema([
+        pa.field(f.name, f.type.value_type if pa.types.is_dictionary(f.type) else f.type) for f in table_schema
+    ])
+
+def table_dataset(sheet_name: str, store_dir: str = STORE_DIR) -> ds.Dataset:
+    # Parts of a table read as one, with the union of their columns (missing ones being null)
+    parts = table_parts(table_path(sheet_name, store_dir))
+    parts_schema = pa.unify_schemas([value_types(pq.read_schema(part)) for part in parts], promote_options="permissive")
+    return ds.dataset(parts, schema=parts_schema, format="parquet")
+
+def load_table(sheet_name: str, store_dir: str = STORE_DIR, columns: list[str] = None) -> pd.DataFrame:
+    path = table_path(sheet_name, store_dir)
+    if not os.path.isdir(path):
+        return pd.read_parquet(path, columns=columns)
+    return with_categories(table_dataset(sheet_name, store_dir).to_table(columns=columns).to_pandas())
+
+def load_store(store_dir: str = STORE_DIR) -> dict[str, pd.DataFrame]:
+    return {sheet_name: load_table(sheet_name, store_dir) for sheet_name in STORE_TABLES}
+
+def table_batches(sheet_name: str, store_dir: str = STORE_DIR, columns: list[str] = None, batch_rows: int = xlsx.CHUNK_ROWS):
+    # Table read a row group slice at a time, for the exports that do not need it whole
+    for batch in table_dataset(sheet_name, store_dir).to_batches(columns=columns, batch_size=batch_rows):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+def table_columns(sheet_name: str, store_dir: str = STORE_DIR) -> list[str]:
+    # Read from the Parquet footers, without loading the table
+    return table_dataset(sheet_name, store_dir).schema.names
+
+def export_columns(sheet_name: str, store_dir: str = STORE_DIR, include_odds: bool = False) -> list[str] | None:
+    # Matches odds are only exported on request, the other tables are exported whole
+    if sheet_name != "Matches" or include_odds:
+        return None
+    columns = table_columns(sheet_name, store_dir)
+    odds = set(schema.odds_columns(columns, fetching.header_mapping()))
+    return [col for col in columns if col not in odds]
+
+def export_store_to_excel(
+        xlsx_path: str | BytesIO, store_dir: str = STORE_DIR,
+        report: profiling.RunReport = None, include_odds: bool = False
+    ) -> profiling.RunReport:
+    # Same workbook layout as the one the Power BI template expects, streamed from the store.
+    # The odds analytics sheet comes with the odds.
+    sheets = {
+        sheet_name: table_batches(sheet_name, store_dir, export_columns(sheet_name, store_dir, include_odds))
+        for sheet_name in STORE_TABLES if sheet_name != "Odds" or include_odds
+    }
+    return xlsx.write_workbook(xlsx_path, sheets, report)
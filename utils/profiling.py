@@ -0,0 +1,141 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Callable
+
+REPORTS_DIR = "tmp/run_reports"
+
+# tracemalloc is process-wide : started by the first run tracking memory, stopped by the last one
+# (left running if something else started it), concurrent runs sharing the same tracing
+_tracing_runs = 0
+_tracing_started = False
+_tracing_lock = threading.Lock()
+
+@contextmanager
+def memory_tracing():
+    global _tracing_runs, _tracing_started
+    with _tracing_lock:
+        if _tracing_runs == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started = True
+        _tracing_runs += 1
+    try:
+        yield
+    finally:
+        with _tracing_lock:
+            _tracing_runs -= 1
+            if _tracing_runs == 0 and _tracing_started:
+                tracemalloc.stop()
+                _tracing_started = False
+
+def reset_memory_peak():
+    # Peaks are only reset while a single run is traced : a concurrent run would lose the peak of its stage
+    with _tracing_lock:
+        if _tracing_runs == 1:
+            tracemalloc.reset_peak()
+
+@dataclass
+class StageRecord:
+    name: str
+    seconds: float = 0.0
+    rows_in: int = None
+    rows_out: int = None
+    peak_memory_mb: float = None
+    # Size of what the stage wrote, for the stages writing files
+    bytes_out: int = None
+
+@dataclass
+class RunReport:
+    # Wall time, rows in/out and (optionally) peak traced memory of every pipeline stage
+    name: str = "process"
+    track_memory: bool = False
+    profile: bool = False
+    on_stage_end: Callable[[StageRecord], None] = None
+    started_at: str = field(default_factory=lambda: datetime.now().isoformat(timespec="seconds"))
+    stages: list[StageRecord] = field(default_factory=list)
+    total_seconds: float = 0.0
+    profile_stats: str = None
+    _profiler: cProfile.Profile = field(default=None, init=False, repr=False)
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        record = StageRecord(name, rows_in=rows_in)
+        if self.track_memory:
+            reset_memory_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            if self.track_memory:
+                record.peak_memory_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            self.stages.append(record)
+            if self.on_stage_end is not None:
+                self.on_stage_end(record)
+
+    @contextmanager
+    def run(self):
+        # Whole run, with memory tracing and cProfile capture when requested
+        with memory_tracing() if self.track_memory else nullcontext():
+            profiler = cProfile.Profile() if self.profile else None
+            if profiler is not None:
+                profiler.enable()
+            start = time.perf_counter()
+            try:
+                yield self
+            finally:
+                self.total_seconds = time.perf_counter() - start
+                if profiler is not None:
+                    profiler.disable()
+                    self.profile_stats = profile_summary(profiler)
+                    self._profiler = profiler
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_seconds": self.total_seconds,
+            "stages": [asdict(record) for record in self.stages],
+            "profile": self.profile_stats,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def save(self, reports_dir: str = REPORTS_DIR) -> str:
+        # JSON report, plus the raw cProfile dump (readable with pstats or snakeviz) when profiled
+        os.makedirs(reports_dir, exist_ok=True)
+        stamp = self.started_at.replace(":", "-")
+        path = os.path.join(reports_dir, f"{self.name}_{stamp}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_json())
+        if self._profiler is not None:
+            self._profiler.dump_stats(os.path.join(reports_dir, f"{self.name}_{stamp}.prof"))
+        return path
+
+def profile_summary(profiler: cProfile.Profile, limit: int = 30) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
+
+def throughput(record: StageRecord) -> dict:
+    # Rows and megabytes written per second, for the stages which report them
+    if not record.seconds:
+        return {}
+    rates = {}
+    if record.rows_out is not None:
+        rates["rows_per_second"] = record.rows_out / record.seconds
+    if record.bytes_out is not None:
+        rates["mb_per_second"] = record.bytes_out / 1024 ** 2 / record.seconds
+    return rates
+
+def stages_table(report: RunReport) -> list[dict]:
+    return [{**asdict(record), **throughput(record)} for record in report.stages]
@@ -1,45 +1,66 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
 from typing import Literal
-from io import BytesIO
 
+import numpy as np
 import pandas as pd
-from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 import utils.data_fetching as fetching
-
-def get_leagues_list(leagues_sources_path: str):
-    df = pd.read_csv(leagues_sources_path)
-    return list(df["League"])
-
-def map_fullname_columns(matches_dataset: pd.DataFrame):
-    header_dictionary = pd.read_csv("data_mapping/header_dictionary.csv")
-    header_mapping = dict(zip(header_dictionary["Field"], header_dictionary["Fullname"]))
-    matches_dataset.rename(columns=header_mapping, inplace=True)
-
-def create_ranking(matches: pd.DataFrame, at_home: bool) -> pd.DataFrame:
+import utils.mapping_registry as registry
+import utils.match_warehouse as warehouse
+import utils.odds_analytics as odds_analytics
+import utils.processed_store as store
+import utils.profiling as profiling
+import utils.ranking_series as ranking_series
+import utils.team_index as team_index
+
+def get_leagues_list(leagues_sources_path: str = registry.LEAGUES_SOURCES_PATH):
+    return list(registry.leagues_sources(leagues_sources_path).leagues)
+
+RESULT_MAPPING = {
+    "Home": {"H": "Win", "D": "Draw", "A": "Loss"},
+    "Away": {"H": "Loss", "D": "Draw", "A": "Win"},
+}
+
+# Ranking stat -> (column read for the home team, column read for the away team)
+SIDE_STATS_COLUMNS = {
+    "Goals": ("Full time home team goals", "Full time away team goals"),
+    "Conceded": ("Full time away team goals", "Full time home team goals"),
+    "Shots": ("Home Team Shots", "Away Team Shots"),
+    "Shots conceded": ("Away Team Shots", "Home Team Shots"),
+    "Shots on target": ("Home Team Shots on Target", "Away Team Shots on Target"),
+}
+
+def team_matches_table(matches: pd.DataFrame) -> pd.DataFrame:
+    # Reshaping matches once into a team-centric table : one row per team per match played
+    sides = []
+    for side, team_col in (("Home", "Home Team"), ("Away", "Away Team")):
+        stat_idx = 0 if side == "Home" else 1
+        side_matches = pd.DataFrame({
+            "Team": matches[team_col].to_numpy(),
+            "Side": side,
+            "Match Date": matches["Match Date"].to_numpy(),
+            "Result": matches["Full time result"].map(RESULT_MAPPING[side]).to_numpy(),
+        })
+        for stat, columns in SIDE_STATS_COLUMNS.items():
+            side_matches[stat] = matches[columns[stat_idx]].to_numpy()
+        sides.append(side_matches)
+    return pd.concat(sides, axis="index", ignore_index=True)
+
+def results_ranking(team_matches: pd.DataFrame) -> pd.DataFrame:
     # Creating a ranking from matches that happened between two dates
     # NB : Win = 3 points, Draw = 1 point, Loss = 0 point
-
-    col = "Home Team" if at_home else "Away Team"
-    result_mapping = {
-        "H": "Win" if at_home else "Loss",
-        "D": "Draw",
-        "A": "Loss" if at_home else "Win",
-    }
-
-    results = matches.groupby([col, "Full time result"])["Match Date"].count().reset_index()
-    results = results.pivot(index=col, columns="Full time result", values="Match Date")
-    results = results.rename(columns=result_mapping)
-    results = results.fillna(0)
-    results = results[["Win", "Draw", "Loss"]]
+    results = team_matches.groupby(["Team", "Result"]).size().unstack("Result", fill_value=0)
+    results = results.reindex(columns=["Win", "Draw", "Loss"], fill_value=0)
+    results.columns.name = None
     results["Points"] = results["Win"] * 3 + results["Draw"] * 1
     return results
 
 def create_overall_ranking(matches: pd.DataFrame) -> pd.DataFrame:
-    home_ranking = create_ranking(matches, True)
-    away_ranking = create_ranking(matches, False)
-    combined = pd.concat([home_ranking, away_ranking], axis="index")
-    return combined.groupby(combined.index).sum()
+    return results_ranking(team_matches_table(matches))
 
 def reindexing_ranking(ranking: pd.DataFrame):
     ranking.index.name = "Teams"
@@ -59,151 +80,224 @@ def form_consistency_indicator(results: list[Literal["H", "D", "A"]]) -> float:
     possible_switches = len(results) - 1
     return 1-(variation/possible_switches)
 
-def team_side_consistency(matches: pd.DataFrame, team_name: str, at_home: bool = True):
-    col_team = "Home Team" if at_home else "Away Team"
-    team_matches = matches[matches[col_team] == team_name]
-    team_matches = team_matches.sort_values(by="Match Date", ascending=True)
-    return form_consistency_indicator(list(team_matches["Full time result"]))
-
-def team_all_consistency(matches: pd.DataFrame, team_name: str):
-    def team_result(team_name: str, home_team: str, ftresult: str):
-        inverted_result = {
-            'H': 'A',
-            'D': 'D',
-            'A': 'H',
-        }
-        if team_name != home_team:
-            return inverted_result[ftresult]
-        return ftresult
-    team_matches = matches[(matches["Home Team"] == team_name) | (matches["Away Team"] == team_name)]
-    team_matches = team_matches.sort_values(by="Match Date", ascending=True)
-    team_matches["TeamResult"] = team_matches.apply(
-        lambda row: team_result(team_name, row["Home Team"], row["Full time result"]),
-    axis=1
-    )
-    return form_consistency_indicator(list(team_matches["TeamResult"]))
-
-def team_consistency(
-        matches: pd.DataFrame, team_name: str, side: Literal['home', 'away'] = None):
-    if side == 'home':
-        return team_side_consistency(matches, team_name, at_home=True)
-    elif side == 'away':
-        return team_side_consistency(matches, team_name, at_home=False)
-    return team_all_consistency(matches, team_name)
-
-def add_consistency_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    ranking["Consistency - Home"] = ranking.index.map(lambda name: team_consistency(matches, name, side="home"))
-    ranking["Consistency - Away"] = ranking.index.map(lambda name: team_consistency(matches, name, side="away"))
-    ranking["Consistency - All"] = ranking.index.map(lambda name: team_consistency(matches, name))
-
-def team_side_goals(matches: pd.DataFrame, team_name: str, at_home: bool = True) -> int:
-    col_team = "Home Team" if at_home else "Away Team"
-    team_matches = matches[matches[col_team] == team_name]
-    col_goals = "Full time home team goals" if at_home else "Full time away team goals"
-    return int(team_matches[col_goals].sum())
-
-def add_goals_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    ranking["Goals - Home"] = ranking.index.map(lambda name: team_side_goals(matches, name, at_home=True))
-    ranking["Goals - Away"] = ranking.index.map(lambda name: team_side_goals(matches, name, at_home=False))
-    ranking["Goals - All"] = ranking.apply(lambda row: row["Goals - Home"] + row["Goals - Away"], axis=1)
-
-def team_side_conceded(matches: pd.DataFrame, team_name: str, at_home: bool = True) -> int:
-    col_team = "Home Team" if at_home else "Away Team"
-    team_matches = matches[matches[col_team] == team_name]
-    col_goals = "Full time away team goals" if at_home else "Full time home team goals"
-    return int(team_matches[col_goals].sum())
-
-def add_conceded_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    ranking["Conceded - Home"] = ranking.index.map(lambda name: team_side_conceded(matches, name, at_home=True))
-    ranking["Conceded - Away"] = ranking.index.map(lambda name: team_side_conceded(matches, name, at_home=False))
-    ranking["Conceded - All"] = ranking.apply(lambda row: row["Conceded - Home"] + row["Conceded - Away"], axis=1)
-
-def team_side_shots(matches: pd.DataFrame, team_name: str, at_home: bool = True) -> int:
-    col_team = "Home Team" if at_home else "Away Team"
-    team_matches = matches[matches[col_team] == team_name]
-    col_shots = "Home Team Shots" if at_home else "Away Team Shots"
-    return int(team_matches[col_shots].sum())
-
-def add_shots_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    ranking["Shots - Home"] = ranking.index.map(lambda name: team_side_shots(matches, name, at_home=True))
-    ranking["Shots - Away"] = ranking.index.map(lambda name: team_side_shots(matches, name, at_home=False))
-    ranking["Shots - All"] = ranking.apply(lambda row: row["Shots - Home"] + row["Shots - Away"], axis=1)
-
-def team_side_shots_conceded(matches: pd.DataFrame, team_name: str, at_home: bool = True) -> int:
-    col_team = "Home Team" if at_home else "Away Team"
-    team_matches = matches[matches[col_team] == team_name]
-    col_shots = "Away Team Shots" if at_home else "Home Team Shots"
-    return int(team_matches[col_shots].sum())
-
-def add_shots_conceded_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    ranking["Shots conceded - Home"] = ranking.index.map(lambda name: team_side_shots_conceded(matches, name, at_home=True))
-    ranking["Shots conceded - Away"] = ranking.index.map(lambda name: team_side_shots_conceded(matches, name, at_home=False))
-    ranking["Shots conceded - All"] = ranking.apply(lambda row: row["Shots conceded - Home"] + row["Shots conceded - Away"], axis=1)
-
-def team_side_target(matches: pd.DataFrame, team_name: str, at_home: bool = True) -> int:
-    col_team = "Home Team" if at_home else "Away Team"
-    team_matches = matches[matches[col_team] == team_name]
-    col_target = "Home Team Shots on Target" if at_home else "Away Team Shots on Target"
-    return int(team_matches[col_target].sum())
-
-def add_target_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    ranking["Shots on target - Home"] = ranking.index.map(lambda name: team_side_target(matches, name, at_home=True))
-    ranking["Shots on target - Away"] = ranking.index.map(lambda name: team_side_target(matches, name, at_home=False))
-    ranking["Shots on target - All"] = ranking.apply(lambda row: row["Shots on target - Home"] + row["Shots on target - Away"], axis=1)
-
-def elo(elo_dataset: pd.DataFrame, team_name: str):
-    team_elos = elo_dataset[elo_dataset["Club"] == team_name]
-    team_elos = team_elos.sort_values("From", ascending=False)
-    res = team_elos["Elo"].iloc[0]
+def sort_team_matches(team_matches: pd.DataFrame) -> pd.DataFrame:
+    # Chronological sequence of matches for each team, sorted once for all consistency variants
+    return team_matches.sort_values(["Team", "Match Date"], kind="stable", ignore_index=True)
+
+def group_consistency(ordered: pd.DataFrame, keys: list[str], last_n: int = None) -> pd.Series:
+    # Same indicator as form_consistency_indicator, computed for every group with shifted comparisons
+    if last_n is not None:
+        ordered = ordered.groupby(keys, sort=False).tail(last_n)
+    previous = ordered.groupby(keys, sort=False)["Result"].shift()
+    changes = previous.notna() & (previous != ordered["Result"])
+    counts = changes.groupby([ordered[key] for key in keys]).agg(["sum", "size"])
+    possible_switches = counts["size"] - 1
+    return (1 - counts["sum"] / possible_switches).where(possible_switches > 0)
+
+def previous_consistency(ordered: pd.DataFrame, keys: list[str], last_n: int = None) -> pd.Series:
+    # Same indicator again, before every match of ordered : over the previous matches of its group only
+    # (the last_n previous ones if given), aligned on the rows of ordered
+    groups = [ordered[key] for key in keys]
+    previous = ordered.groupby(keys, sort=False)["Result"].shift()
+    changes = (previous.notna() & (previous != ordered["Result"])).astype(int)
+    cumulative = changes.groupby(groups, sort=False).cumsum()
+    played = ordered.groupby(keys, sort=False).cumcount()
+    before = cumulative.groupby(groups, sort=False).shift(1).fillna(0)
+    window = played if last_n is None else np.minimum(played, last_n)
+    # Changes before the first match of the window are not counted
+    start = cumulative.groupby(groups, sort=False).shift(last_n).fillna(0) if last_n is not None else 0
+    start = np.where(played > window, start, 0)
+    possible_switches = window - 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (1 - (before - start) / possible_switches).where(possible_switches > 0)
+
+def consistency_table(team_matches: pd.DataFrame, last_n: int = None, ordered: bool = False) -> pd.DataFrame:
+    # Home, away and all-sides consistency per team, optionally over the last N matches of each sequence
+    if not ordered:
+        team_matches = sort_team_matches(team_matches)
+    sides = group_consistency(team_matches, ["Team", "Side"], last_n).unstack("Side")
+    res = pd.DataFrame(index=sides.index)
+    res["Home"] = sides["Home"] if "Home" in sides else None
+    res["Away"] = sides["Away"] if "Away" in sides else None
+    res["All"] = group_consistency(team_matches, ["Team"], last_n)
     return res
 
+def add_consistency_columns(ranking: pd.DataFrame, team_matches: pd.DataFrame, windows: tuple[int, ...] = ()):
+    ordered = sort_team_matches(team_matches)
+    consistency = consistency_table(ordered, ordered=True).reindex(ranking.index)
+    for side in ("Home", "Away", "All"):
+        ranking[f"Consistency - {side}"] = consistency[side]
+    # Rolling variants : consistency over the last N matches (home, away or all)
+    for last_n in windows:
+        consistency = consistency_table(ordered, last_n, ordered=True).reindex(ranking.index)
+        for side in ("Home", "Away", "All"):
+            ranking[f"Consistency (last {last_n}) - {side}"] = consistency[side]
+
+def side_stats_ranking(team_matches: pd.DataFrame) -> pd.DataFrame:
+    # Summing every stat per team and side in a single grouped pass
+    stats = list(SIDE_STATS_COLUMNS)
+    sums = team_matches.groupby(["Team", "Side"])[stats].sum().unstack("Side", fill_value=0)
+    sums = sums.reindex(columns=pd.MultiIndex.from_product([stats, ["Home", "Away"]]), fill_value=0)
+    res = pd.DataFrame(index=sums.index)
+    for stat in stats:
+        res[f"{stat} - Home"] = sums[(stat, "Home")].astype(int)
+        res[f"{stat} - Away"] = sums[(stat, "Away")].astype(int)
+        res[f"{stat} - All"] = res[f"{stat} - Home"] + res[f"{stat} - Away"]
+    return res
+
+def add_side_stats_columns(ranking: pd.DataFrame, team_matches: pd.DataFrame):
+    # Goals, conceded, shots, shots conceded and shots on target columns
+    stats = side_stats_ranking(team_matches).reindex(ranking.index, fill_value=0)
+    for col in stats.columns:
+        ranking[col] = stats[col]
+
 def add_elo_column(ranking: pd.DataFrame, elo_dataset: pd.DataFrame):
-    ranking["Elo"] = ranking.index.map(lambda name: elo(elo_dataset, name))
-
-def add_country_league_columns(ranking: pd.DataFrame, matches: pd.DataFrame):
-    home_team_country_league = matches[["Home Team", "Country", "League"]]
-    home_team_country_league = home_team_country_league.rename({"Home Team": "Team"}, axis="columns")
-    away_team_country_league = matches[["Away Team", "Country", "League"]]
-    away_team_country_league = away_team_country_league.rename({"Away Team": "Team"}, axis="columns")
-
-    team_country_league = pd.concat([home_team_country_league, away_team_country_league], axis="index", ignore_index=True)
-    team_country_league.drop_duplicates(inplace=True)
-    country_mapping = dict(zip(team_country_league["Team"], team_country_league["Country"]))
-    league_mapping = dict(zip(team_country_league["Team"], team_country_league["League"]))
-    
-    ranking["Country"] = ranking.index.map(lambda x: country_mapping[x])
-    ranking["League"] = ranking.index.map(lambda x: league_mapping[x])
-    
-    return team_country_league
+    ranking["Elo"] = ranking.index.map(fetching.latest_elo_index(elo_dataset))
+
+def add_country_league_columns(ranking: pd.DataFrame, team_country_league: pd.DataFrame):
+    attributes = team_index.teams_attributes(team_country_league)
+    ranking["Country"] = ranking.index.map(attributes["Country"])
+    ranking["League"] = ranking.index.map(attributes["League"])
+
+def league_partitions(team_matches: pd.DataFrame, matches: pd.DataFrame) -> list[pd.DataFrame]:
+    # Team matches split by league, in league order. A team found in several selected leagues (promotion,
+    # relegation) is kept in a single partition, so that its result sequences are never split.
+    team_league = team_index.teams_table(matches).drop_duplicates("Team")
+    labels = team_matches["Team"].map(dict(zip(team_league["Team"], team_league["League"])))
+    return [partition for _, partition in team_matches.groupby(labels, sort=True)]
+
+def partition_ranking(team_matches: pd.DataFrame, consistency_windows: tuple[int, ...]) -> pd.DataFrame:
+    # Ranking, consistency and stats columns of independent teams, run in a worker process
+    ranking = results_ranking(team_matches)
+    reindexing_ranking(ranking)
+    add_consistency_columns(ranking, team_matches, consistency_windows)
+    add_side_stats_columns(ranking, team_matches)
+    return ranking
+
+def parallel_ranking(
+        team_matches: pd.DataFrame, matches: pd.DataFrame,
+        consistency_windows: tuple[int, ...], workers: int
+    ) -> pd.DataFrame:
+    partitions = league_partitions(team_matches, matches)
+    # Workers spawned, not forked : the pool is started from the threads of the app jobs
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(workers, len(partitions))), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        rankings = list(executor.map(partition_ranking, partitions, repeat(consistency_windows)))
+    # Merged in the same team order as the single process ranking, whatever the completion order
+    return pd.concat(rankings, axis="index").sort_index()
+
+def fetch_all_matches() -> pd.DataFrame:
+    df_matches = fetching.fetch_matches_data()
+    fetching.map_fullname_columns(df_matches)
+    return df_matches
 
 def process_input_data(
         leagues_to_keep: list[str],
-        from_date: datetime, to_date: datetime
-    ):
-    df_matches = fetching.fetch_matches_data()
-    map_fullname_columns(df_matches)
-
-    df_matches = df_matches[df_matches["League"].isin(leagues_to_keep)]
-    df_matches = df_matches[df_matches["Match Date"].between(from_date, to_date)]
-
-    df_elo = fetching.fetch_elo_data()
-    fetching.pre_process_elo_data(df_elo, df_matches)
-    df_elo = df_elo[df_elo["League"].isin(leagues_to_keep)]
-
-    ranking = create_overall_ranking(df_matches)
-    reindexing_ranking(ranking)
-    add_consistency_columns(ranking, df_matches)
-    add_goals_columns(ranking, df_matches)
-    add_conceded_columns(ranking, df_matches)
-    add_shots_columns(ranking, df_matches)
-    add_shots_conceded_columns(ranking, df_matches)
-    add_target_columns(ranking, df_matches)
-    add_elo_column(ranking, df_elo)
-    team_country_league = add_country_league_columns(ranking, df_matches)
-
-    with pd.ExcelWriter("tmp/process_result.xlsx", mode="w") as writer:
-        df_matches.to_excel(writer, sheet_name="Matches", index=False)
-        ranking.to_excel(writer, sheet_name="Ranking")
-        team_country_league.to_excel(writer, sheet_name="Countries and leagues", index=False)
-
-    team_country_league.to_csv("tmp/team_country_league.csv", index=False)
\ No newline at end of file
+        from_date: datetime, to_date: datetime,
+        consistency_windows: tuple[int, ...] = (),
+        store_dir: str = store.STORE_DIR,
+        use_warehouse: bool = False,
+        historical_elo: bool = False,
+        all_matches: pd.DataFrame = None,
+        elo: pd.DataFrame = None,
+        report: profiling.RunReport = None,
+        workers: int = 1
+    ) -> profiling.RunReport:
+    # all_matches and elo can be given to share one download between several runs.
+    # With workers > 1, the ranking of every league is computed in a pool of worker processes.
+    report = report or profiling.RunReport()
+    with report.run():
+        if use_warehouse:
+            # Matches already ingested in the local warehouse, filtered while reading
+            with report.stage("Load warehouse matches") as stage:
+                df_matches = warehouse.load_matches(leagues_to_keep, from_date, to_date)
+                stage.rows_out = len(df_matches)
+        else:
+            if all_matches is None:
+                with report.stage("Fetch matches") as stage:
+                    all_matches = fetching.fetch_matches_data()
+                    stage.rows_out = len(all_matches)
+                with report.stage("Map fullname columns", len(all_matches)) as stage:
+                    fetching.map_fullname_columns(all_matches)
+                    stage.rows_out = len(all_matches)
+
+            with report.stage("Filter matches", len(all_matches)) as stage:
+                df_matches = all_matches[all_matches["League"].isin(leagues_to_keep)]
+                df_matches = df_matches[df_matches["Match Date"].between(from_date, to_date)]
+                stage.rows_out = len(df_matches)
+
+        with report.stage("Teams", len(df_matches)) as stage:
+            # Countries and leagues of the teams, for every lookup of the run
+            team_country_league = team_index.teams_table(df_matches)
+            stage.rows_out = len(team_country_league)
+
+        if elo is None and use_warehouse:
+            # Ratings saved with the warehouse : no network access
+            with report.stage("Load warehouse Elo") as stage:
+                elo = warehouse.load_elo()
+                stage.rows_out = len(elo)
+        elif elo is None:
+            with report.stage("Fetch Elo") as stage:
+                elo = fetching.fetch_elo_data()
+                stage.rows_out = len(elo)
+        with report.stage("Elo preprocessing", len(elo)) as stage:
+            df_elo = elo.copy()
+            fetching.pre_process_elo_data(df_elo, team_country_league)
+            df_elo = df_elo[df_elo["League"].isin(leagues_to_keep)]
+            stage.rows_out = len(df_elo)
+
+        if historical_elo:
+            # Elo of both teams at kickoff, added to every match
+            with report.stage("Historical Elo", len(df_matches)) as stage:
+                teams = sorted(set(df_matches["Home Team"]) | set(df_matches["Away Team"]))
+                elo_history = fetching.fetch_elo_history(fetching.elo_club_names(teams))
+                fetching.pre_process_elo_data(elo_history, team_country_league)
+                df_matches = df_matches.copy()
+                fetching.add_match_elo_columns(df_matches, elo_history)
+                stage.rows_out = len(df_matches)
+
+        if workers > 1:
+            with report.stage(f"Ranking, consistency, goals and shots ({workers} workers)", len(df_matches)) as stage:
+                team_matches = team_matches_table(df_matches)
+                ranking = parallel_ranking(team_matches, df_matches, consistency_windows, workers)
+                stage.rows_out = len(ranking)
+        else:
+            with report.stage("Ranking", len(df_matches)) as stage:
+                team_matches = team_matches_table(df_matches)
+                ranking = results_ranking(team_matches)
+                reindexing_ranking(ranking)
+                stage.rows_out = len(ranking)
+            with report.stage("Consistency", len(team_matches)) as stage:
+                add_consistency_columns(ranking, team_matches, consistency_windows)
+                stage.rows_out = len(ranking)
+            with report.stage("Goals and shots", len(team_matches)) as stage:
+                add_side_stats_columns(ranking, team_matches)
+                stage.rows_out = len(ranking)
+        with report.stage("Elo column", len(df_elo)) as stage:
+            add_elo_column(ranking, df_elo)
+            stage.rows_out = len(ranking)
+        with report.stage("Countries and leagues", len(team_country_league)) as stage:
+            add_country_league_columns(ranking, team_country_league)
+            stage.rows_out = len(ranking)
+        with report.stage("Ranking history", len(df_matches)) as stage:
+            # League tables after every matchday, for the trend visuals
+            history = ranking_series.ranking_history(df_matches)
+            stage.rows_out = len(history)
+        with report.stage("Odds", len(df_matches)) as stage:
+            # Best prices, market probabilities and margins of every match
+            odds = odds_analytics.odds_table(df_matches)
+            stage.rows_out = len(odds)
+
+        with report.stage("Store write", len(df_matches) + len(ranking)) as stage:
+            store.save_store({
+                "Matches": df_matches,
+                "Ranking": ranking.reset_index(),
+                "Countries and leagues": team_country_league,
+                "Ranking history": history,
+                "Odds": odds,
+            }, store_dir)
+
+            # Next to the store (tmp/ by default), so that runs with their own store do not share it
+            team_country_league.to_csv(os.path.join(os.path.dirname(store_dir), "team_country_league.csv"), index=False)
+    return report
@@ -0,0 +1,190 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import utils.data_fetching as fetching
+import utils.match_schema as schema
+import utils.ranking as ranking
+
+# Running totals of every team, in this order in the cumulative tables (side stats as in ranking.SIDE_STATS_COLUMNS)
+RESULT_STATS = ["Played", "Win", "Draw", "Loss", "Points"]
+SIDE_STATS = ["Goals", "Conceded", "Shots", "Shots conceded", "Shots on target"]
+SERIES_STATS = RESULT_STATS + SIDE_STATS
+# Matches columns the series are built from
+SERIES_COLUMNS = [
+    "Match Date", "League", "Home Team", "Away Team", "Full time result",
+    "Full time home team goals", "Full time away team goals",
+    "Home Team Shots", "Away Team Shots", "Home Team Shots on Target", "Away Team Shots on Target",
+]
+# Position in a league table : points, then goal difference, then goals scored
+POSITION_ORDER = ["Points", "Goal difference", "Goals"]
+# Seasons start in July (Football-Data.co.uk seasons run from August to May)
+SEASON_START_MONTH = 7
+
+def day_number(date) -> int:
+    return int(np.datetime64(pd.Timestamp(date).tz_localize(None).normalize(), "D").astype(np.int64))
+
+def season_start_years(dates: pd.Series) -> np.ndarray:
+    dates = pd.DatetimeIndex(dates)
+    return (dates.year - (dates.month < SEASON_START_MONTH)).to_numpy()
+
+def season_start(date) -> pd.Timestamp:
+    date = pd.Timestamp(date)
+    return pd.Timestamp(date.year - (date.month < SEASON_START_MONTH), SEASON_START_MONTH, 1)
+
+@dataclass
+class RankingSeries:
+    # Cumulative stats of every (league, season, team) after each of its matchdays, sorted by entry then day :
+    # totals start again every season, a team only being in the tables of the seasons it has played.
+    # The ranking of any period is the difference of two lookups in these tables, one binary search per team.
+    # (League, Season start year, Team) of every entry, entries being numbered in this order
+    entries: pd.DataFrame
+    # Entry, day number and cumulative stats of every row
+    codes: np.ndarray
+    days: np.ndarray
+    cumulative: np.ndarray
+    # Search keys : entry * span + days since the first matchday
+    first_day: int
+    span: int
+    keys: np.ndarray
+
+    def totals(self, date, inclusive: bool = True) -> np.ndarray:
+        # Cumulative stats of every entry on a date (or just before it), zero before its first match
+        day = day_number(date) - (0 if inclusive else 1)
+        offset = np.clip(day - self.first_day, -1, self.span - 2)
+        entries = np.arange(len(self.entries))
+        rows = np.searchsorted(self.keys, entries * self.span + offset, side="right") - 1
+        found = (rows >= 0) & (self.codes[np.maximum(rows, 0)] == entries)
+        return np.where(found[:, None], self.cumulative[np.maximum(rows, 0)], 0)
+
+    def last_day(self) -> pd.Timestamp:
+        return pd.Timestamp(np.datetime64(int(self.days.max()) if len(self.days) else 0, "D"))
+
+    def between(self, start=None, end=None) -> pd.DataFrame:
+        # League tables of the matches played from start to end (both included), whole series by default.
+        # A period over several seasons adds up the seasons of every team.
+        totals = self.totals(end if end is not None else pd.Timestamp.max)
+        if start is not None:
+            totals = totals - self.totals(start, inclusive=False)
+        table = pd.concat([self.entries, pd.DataFrame(totals, columns=SERIES_STATS)], axis="columns")
+        table = table[table["Played"] > 0]
+        table = table.groupby(["League", "Team"], sort=False, as_index=False)[SERIES_STATS].sum()
+        return league_positions(table).set_index(["League", "Team"])
+
+    def as_of(self, date=None) -> pd.DataFrame:
+        # League tables of the season of a date (the last matchday by default), after the matches of that date
+        date = date if date is not None else self.last_day()
+        return self.between(season_start(date), date)
+
+    def matchday_table(self, start=None, end=None) -> pd.DataFrame:
+        # Long format table for the dashboard : every league table after each matchday of the league,
+        # with the teams that have played since the start of the season
+        entry_days = pd.DataFrame({"Entry": self.codes, "Day": self.days})
+        entry_days["League"] = self.entries["League"].to_numpy()[self.codes]
+        entry_days["Season"] = self.entries["Season"].to_numpy()[self.codes]
+        league_days = entry_days[["League", "Season", "Day"]].drop_duplicates()
+        if start is not None:
+            league_days = league_days[league_days["Day"] >= day_number(start)]
+        if end is not None:
+            league_days = league_days[league_days["Day"] <= day_number(end)]
+        entry_start = entry_days.groupby("Entry", sort=True)["Day"].min()
+        league_entries = pd.DataFrame({
+            "League": self.entries["League"].to_numpy(), "Season": self.entries["Season"].to_numpy(),
+            "Entry": np.arange(len(self.entries)), "First day": entry_start.to_numpy(),
+        })
+        grid = league_days.merge(league_entries, on=["League", "Season"])
+        grid = grid[grid["First day"] <= grid["Day"]]
+
+        # One binary search per (matchday, entry) : latest cumulative row of the entry up to that day
+        entries, days = grid["Entry"].to_numpy(), grid["Day"].to_numpy()
+        rows = np.searchsorted(self.keys, entries * self.span + (days - self.first_day), side="right") - 1
+        table = pd.DataFrame(self.cumulative[rows], columns=SERIES_STATS)
+        table.insert(0, "Match Date", days.astype("datetime64[D]").astype("datetime64[ns]"))
+        table.insert(1, "League", grid["League"].to_numpy())
+        seasons = grid["Season"].to_numpy()
+        season_codes = {year: fetching.season_code(year) for year in np.unique(seasons)}
+        table.insert(2, "Season", pd.Series(seasons).map(season_codes).to_numpy())
+        table.insert(3, "Team", self.entries["Team"].to_numpy()[entries])
+        table = league_positions(table, ["Match Date"])
+        table = table.sort_values(["League", "Match Date", "Position"], kind="stable", ignore_index=True)
+        return compact_table(table)
+
+def league_positions(table: pd.DataFrame, keys: list[str] = None) -> pd.DataFrame:
+    keys = ["League"] + (keys or [])
+    table = table.copy()
+    table["Goal difference"] = table["Goals"] - table["Conceded"]
+    ordered = table.sort_values(keys + POSITION_ORDER, ascending=[True] * len(keys) + [False] * len(POSITION_ORDER), kind="stable")
+    table["Position"] = ordered.groupby(keys, sort=False).cumcount() + 1
+    return table
+
+def compact_table(table: pd.DataFrame) -> pd.DataFrame:
+    # Repeated names as categories, counts in the smallest integer type holding them
+    counts = {
+        col: schema.smallest_integer_type(table[col].min(), table[col].max()) if len(table) else np.int8
+        for col in table.columns if pd.api.types.is_integer_dtype(table[col])
+    }
+    names = {col: "category" for col in ("League", "Season", "Team") if col in table.columns}
+    return table.astype({**names, **counts})
+
+def series_increments(matches: pd.DataFrame) -> pd.DataFrame:
+    # Stats of every team match, with the (league, season, team) entry and the day number it counts for
+    team_matches = ranking.team_matches_table(matches)
+    team_matches["League"] = np.concatenate([matches["League"].to_numpy()] * 2)
+    results = team_matches["Result"]
+    increments = pd.DataFrame({
+        "League": team_matches["League"].astype(object),
+        "Season": season_start_years(team_matches["Match Date"]),
+        "Team": team_matches["Team"].astype(object),
+        "Day": team_matches["Match Date"].to_numpy().astype("datetime64[D]").astype(np.int64),
+        "Played": 1,
+        "Win": (results == "Win").astype(int),
+        "Draw": (results == "Draw").astype(int),
+        "Loss": (results == "Loss").astype(int),
+    })
+    increments["Points"] = increments["Win"] * 3 + increments["Draw"]
+    for stat in SIDE_STATS:
+        increments[stat] = team_matches[stat].fillna(0).astype(int).to_numpy()
+    return increments
+
+def series_from_increments(increments: pd.DataFrame) -> RankingSeries:
+    # Increments sorted once by (league, season, team, day), then accumulated per entry
+    daily = increments.groupby(["League", "Season", "Team", "Day"], sort=True)[SERIES_STATS].sum()
+    cumulative = daily.groupby(level=["League", "Season", "Team"], sort=False).cumsum()
+
+    entries = daily.index.droplevel("Day").unique().to_frame(index=False)
+    codes = pd.MultiIndex.from_frame(entries).get_indexer(daily.index.droplevel("Day"))
+    days = daily.index.get_level_values("Day").to_numpy()
+    first_day = int(days.min()) if len(days) else 0
+    span = int(days.max()) - first_day + 2 if len(days) else 2
+    return RankingSeries(
+        entries=entries, codes=codes, days=days, cumulative=cumulative.to_numpy(dtype=np.int64),
+        first_day=first_day, span=span, keys=codes.astype(np.int64) * span + (days - first_day),
+    )
+
+def build_series(matches: pd.DataFrame) -> RankingSeries:
+    return series_from_increments(series_increments(matches))
+
+def season_totals(matches: pd.DataFrame) -> pd.DataFrame:
+    # (League, Season, Team) -> stats of the matches, the running totals a later history update starts from
+    return series_increments(matches).groupby(["League", "Season", "Team"])[SERIES_STATS].sum()
+
+def history_update(totals: pd.DataFrame, last_dates: dict[str, str], new_matches: pd.DataFrame) -> pd.DataFrame:
+    # Tables of the matchdays of the new matches only, as stored in the "Ranking history" table.
+    # totals : season totals of the matches already absorbed, each one counted on the last absorbed date of its
+    # league (last_dates) : the tables of a matchday partly absorbed before are computed again, whole.
+    increments = series_increments(new_matches)
+    base = pd.DataFrame(columns=["League", "Season", "Team"] + SERIES_STATS)
+    if totals is not None:
+        base = totals.reset_index().merge(increments[["League", "Season"]].drop_duplicates(), on=["League", "Season"])
+    base["Day"] = pd.to_datetime(base["League"].map(last_dates)).to_numpy().astype("datetime64[D]").astype(np.int64)
+    table = series_from_increments(pd.concat([base, increments], axis="index", ignore_index=True)).matchday_table()
+    # Matchdays of the absorbed matches only counted as a start : not written again
+    first_days = increments.groupby("League")["Day"].min()
+    days = table["Match Date"].to_numpy().astype("datetime64[D]").astype(np.int64)
+    return table[days >= table["League"].astype(object).map(first_days).to_numpy()].reset_index(drop=True)
+
+def ranking_history(matches: pd.DataFrame, from_date: datetime = None, to_date: datetime = None) -> pd.DataFrame:
+    # League tables after every matchday of the period, as stored in the "Ranking history" table
+    return build_series(matches).matchday_table(from_date, to_date)
@@ -0,0 +1,364 @@
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pandas as pd
+
+import utils.data_fetching as fetching
+import utils.odds_analytics as odds_analytics
+import utils.processed_store as store
+import utils.profiling as profiling
+import utils.ranking as ranking
+import utils.ranking_series as ranking_series
+import utils.team_index as team_index
+
+STATE_DIR = "tmp/ranking_state"
+# State table -> Parquet file in the state directory
+STATE_TABLES = {
+    "results": "results.parquet",
+    "stats": "stats.parquet",
+    "sequences": "sequences.parquet",
+    "team_country_league": "team_country_league.parquet",
+    "series": "series.parquet",
+}
+RESULT_CODES = {"Win": "W", "Draw": "D", "Loss": "L"}
+SEQUENCE_COLUMNS = ["Matches", "Changes", "Last", "Recent"]
+
+def add_counts(current: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    if current is None:
+        return new
+    return current.add(new, fill_value=0).astype(new.dtypes.to_dict())
+
+def sequence_consistency(matches: pd.Series, changes: pd.Series) -> pd.Series:
+    # Same normalization as form_consistency_indicator : no value under two matches
+    possible_switches = matches - 1
+    return (1 - changes / possible_switches).where(possible_switches > 0)
+
+def recent_changes(results: str) -> int:
+    return sum(results[i] != results[i - 1] for i in range(1, len(results)))
+
+@dataclass
+class RankingState:
+    # Running totals of a ranking, updated one chunk of matches at a time : memory only depends on the number of teams.
+    # Matches are expected in chronological order for each team (Football-Data files are sorted by date).
+    windows: tuple[int, ...] = ()
+    # Leagues and start date the state was built for, a state is only refreshed for the same ranking
+    leagues: list[str] = None
+    from_date: datetime = None
+    # Team -> Win, Draw, Loss
+    results: pd.DataFrame = None
+    # Team -> goals, conceded, shots,... sums per side
+    stats: pd.DataFrame = None
+    # (Team, Side) -> matches played, result changes, last result and last results codes, for Home, Away and All sides
+    sequences: pd.DataFrame = None
+    team_country_league: pd.DataFrame = field(default_factory=lambda: pd.DataFrame(columns=["Team", "Country", "League"]))
+    matches_count: int = 0
+    # League -> last absorbed match date and the (home team, away team) pairs absorbed on that date
+    watermarks: dict[str, dict] = field(default_factory=dict)
+    # (League, Season, Team) -> season totals, the ranking history of new matches being continued from them
+    series: pd.DataFrame = None
+
+    def update(self, matches: pd.DataFrame):
+        # Absorbing new matches, with fullname columns
+        if matches.empty:
+            return
+        team_matches = ranking.team_matches_table(matches)
+        self.results = add_counts(self.results, ranking.results_ranking(team_matches)[["Win", "Draw", "Loss"]])
+        self.stats = add_counts(self.stats, ranking.side_stats_ranking(team_matches))
+        self.update_sequences(ranking.sort_team_matches(team_matches))
+        self.update_team_country_league(matches)
+        self.update_watermarks(matches)
+        self.series = add_counts(self.series, ranking_series.season_totals(matches))
+        self.matches_count += len(matches)
+
+    def update_watermarks(self, matches: pd.DataFrame):
+        for league, league_matches in matches.groupby(matches["League"].astype(object), sort=False):
+            last_date = league_matches["Match Date"].max()
+            if pd.isna(last_date):
+                continue
+            last_matches = league_matches[league_matches["Match Date"] == last_date]
+            keys = [[home, away] for home, away in zip(last_matches["Home Team"], last_matches["Away Team"])]
+            watermark = self.watermarks.get(league)
+            if watermark is None or last_date > pd.Timestamp(watermark["date"]):
+                self.watermarks[league] = {"date": last_date.isoformat(), "keys": keys}
+            elif last_date == pd.Timestamp(watermark["date"]):
+                watermark["keys"] += [key for key in keys if key not in watermark["keys"]]
+
+    def unseen_matches(self, matches: pd.DataFrame) -> pd.DataFrame:
+        # Matches of the state leagues and dates that have not been absorbed yet
+        matches = matches[matches["League"].isin(self.leagues) & (matches["Match Date"] >= self.from_date)]
+        leagues = matches["League"].astype(object)
+        watermark_dates = pd.to_datetime(leagues.map({league: w["date"] for league, w in self.watermarks.items()}))
+        seen_keys = {(league, home, away) for league, w in self.watermarks.items() for home, away in w["keys"]}
+        on_watermark = matches["Match Date"] == watermark_dates
+        seen = pd.Series([
+            on_date and key in seen_keys
+            for on_date, key in zip(on_watermark, zip(leagues, matches["Home Team"], matches["Away Team"]))
+        ], index=matches.index, dtype=bool)
+        return matches[watermark_dates.isna() | (matches["Match Date"] > watermark_dates) | (on_watermark & ~seen)]
+
+    def last_date(self) -> datetime:
+        # Oldest of the leagues watermarks : matches before it have all been absorbed
+        if not self.watermarks:
+            return self.from_date
+        return min(pd.Timestamp(w["date"]) for w in self.watermarks.values()).to_pydatetime()
+
+    def history_update(self, new_matches: pd.DataFrame) -> pd.DataFrame:
+        # Ranking history rows of the new matches, before they are absorbed
+        last_dates = {league: w["date"] for league, w in self.watermarks.items()}
+        return ranking_series.history_update(self.series, last_dates, new_matches)
+
+    def matches_config(self, leagues: list[str], from_date: datetime, windows: tuple[int, ...]) -> bool:
+        return sorted(self.leagues) == sorted(leagues) and self.from_date == from_date and tuple(self.windows) == tuple(windows)
+
+    def save(self, state_dir: str = STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        tables = {
+            "results": self.results.rename_axis("Team").reset_index() if self.results is not None else None,
+            "stats": self.stats.rename_axis("Team").reset_index() if self.stats is not None else None,
+            "sequences": self.sequences.reset_index() if self.sequences is not None else None,
+            "team_country_league": self.team_country_league,
+            "series": self.series.reset_index() if self.series is not None else None,
+        }
+        for name, df in tables.items():
+            path = os.path.join(state_dir, STATE_TABLES[name])
+            if df is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            df.to_parquet(f"{path}.tmp", index=False)
+            os.replace(f"{path}.tmp", path)
+        # Written last : a state is only loaded when its tables are complete
+        with open(os.path.join(state_dir, "state.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "windows": list(self.windows),
+                "leagues": self.leagues,
+                "from_date": self.from_date.isoformat() if self.from_date is not None else None,
+                "matches_count": self.matches_count,
+                "watermarks": self.watermarks,
+            }, f, indent=2)
+
+    def update_sequences(self, ordered: pd.DataFrame):
+        keys = ["Team", "Side"]
+        sequences = pd.concat(
+            [ordered[["Team", "Side", "Result"]], ordered[["Team", "Result"]].assign(Side="All")],
+            axis="index", ignore_index=True
+        )
+        sequences["Result"] = sequences["Result"].map(RESULT_CODES)
+        grouped = sequences.groupby(keys, sort=False)["Result"]
+        # The first match of each sequence is compared with the last result already absorbed
+        previous = grouped.shift()
+        first_matches = ~sequences.duplicated(keys)
+        if self.sequences is not None:
+            last_known = self.sequences["Last"].reindex(pd.MultiIndex.from_frame(sequences[keys]))
+            previous[first_matches] = last_known.to_numpy()[first_matches.to_numpy()]
+        changes = previous.notna() & (previous != sequences["Result"])
+
+        longest_window = max(self.windows, default=0)
+        new = pd.DataFrame({
+            "Matches": grouped.size(),
+            "Changes": changes.groupby([sequences[key] for key in keys], sort=False).sum(),
+            "Last": grouped.last(),
+            "Recent": grouped.tail(longest_window).groupby([sequences[key] for key in keys], sort=False).agg("".join)
+                if longest_window else "",
+        })
+        if self.sequences is None:
+            self.sequences = new[SEQUENCE_COLUMNS]
+            return
+        index = self.sequences.index.union(new.index)
+        current = self.sequences.reindex(index)
+        new = new.reindex(index)
+        self.sequences = pd.DataFrame({
+            "Matches": current["Matches"].fillna(0) + new["Matches"].fillna(0),
+            "Changes": current["Changes"].fillna(0) + new["Changes"].fillna(0),
+            "Last": new["Last"].fillna(current["Last"]),
+            "Recent": (current["Recent"].fillna("") + new["Recent"].fillna("")).str[-longest_window:]
+                if longest_window else "",
+        }).astype({"Matches": int, "Changes": int})
+
+    def update_team_country_league(self, matches: pd.DataFrame):
+        # Same pairs as the "Countries and leagues" table of the batch process
+        team_country_league = pd.concat(
+            [self.team_country_league, team_index.teams_table(matches)], axis="index", ignore_index=True
+        )
+        self.team_country_league = team_country_league.astype(object).drop_duplicates(ignore_index=True)
+
+    def ranking(self) -> pd.DataFrame:
+        # Same columns as the ranking of process_input_data, before the Elo, country and league columns
+        if self.results is None:
+            return pd.DataFrame(index=pd.Index([], name="Teams"))
+        res = self.results.sort_index().copy()
+        res.index.name = None
+        res["Points"] = res["Win"] * 3 + res["Draw"] * 1
+        ranking.reindexing_ranking(res)
+
+        for side in ("Home", "Away", "All"):
+            side_sequences = self.side_sequences(res.index, side)
+            res[f"Consistency - {side}"] = sequence_consistency(side_sequences["Matches"], side_sequences["Changes"])
+        for last_n in self.windows:
+            for side in ("Home", "Away", "All"):
+                recent = self.side_sequences(res.index, side)["Recent"].str[-last_n:]
+                res[f"Consistency (last {last_n}) - {side}"] = sequence_consistency(
+                    recent.str.len(), recent.map(recent_changes, na_action="ignore")
+                )
+
+        stats = self.stats.reindex(res.index, fill_value=0)
+        for col in stats.columns:
+            res[col] = stats[col]
+        return res
+
+    def side_sequences(self, teams: pd.Index, side: str) -> pd.DataFrame:
+        index = pd.MultiIndex.from_arrays([teams, [side] * len(teams)], names=["Team", "Side"])
+        return self.sequences.reindex(index).set_axis(teams)
+
+def load_state(state_dir: str = STATE_DIR) -> RankingState | None:
+    meta_path = os.path.join(state_dir, "state.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    tables = {
+        name: pd.read_parquet(os.path.join(state_dir, filename))
+        for name, filename in STATE_TABLES.items()
+        if os.path.exists(os.path.join(state_dir, filename))
+    }
+    if meta["matches_count"] and "series" not in tables:
+        # Saved without the season totals : built again
+        return None
+    return RankingState(
+        windows=tuple(meta["windows"]),
+        leagues=meta["leagues"],
+        from_date=datetime.fromisoformat(meta["from_date"]) if meta["from_date"] else None,
+        results=tables["results"].set_index("Team") if "results" in tables else None,
+        stats=tables["stats"].set_index("Team") if "stats" in tables else None,
+        sequences=tables["sequences"].set_index(["Team", "Side"]) if "sequences" in tables else None,
+        team_country_league=tables["team_country_league"],
+        matches_count=meta["matches_count"],
+        watermarks=meta["watermarks"],
+        series=tables["series"].set_index(["League", "Season", "Team"]) if "series" in tables else None,
+    )
+
+def save_ranking_outputs(
+        state: RankingState, leagues_to_keep: list[str], store_dir: str,
+        elo: pd.DataFrame, report: profiling.RunReport, appended: dict[str, pd.DataFrame] = None
+    ):
+    # Ranking and "Countries and leagues" tables of the store, from the running totals.
+    # appended : new rows of the other tables (refresh), instead of rebuilding them from the matches of the store
+    if elo is None:
+        with report.stage("Fetch Elo") as stage:
+            elo = fetching.fetch_elo_data()
+            stage.rows_out = len(elo)
+    with report.stage("Elo preprocessing", len(elo)) as stage:
+        df_elo = elo.copy()
+        fetching.pre_process_elo_data(df_elo, state.team_country_league)
+        df_elo = df_elo[df_elo["League"].isin(leagues_to_keep)]
+        stage.rows_out = len(df_elo)
+
+    with report.stage("Ranking", state.matches_count) as stage:
+        ranking_df = state.ranking()
+        ranking.add_elo_column(ranking_df, df_elo)
+        ranking.add_country_league_columns(ranking_df, state.team_country_league)
+        stage.rows_out = len(ranking_df)
+
+    tables = {"Ranking": ranking_df.reset_index(), "Countries and leagues": state.team_country_league}
+    if appended is None:
+        with report.stage("Ranking history", state.matches_count) as stage:
+            # Built from the matches of the store, written by the stream
+            columns = ranking_series.SERIES_COLUMNS
+            matches = store.load_table("Matches", store_dir, columns) if state.matches_count else pd.DataFrame(columns=columns)
+            tables["Ranking history"] = ranking_series.ranking_history(matches)
+            stage.rows_out = len(tables["Ranking history"])
+
+        with report.stage("Odds", state.matches_count) as stage:
+            # From the matches of the store as well, their odds columns only
+            if state.matches_count:
+                matches = store.load_table("Matches", store_dir, odds_analytics.source_columns(store.table_columns("Matches", store_dir)))
+            else:
+                matches = pd.DataFrame(columns=odds_analytics.KEY_COLUMNS)
+            tables["Odds"] = odds_analytics.odds_table(matches)
+            stage.rows_out = len(tables["Odds"])
+
+    with report.stage("Store write", len(ranking_df)) as stage:
+        store.save_store(tables, store_dir)
+        for sheet_name, df in (appended or {}).items():
+            store.append_table(sheet_name, df, store_dir)
+        state.team_country_league.to_csv(os.path.join(os.path.dirname(store_dir), "team_country_league.csv"), index=False)
+
+def process_input_stream(
+        leagues_to_keep: list[str],
+        from_date: datetime, to_date: datetime,
+        consistency_windows: tuple[int, ...] = (),
+        seasons: list[str] = None,
+        chunksize: int = 10_000,
+        store_dir: str = store.STORE_DIR,
+        state_dir: str = STATE_DIR,
+        elo: pd.DataFrame = None,
+        report: profiling.RunReport = None
+    ) -> profiling.RunReport:
+    # Same outputs as process_input_data, with matches streamed from the sources : peak memory stays bounded
+    # whatever the number of seasons, the matches table being written to the store chunk by chunk.
+    # The running totals are saved in state_dir, for later refreshes.
+    report = report or profiling.RunReport()
+    state = RankingState(consistency_windows, leagues=list(leagues_to_keep), from_date=from_date)
+    with report.run():
+        with report.stage("Stream matches") as stage, store.matches_writer(store_dir) as append_matches:
+            for chunk in fetching.stream_matches_data(leagues_to_keep, from_date, to_date, seasons, chunksize=chunksize):
+                append_matches(chunk)
+                state.update(chunk)
+            stage.rows_out = state.matches_count
+
+        save_ranking_outputs(state, leagues_to_keep, store_dir, elo, report)
+        with report.stage("State write", len(state.results) if state.results is not None else 0):
+            state.save(state_dir)
+    return report
+
+def refresh_ranking(
+        leagues_to_keep: list[str],
+        from_date: datetime,
+        consistency_windows: tuple[int, ...] = (),
+        matches: pd.DataFrame = None,
+        store_dir: str = store.STORE_DIR,
+        state_dir: str = STATE_DIR,
+        elo: pd.DataFrame = None,
+        report: profiling.RunReport = None
+    ) -> profiling.RunReport:
+    # Absorbing the matches played since the last run into the saved state : O(new matches) instead of a rebuild.
+    # matches : fullname columns matches to take the new ones from, the current season sources by default
+    report = report or profiling.RunReport(name="refresh")
+    state = load_state(state_dir)
+    if state is None or not state.matches_config(leagues_to_keep, from_date, consistency_windows):
+        # No state for this ranking yet : built once from the sources
+        return process_input_stream(
+            leagues_to_keep, from_date, datetime.now(), consistency_windows,
+            store_dir=store_dir, state_dir=state_dir, elo=elo, report=report
+        )
+    with report.run():
+        with report.stage("New matches") as stage:
+            if matches is None:
+                chunks = list(fetching.stream_matches_data(leagues_to_keep, state.last_date()))
+                matches = pd.concat(chunks, axis="index", ignore_index=True) if chunks else None
+            new_matches = state.unseen_matches(matches) if matches is not None else pd.DataFrame()
+            stage.rows_in = len(matches) if matches is not None else 0
+            stage.rows_out = len(new_matches)
+
+        appended = {}
+        if not new_matches.empty:
+            new_matches = new_matches.sort_values("Match Date", kind="stable", ignore_index=True)
+            # History and odds rows of the new matches only, the stored matches are not read again
+            with report.stage("Ranking history", len(new_matches)) as stage:
+                appended["Ranking history"] = state.history_update(new_matches)
+                stage.rows_out = len(appended["Ranking history"])
+            with report.stage("Odds", len(new_matches)) as stage:
+                appended["Odds"] = odds_analytics.odds_table(new_matches)
+                stage.rows_out = len(appended["Odds"])
+            appended["Matches"] = new_matches
+
+        with report.stage("State update", len(new_matches)) as stage:
+            state.update(new_matches)
+            stage.rows_out = state.matches_count
+
+        save_ranking_outputs(state, leagues_to_keep, store_dir, elo, report, appended)
+        with report.stage("State write", len(state.results) if state.results is not None else 0):
+            state.save(state_dir)
+    return report
@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher, get_close_matches
+
+import pandas as pd
+
+import utils.mapping_registry as registry
+
+INDEX_PATH = "tmp/team_index.json"
+MAPPING_PATH = registry.TEAM_MAPPING_PATH
+# Similarity from which a team is suggested for an unknown name, and from which the suggestion is used without review
+SUGGESTION_CUTOFF = 0.75
+AUTO_RESOLVE_SCORE = 0.9
+
+def teams_table(matches: pd.DataFrame) -> pd.DataFrame:
+    # Distinct (Team, Country, League) of the matches, i.e. the "Countries and leagues" table
+    sides = [
+        matches[[f"{side} Team", "Country", "League"]].drop_duplicates().astype(object)
+        .set_axis(["Team", "Country", "League"], axis="columns")
+        for side in ("Home", "Away")
+    ]
+    return pd.concat(sides, axis="index", ignore_index=True).drop_duplicates(ignore_index=True)
+
+def teams_attributes(team_country_league: pd.DataFrame) -> pd.DataFrame:
+    # Team -> Country, League, for column lookups (the last pair of a team wins)
+    return team_country_league.drop_duplicates("Team", keep="last").set_index("Team")[["Country", "League"]]
+
+@dataclass
+class TeamIndex:
+    # Names used by the other sources (ClubElo, fixtures feeds) resolved to the names of the matches dataset.
+    # Built from the mapping file, and completed by suggestions for the names it does not cover.
+    path: str = INDEX_PATH
+    mapping_path: str = MAPPING_PATH
+    # Source -> source name -> team, from the mapping file
+    aliases: dict[str, dict[str, str]] = field(default_factory=dict)
+    # League -> teams seen in its matches, the candidates of the suggestions, and league -> country
+    leagues: dict[str, set[str]] = field(default_factory=dict)
+    countries: dict[str, str] = field(default_factory=dict)
+    # Source -> source name -> [closest team or None, similarity, number of teams searched,
+    # similarity of the runner-up, applied]
+    suggestions: dict[str, dict[str, list]] = field(default_factory=dict)
+    changed: bool = False
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False)
+
+    def load_mapping(self):
+        # The mapping file is read again only when it has been edited
+        self.aliases = registry.team_aliases(self.mapping_path)
+
+    def add_teams(self, team_country_league: pd.DataFrame):
+        with self.lock:
+            for league, teams in team_country_league.groupby("League", sort=False)["Team"]:
+                known = self.leagues.setdefault(league, set())
+                new_teams = set(teams) - known
+                if new_teams:
+                    known |= new_teams
+                    self.changed = True
+            for league, country in team_country_league[["League", "Country"]].drop_duplicates("League").itertuples(index=False):
+                if self.countries.get(league) != country:
+                    self.countries[league] = country
+                    self.changed = True
+
+    def teams(self, leagues: list[str] = None, country: str = None) -> set[str]:
+        # Teams of the leagues (all of them by default), of the country only if given
+        leagues = self.leagues if leagues is None else leagues
+        return set().union(*(
+            self.leagues.get(league, ()) for league in leagues
+            if country is None or self.countries.get(league) == country
+        ))
+
+    def resolve(self, names: pd.Series, source: str, leagues: list[str] = None, countries: pd.Series = None) -> pd.Series:
+        # Names looked up once per distinct value : mapping file first, then the teams themselves, then the
+        # closest team among the teams of the leagues (all of them by default) of the country of the name
+        # (countries : country of every name, the names without one being left as is, not searched).
+        # A suggestion is applied only when it is close enough, closer than the runner-up, not named yet and the
+        # closest team of no other name : the others are recorded for review only.
+        with self.lock:
+            self.load_mapping()
+            aliases = self.aliases.get(source, {})
+            teams = self.teams(leagues)
+            lookup = {name: aliases.get(name, name if name in teams else None) for name in pd.unique(names.dropna())}
+            unresolved = [name for name, team in lookup.items() if team is None]
+            if not unresolved:
+                return names.map(lookup)
+            name_countries = {} if countries is None else dict(
+                pd.DataFrame({"Name": names, "Country": countries}).dropna(subset=["Name"])
+                .drop_duplicates("Name").itertuples(index=False)
+            )
+            # Teams already named by the source are not applied to another name
+            named = set(lookup.values())
+            candidates = {}
+            closest = {}
+            for name in unresolved:
+                country = name_countries.get(name)
+                if countries is not None and pd.isna(country):
+                    # Without a known country, a name is left as is and not searched
+                    continue
+                if country not in candidates:
+                    candidates[country] = sorted(self.teams(leagues, country))
+                team, score, _, runner_up, _ = self.suggest(source, name, candidates[country])
+                if team is not None and team not in named and score >= AUTO_RESOLVE_SCORE and score > runner_up:
+                    closest[name] = team
+            claims = pd.Series(list(closest.values()), dtype=object).value_counts()
+            for name in unresolved:
+                applied = bool(name in closest and claims[closest[name]] == 1)
+                lookup[name] = closest[name] if applied else name
+                suggestion = self.suggestions.get(source, {}).get(name)
+                if suggestion is not None and suggestion[4] != applied:
+                    suggestion[4] = applied
+                    self.changed = True
+        return names.map(lookup)
+
+    def suggest(self, source: str, name: str, candidates: list[str]) -> list:
+        # Two closest teams, searched once per name (again when teams are added to its country)
+        cached = self.suggestions.setdefault(source, {}).get(name)
+        if cached is None or len(cached) != 5 or cached[2] != len(candidates):
+            matches = get_close_matches(name, candidates, n=2, cutoff=SUGGESTION_CUTOFF)
+            scores = [round(SequenceMatcher(None, name, team).ratio(), 3) for team in matches] + [0.0, 0.0]
+            cached = [matches[0] if matches else None, scores[0], len(candidates), scores[1], False]
+            self.suggestions[source][name] = cached
+            self.changed = True
+        return cached
+
+    def source_names(self, teams: list[str], source: str) -> list[str]:
+        # Names of teams of the matches dataset in a source, e.g. to request ClubElo
+        with self.lock:
+            self.load_mapping()
+            names = {team: name for name, team in self.aliases.get(source, {}).items()}
+            for name, suggestion in self.suggestions.get(source, {}).items():
+                if len(suggestion) == 5 and suggestion[4]:
+                    names.setdefault(suggestion[0], name)
+        return [names.get(team, team) for team in teams]
+
+    def save(self):
+        # Seen teams and suggestions are kept between runs, the aliases come from the mapping file
+        with self.lock:
+            if not self.changed:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "leagues": {league: sorted(teams) for league, teams in self.leagues.items()},
+                    "countries": self.countries,
+                    "suggestions": self.suggestions,
+                }, f, indent=1, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+
+# (index path, mapping path) -> index shared by every pipeline of the process
+_indexes: dict[tuple[str, str], TeamIndex] = {}
+_indexes_lock = threading.Lock()
+
+def load_index(path: str = INDEX_PATH, mapping_path: str = MAPPING_PATH) -> TeamIndex:
+    key = (os.path.abspath(path), os.path.abspath(mapping_path))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = TeamIndex(key[0], key[1])
+            if os.path.exists(key[0]):
+                with open(key[0], "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                index.leagues = {league: set(teams) for league, teams in saved["leagues"].items()}
+                index.countries = saved.get("countries", {})
+                index.suggestions = saved["suggestions"]
+            _indexes[key] = index
+    return index
@@ -0,0 +1,203 @@
+import re
+import shutil
+import tempfile
+import zipfile
+from typing import Iterable
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
+import utils.profiling as profiling
+
+# Rows rendered and written at once : memory does not depend on the size of a sheet
+CHUNK_ROWS = 5_000
+# Rendered sheets kept in memory up to this size for the next sheets sharing them, on disk beyond
+SPOOL_MAX_SIZE = 64 * 1024 ** 2
+EXCEL_EPOCH = pd.Timestamp("1899-12-30")
+# Style indexes of styles.xml
+DATETIME_STYLE, HEADER_STYLE = 1, 2
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+{sheets}
+</Types>"""
+SHEET_CONTENT_TYPE = '<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>{sheets}</sheets>
+</workbook>"""
+WORKBOOK_SHEET = '<sheet name="{name}" sheetId="{i}" r:id="rId{i}"/>'
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+{sheets}
+<Relationship Id="rId0" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+WORKBOOK_SHEET_REL = '<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i}.xml"/>'
+# Default style, datetimes as "yyyy-mm-dd hh:mm:ss" (as written by pandas) and bold headers
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="3">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+SHEET_START = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+SHEET_END = "</sheetData></worksheet>"
+EMPTY_CELL = "<c/>"
+# Characters not allowed in XML 1.0 : control characters (but tab and line breaks), surrogates and non-characters
+XML_INVALID_CHARACTERS = r"[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]"
+# Sheet names rules of Excel : 1 to 31 characters, none of []:*?/\, unique whatever the case
+MAX_SHEET_NAME_LENGTH = 31
+SHEET_NAME_INVALID_CHARACTERS = re.compile(r"[\[\]:*?/\\]|" + XML_INVALID_CHARACTERS)
+
+def check_sheet_names(names: list[str]):
+    seen = set()
+    for name in names:
+        if not name or len(name) > MAX_SHEET_NAME_LENGTH:
+            raise ValueError(f"Sheet name {name!r} must have 1 to {MAX_SHEET_NAME_LENGTH} characters")
+        if SHEET_NAME_INVALID_CHARACTERS.search(name) or name.startswith("'") or name.endswith("'"):
+            raise ValueError(f"Sheet name {name!r} cannot contain []:*?/\\ or control characters, nor start or end with '")
+        if name.lower() in seen:
+            raise ValueError(f"Sheet name {name!r} is used twice")
+        seen.add(name.lower())
+
+def string_cells(values: pd.Series, style: int = None) -> np.ndarray:
+    # Inline strings : no shared strings table, so that a rendered sheet can be reused as is
+    style_attr = f' s="{style}"' if style is not None else ""
+    text = values.astype(str).str.replace("&", "&amp;", regex=False)
+    text = text.str.replace("<", "&lt;", regex=False).str.replace(">", "&gt;", regex=False)
+    # Characters not allowed in XML are left out
+    text = text.str.replace(XML_INVALID_CHARACTERS, "", regex=True)
+    cells = f'<c t="inlineStr"{style_attr}><is><t xml:space="preserve">' + text + "</t></is></c>"
+    return cells.where(values.notna(), EMPTY_CELL).to_numpy(dtype=object)
+
+def number_cells(values: pd.Series, style: int = None) -> np.ndarray:
+    style_attr = f' s="{style}"' if style is not None else ""
+    cells = f"<c{style_attr}><v>" + values.astype(str) + "</v></c>"
+    valid = values.notna() & ~values.isin([np.inf, -np.inf])
+    return cells.where(valid, EMPTY_CELL).to_numpy(dtype=object)
+
+def object_cell(value) -> str:
+    # Columns mixing types (e.g. a league name or a ClubElo level) : one cell at a time
+    if value is None or (isinstance(value, float) and not np.isfinite(value)) or value is pd.NaT:
+        return EMPTY_CELL
+    if isinstance(value, (bool, np.bool_)):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return f"<c><v>{value}</v></c>"
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return f'<c s="{DATETIME_STYLE}"><v>{(pd.Timestamp(value).tz_localize(None) - EXCEL_EPOCH) / pd.Timedelta(days=1)}</v></c>'
+    return string_cells(pd.Series([value]))[0]
+
+def column_cells(values: pd.Series) -> np.ndarray:
+    # Every cell of a column rendered at once, from its type
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(object)
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return ('<c t="b"><v>' + values.astype(int).astype(str) + "</v></c>").to_numpy(dtype=object)
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        if getattr(values.dt, "tz", None) is not None:
+            values = values.dt.tz_localize(None)
+        return number_cells((values - EXCEL_EPOCH) / pd.Timedelta(days=1), DATETIME_STYLE)
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return number_cells(values)
+    if pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty"):
+        return string_cells(values)
+    return values.map(object_cell).to_numpy(dtype=object)
+
+def render_rows(df: pd.DataFrame) -> str:
+    if df.empty:
+        return ""
+    # Cells of every column rendered at once, then joined row by row (linear in the number of columns)
+    cells = np.column_stack([column_cells(df[col]) for col in df.columns])
+    return "".join(["<row>" + "".join(row) + "</row>" for row in cells.tolist()])
+
+def render_header(columns: list[str]) -> str:
+    return "<row>" + "".join(string_cells(pd.Series([str(col) for col in columns], dtype=object), HEADER_STYLE)) + "</row>"
+
+def chunked(df: pd.DataFrame, chunk_rows: int = CHUNK_ROWS) -> Iterable[pd.DataFrame]:
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+def write_sheet(output, chunks: Iterable[pd.DataFrame], columns: list[str] = None) -> int:
+    # Sheet XML streamed chunk by chunk, returns the number of rows written.
+    # columns : header of the sheet, known before the first chunk for frames (written even without rows)
+    rows = 0
+    output.write(SHEET_START.encode("utf-8"))
+    if columns is not None:
+        output.write(render_header(columns).encode("utf-8"))
+    for chunk in chunks:
+        if columns is None:
+            columns = list(chunk.columns)
+            output.write(render_header(columns).encode("utf-8"))
+        output.write(render_rows(chunk[columns]).encode("utf-8"))
+        rows += len(chunk)
+    output.write(SHEET_END.encode("utf-8"))
+    return rows
+
+def write_workbook(
+        xlsx_path, sheets: dict[str, pd.DataFrame | Iterable[pd.DataFrame]],
+        report: profiling.RunReport = None
+    ) -> profiling.RunReport:
+    # Sheets given as frames, or as iterables of chunks to stay within a constant memory.
+    # A frame given for several sheets is rendered once, its XML being copied for the next ones.
+    check_sheet_names(list(sheets))
+    report = report or profiling.RunReport(name="excel_export")
+    rendered = {}
+    with report.run(), zipfile.ZipFile(xlsx_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as workbook:
+        names = list(sheets)
+        workbook.writestr("[Content_Types].xml", CONTENT_TYPES.format(
+            sheets="\n".join(SHEET_CONTENT_TYPE.format(i=i) for i in range(1, len(names) + 1))
+        ))
+        workbook.writestr("_rels/.rels", ROOT_RELS)
+        workbook.writestr("xl/workbook.xml", WORKBOOK.format(
+            sheets="".join(WORKBOOK_SHEET.format(name=escape(name, {'"': "&quot;"}), i=i) for i, name in enumerate(names, 1))
+        ))
+        workbook.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS.format(
+            sheets="\n".join(WORKBOOK_SHEET_REL.format(i=i) for i in range(1, len(names) + 1))
+        ))
+        workbook.writestr("xl/styles.xml", STYLES)
+
+        shared = {id(df) for df in sheets.values() if isinstance(df, pd.DataFrame)}
+        shared = {key for key in shared if sum(id(df) == key for df in sheets.values()) > 1}
+        for i, (name, content) in enumerate(sheets.items(), 1):
+            part = f"xl/worksheets/sheet{i}.xml"
+            with report.stage(f"Excel write - {name}") as stage:
+                with workbook.open(part, "w") as output:
+                    if id(content) in rendered:
+                        # Same frame as a previous sheet : its XML is copied, not rendered again
+                        spool, rows = rendered[id(content)]
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, output)
+                    elif id(content) in shared:
+                        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                        rows = write_sheet(spool, chunked(content), list(content.columns))
+                        rendered[id(content)] = (spool, rows)
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, output)
+                    else:
+                        if isinstance(content, pd.DataFrame):
+                            rows = write_sheet(output, chunked(content), list(content.columns))
+                        else:
+                            rows = write_sheet(output, content)
+                stage.rows_in = stage.rows_out = rows
+                stage.bytes_out = workbook.getinfo(part).compress_size
+    for spool, _ in rendered.values():
+        spool.close()
+    return report
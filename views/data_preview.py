@@ -1,14 +1,24 @@
 import streamlit as st
 
+import utils.jobs as jobs
+import utils.processed_store as store
 from utils.preview_prep import (
     split_processed_data_sheets,
+    load_processed_store,
     map_divisions_leagues_images,
+    leagues_images_mapping,
+    uploaded_file_key,
+    build_preview_cube,
+    cube_kpis,
+    cube_leagues,
     countries_flags,
     divisions_logos,
+    group_goals_per_team,
     group_goals_per_month,
     group_wins_per_team,
     most_consistent_team,
-    highest_elo_team
+    highest_elo_team,
+    build_odds_summary
     )
 
 "# Soccer BI - data preview"
@@ -23,15 +33,41 @@ and some **key analytical information**.
 "## Preview options"
 
 """
-Coming from the [Data process page](/), we assume that you have already downloaded the processed data.
+Coming from the [Data process page](/), the data of a finished process job can be loaded directly.
+You can also drop a processed data workbook downloaded previously.
 """
 
-data = st.file_uploader("Drop the processed data here", type="xlsx")
+finished_jobs = [job for job in jobs.list_jobs() if job.status == jobs.DONE]
+sources = ["Upload a workbook"]
+if store.store_exists():
+    sources.insert(0, "Latest processed data")
+if finished_jobs:
+    sources.insert(0, "Processed data of a job")
+source = st.radio("Processed data source", sources, horizontal=True)
+
+store_dir = None
+if source == "Processed data of a job":
+    job = st.selectbox(
+        "Finished process job", finished_jobs[::-1],
+        format_func=lambda job: f"{', '.join(job.leagues)} ({job.from_date:%Y-%m-%d} - {job.to_date:%Y-%m-%d})"
+    )
+    data = store_dir = job.store_dir
+elif source == "Latest processed data":
+    data = store_dir = store.STORE_DIR
+else:
+    data = st.file_uploader("Drop the processed data here", type="xlsx")
 
 if data:
     with st.spinner(text="Loading data...", show_time=True):
-        df_matches, df_ranking = split_processed_data_sheets(data)
-        df_leagues = map_divisions_leagues_images(data)
+        if store_dir is not None:
+            data_key = f"{store_dir}:{store.store_version(store_dir)}"
+            df_matches, df_ranking = load_processed_store(store_dir, store.store_version(store_dir))
+            df_leagues = leagues_images_mapping(df_matches)
+        else:
+            data_key = uploaded_file_key(data)
+            df_matches, df_ranking = split_processed_data_sheets(data, data_key)
+            df_leagues = map_divisions_leagues_images(data, data_key)
+        cube = build_preview_cube(data_key, df_matches)
 
     "## Overall information"
     
@@ -40,16 +76,15 @@ if data:
     countries = list(df_matches["Country"].unique())
     country_selected = st.selectbox("Country", ["All"] + countries)
 
-    df_country_matches = df_matches[df_matches["Country"] == country_selected] if country_selected != "All" else df_matches
-
     col1, col2, col3 = st.columns(3)
 
-    oldest_date = df_country_matches["Match Date"].min()
-    latest_date = df_country_matches["Match Date"].max()
-    matches_days = df_country_matches["Match Date"].unique().size * 1.0
-    matches_number = len(df_country_matches)
-    leagues_number = df_country_matches["Division"].unique().size
-    teams_number = df_country_matches["Home Team"].unique().size
+    kpis = cube_kpis(cube, country_selected)
+    oldest_date = kpis["Oldest match"]
+    latest_date = kpis["Latest match"]
+    matches_days = kpis["Match days"] * 1.0
+    matches_number = kpis["Matches"]
+    leagues_number = kpis["Leagues"]
+    teams_number = kpis["Teams"]
 
     with col1:
         st.metric("Oldest match", oldest_date.strftime("%Y/%m/%d"), border=True)
@@ -78,24 +113,20 @@ if data:
         divisions_columns[divisions_col_idx].image(caption=divisions_images[i][0], image=divisions_images[i][1], width=80)
 
     "### Historic goals"
-    leagues = list(df_country_matches["League"].unique())
+    leagues = cube_leagues(cube, country_selected)
     league_selected = st.selectbox("League", ["All"] + leagues)
 
-    df_league_matches = (
-        df_country_matches[df_matches["League"] == league_selected]
-        if league_selected != "All"
-        else df_country_matches
-    )
-
     "Goals at home:"
-    st.bar_chart(data=df_league_matches, x="Home Team", y="Full time home team goals")
+    df_team_goals = group_goals_per_team(cube, country_selected, league_selected, True)
+    st.bar_chart(data=df_team_goals, x="Home Team", y="Full time home team goals")
     "...away:"
-    st.bar_chart(data=df_league_matches, x="Away Team", y="Full time away team goals")
+    df_team_goals = group_goals_per_team(cube, country_selected, league_selected, False)
+    st.bar_chart(data=df_team_goals, x="Away Team", y="Full time away team goals")
     "Goals per year at home:"
-    df_league_goals = group_goals_per_month(df_league_matches, True)
+    df_league_goals = group_goals_per_month(cube, country_selected, league_selected, True)
     st.line_chart(data=df_league_goals, x="Match Date", y="Full time home team goals")
     "...away:"
-    df_league_goals = group_goals_per_month(df_league_matches, False)
+    df_league_goals = group_goals_per_month(cube, country_selected, league_selected, False)
     st.line_chart(data=df_league_goals, x="Match Date", y="Full time away team goals")
 
     "### Elo"
@@ -116,11 +147,22 @@ if data:
     "### Historic wins"
 
     "Wins per teams at home:"
-    df_league_results_per_team = group_wins_per_team(df_league_matches, True)
+    df_league_results_per_team = group_wins_per_team(cube, country_selected, league_selected, True)
     st.bar_chart(data=df_league_results_per_team, x="Home Team", y="Full time result")
     "...away:"
-    df_league_results_per_team = group_wins_per_team(df_league_matches, False)
-    st.bar_chart(data=df_league_results_per_team, x="Home Team", y="Full time result")
+    df_league_results_per_team = group_wins_per_team(cube, country_selected, league_selected, False)
+    st.bar_chart(data=df_league_results_per_team, x="Away Team", y="Full time result")
+
+    odds_summary = build_odds_summary(data_key, df_matches)
+    if not odds_summary["margins"].empty:
+        "### Bookmakers odds"
+
+        "Average bookmakers margin per league (%):"
+        margins = odds_summary["margins"]
+        st.bar_chart(margins[margins.index.isin(leagues if league_selected == "All" else [league_selected])])
+        if not odds_summary["calibration"].empty:
+            "Observed frequency of the results, per market probability (all leagues):"
+            st.line_chart(odds_summary["calibration"])
 
     "## Teams"
 
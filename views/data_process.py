@@ -1,8 +1,14 @@
+import os
 from datetime import datetime
+from io import BytesIO
 
 import streamlit as st
 
-from utils.ranking import get_leagues_list, process_input_data
+import utils.jobs as jobs
+import utils.mapping_registry as registry
+import utils.processed_store as store
+from utils.profiling import stages_table
+from utils.ranking import get_leagues_list
 
 "# Soccer BI - data process"
 
@@ -18,8 +24,9 @@ in the analytical field of data, or fans that want to define their own betting s
 
 "Here you can download the **PowerBI** template to visualise the processed data :"
 
-with open("dataviz/pbi_template.pbit", "rb") as f:
-    st.download_button("Download PBI template (.pbit)", f, file_name=f"soccer-bi_pbi_template.pbit")
+st.download_button(
+    "Download PBI template (.pbit)", registry.file_bytes(registry.PBI_TEMPLATE_PATH), file_name=f"soccer-bi_pbi_template.pbit"
+)
 
 "## Page description"
 
@@ -34,7 +41,7 @@ This page allows the user to automatically process all raw data provided by one
 top_leagues = ["Premier League", "Bundesliga", "LaLiga", "Serie A", "Ligue 1"]
 leagues_to_keep = st.multiselect(
     "Select the leagues you want to consider",
-    get_leagues_list("data_mapping/leagues_sources.csv"),
+    get_leagues_list(),
     default=top_leagues
 )
 
@@ -43,15 +50,80 @@ col1, col2 = st.columns(2)
 start_date = col1.date_input("Start date", "2024-08-01")
 end_date = col2.date_input("End date", "today")
 
+"### Elo"
+historical_elo = st.checkbox(
+    "Add the Elo of both teams at kickoff to the matches",
+    help="One ClubElo request per team : slower, but the Elo difference can then be used by the backtests"
+)
+
+"### Parallelism"
+workers = st.number_input(
+    "Worker processes (leagues are ranked in parallel above 1)",
+    min_value=1, max_value=os.cpu_count() or 1, value=1,
+    help="Every worker starts a new Python process (a few seconds) : worth it for many leagues over many seasons"
+)
+
+"### Diagnostics"
+track_memory = st.checkbox(
+    "Track peak memory per stage (slower)",
+    help="Memory is traced for the whole app : runs of other sessions at the same time are counted in the peaks"
+)
+capture_profile = st.checkbox("Capture a cProfile of the run")
+
 all_inputs_filled = start_date and end_date
 
 process_button = st.button("Process data") if all_inputs_filled else st.button("Process data", disabled=True)
 if process_button:
-    with st.spinner("Process in progress...", show_time=True):
-        d1 = datetime.combine(start_date, datetime.min.time())
-        d2 = datetime.combine(end_date, datetime.max.time())
-        process_input_data(leagues_to_keep, d1, d2)
-        st.success("Done", icon="✅")
+    d1 = datetime.combine(start_date, datetime.min.time())
+    d2 = datetime.combine(end_date, datetime.max.time())
+    # Run in the background : identical requests of other users share the same job
+    job = jobs.submit(
+        leagues_to_keep, d1, d2, historical_elo=historical_elo,
+        workers=workers, track_memory=track_memory, profile=capture_profile
+    )
+    st.session_state["process_job_id"] = job.id
+
+@st.fragment(run_every=2)
+def process_job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return
+    f"**Process job** `{job.id}` ({', '.join(job.leagues)}) : **{job.status}**"
+    if job.report is not None and job.report.stages:
+        # Progress breakdown, updated at the end of every stage
+        st.dataframe(stages_table(job.report))
+    if job.is_active():
+        if st.button("Cancel process", key=f"cancel_{job.id}"):
+            jobs.cancel(job.id)
+    elif job.status == jobs.FAILED:
+        st.error(job.error, icon="🚨")
+    elif job.status == jobs.DONE:
+        st.success(f"Done in {job.report.total_seconds:.1f}s", icon="✅")
+        st.download_button("Download run report (.json)", job.report.to_json(), file_name=os.path.basename(job.report_path))
+        if job.report.profile_stats:
+            with st.expander("cProfile - top functions by cumulative time"):
+                st.code(job.report.profile_stats)
+        "The processed data can be previewed on the [Data preview page](/data-preview), or exported as an Excel workbook."
+        include_odds = st.checkbox("Include bookmakers odds", key=f"odds_{job.id}")
+        if os.path.exists(job.excel_path(include_odds)):
+            d = datetime.fromtimestamp(job.finished_at).strftime("%Y-%m-%d_%H-%M-%S")
+            with open(job.excel_path(include_odds), "rb") as f:
+                st.download_button("Download processed data", f, file_name=f"soccer-bi_{d}.xlsx")
+        elif st.button("Prepare Excel export", key=f"excel_{job.id}"):
+            with st.spinner("Excel export in progress...", show_time=True):
+                jobs.export_excel(job, include_odds)
+            st.rerun(scope="fragment")
+
+if "process_job_id" in st.session_state:
+    process_job_status(st.session_state["process_job_id"])
+
+if store.store_exists():
+    "The latest processed data (last finished job, or run from the command line) can also be exported as an Excel workbook."
+    include_odds = st.checkbox("Include bookmakers odds")
+    if st.button("Prepare Excel export"):
+        # Built in memory : sessions exporting at the same time do not share a file
+        workbook = BytesIO()
+        with st.spinner("Excel export in progress...", show_time=True):
+            store.export_store_to_excel(workbook, include_odds=include_odds)
         d = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        with open("tmp/process_result.xlsx", "rb") as f:
-            st.download_button("Download processed data", f, file_name=f"soccer-bi_{d}.xlsx")
\ No newline at end of file
+        st.download_button("Download processed data", workbook.getvalue(), file_name=f"soccer-bi_{d}.xlsx")
\ No newline at end of file
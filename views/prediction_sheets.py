@@ -1,9 +1,13 @@
 from datetime import datetime
+from io import BytesIO
 from zoneinfo import available_timezones
 
 import streamlit as st
 
-from utils.data_fetching import get_current_week_fixtures, save_fixtures_as_sheets
+import utils.jobs as jobs
+import utils.prediction as prediction
+import utils.processed_store as store
+from utils.data_fetching import get_week_fixtures, save_fixtures_as_sheets
 
 "# Soccer BI - prediction sheets"
 
@@ -17,18 +21,45 @@ This page allows the user to generate to-fill prediction sheets, with the three
 """ 
 
 "**NB : Only the Top 5 competitions (Premier League, La Liga,...) have been specified in the sheets. Do not hesitate to add other leagues fixtures if needed.**"
-"**NB2 : Machine Learning is not used for making automated prediction, yet. I am thinking of ways to use ML efficiently on this app.**"
+"**NB2 : The sheets can be pre-filled with the probabilities of a Poisson model of every league (Dixon-Coles), fitted on the processed matches of a finished job of the data process page (or of the command line).**"
 
 "## Generation options"
 
 tz = st.selectbox("Choose a timezone for fixtures datetime", available_timezones())
+week_day = st.date_input("Week of", "today")
+# Processed data the models can be fitted on : finished jobs, the latest one first, then the default store
+finished_jobs = sorted((job for job in jobs.list_jobs() if job.status == jobs.DONE), key=lambda job: job.finished_at, reverse=True)
+store_sources = {
+    job.store_dir: f"Job : {', '.join(job.leagues)} ({job.from_date:%Y-%m-%d} - {job.to_date:%Y-%m-%d})" for job in finished_jobs
+}
+if store.store_exists():
+    store_sources[store.STORE_DIR] = "Latest processed data"
+predict = st.checkbox("Pre-fill with the model probabilities", value=bool(store_sources), disabled=not store_sources)
+store_dir = None
+if store_sources:
+    store_dir = st.selectbox(
+        "Processed data the models are fitted on", list(store_sources), format_func=store_sources.get, disabled=not predict
+    )
 
 if st.button("Generate prediction sheets"):
     with st.spinner("Fixtures fetching in progess...", show_time=True):
-        # Saving fixtures as Excel file
-        fixtures = get_current_week_fixtures(tz)
-        save_fixtures_as_sheets(fixtures, "tmp/prediction_sheet.xlsx")
+        # Saving fixtures as Excel file, in memory : sessions generating sheets at the same time do not share a file
+        fixtures = get_week_fixtures(tz, datetime.combine(week_day, datetime.min.time()))
+        workbook = BytesIO()
+        sheets = None
+        unscored = None
+        if predict and store_dir is not None:
+            # Models fitted again only for the leagues with new processed matches
+            probabilities = prediction.predict_fixtures(fixtures, store_dir)
+            sheets = prediction.prediction_sheets(fixtures, probabilities)
+            unscored = prediction.unscored_fixtures(fixtures, probabilities)
+        save_fixtures_as_sheets(fixtures, workbook, sheets)
+    if unscored is not None and not unscored.empty:
+        st.warning(
+            f"{len(unscored)} of {len(fixtures)} fixtures are left blank : their league has no processed matches, "
+            "or a team name of the fixtures feed is unknown (see the \"Fixtures team name\" column of the team mapping file)."
+        )
+        st.dataframe(unscored, hide_index=True)
     # Displaying download button
     d = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    with open("tmp/prediction_sheet.xlsx", "rb") as f:
-        st.download_button("Download prediction sheets", f, file_name=f"prediction_sheet_{d}.xlsx")
\ No newline at end of file
+    st.download_button("Download prediction sheets", workbook.getvalue(), file_name=f"prediction_sheet_{d}.xlsx")
\ No newline at end of file